@@ -12,7 +12,8 @@ import os
 # agency (token is created for a single agency)
 AGENCY_ID = "2"
 TRANZY_KEY = os.environ.get("TRANZY_KEY")
-TRANZY_URL = "https://api.tranzy.dev/v1/opendata/"
+# API base URL, can be overridden to use a local mock server (see tranzy_mock)
+TRANZY_URL = os.environ.get("TRANZY_URL", "https://api.tranzy.dev/v1/opendata/")
 
 AGENCY = "agency"
 VEHICLES = "vehicles"
@@ -22,6 +23,27 @@ SHAPES = "shapes"  # not used (route GPS coordinates)
 STOPS = "stops"
 STOP_TIMES = "stop_times"
 
+# HTTP client (shared keep-alive session for all API calls)
+HTTP_CONNECT_TIMEOUT = 5  # seconds
+HTTP_READ_TIMEOUT = 30  # seconds, static datasets (stop_times) can be several MB
+HTTP_POOL_SIZE = 4  # max connections kept alive to the API host
+
+# on-disk cache for static datasets (routes, trips, stops, stop_times)
+CACHE_DIR = "cache"
+CACHE_TTL = 24  # hours, after that the data is revalidated with the API
+
+# database
+DB_URL = "sqlite+pysqlite:///tranzy.db?charset=utf8mb4"
+# SQLite connection profile, applied on every new connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block the collector writes
+    "synchronous": "NORMAL",  # safe with WAL, fsync only at checkpoints
+    "busy_timeout": 5000,  # ms to wait for a lock (GUI and collector thread)
+    "cache_size": -65536,  # negative: KiB, 64 MiB page cache
+    "mmap_size": 268435456,  # 256 MiB memory mapped I/O
+    "temp_store": "MEMORY"  # temporary tables / sorts in memory
+}
+
 # statistics collection default duration
 TIME_TO_RUN = 30  # minutes
 # default polling interval
@@ -32,6 +54,40 @@ POLLING_INTERVAL = 30  # seconds
 MAX_DIST_TO_STOP = 300
 # tolerance in seconds (+/-) for vehicle datetime
 TIME_TOLERANCE = 60
+# stats: positions of a vehicle at a stop more than PASSAGE_GAP minutes apart belong to different passages
+PASSAGE_GAP = 10  # minutes
+# stats: longest travel time between the start and end stop, slower trips are shown without arrival
+MAX_TRAVEL_TIME = 60  # minutes
+
+# raw log of the vehicles snapshots (NDJSON), written when raw logging is enabled
+RAW_LOG_DIR = "raw_log"
+RAW_LOG_COMPRESSION = "zstd"  # zstd (needs zstandard, gzip if not installed), gzip or none
+RAW_LOG_MAX_SIZE = 64  # MiB per file (compressed), a new file is also started every day
+# replay of the raw log: days evaluated at the same time, rows per bulk insert
+REPLAY_WORKERS = 4
+REPLAY_BATCH = 10000
 
 # encoding for csv export (use utf-8-sig for UTF-8 BOM)
 CSV_ENC = "utf-8-sig"
+# export folder and rows read from the db at a time when exporting
+EXPORT_DIR = "exports"
+EXPORT_BATCH = 10000
+# trips exported at the same time (parquet export)
+EXPORT_WORKERS = 4
+
+# poll metrics (tranzy_metrics): Prometheus text file rewritten after each poll, None for no file
+METRICS_FILE = os.environ.get("TRANZY_METRICS_FILE")
+
+# opt-in profiling (tranzy_profile) of the collector polls and stats window: enabled by TRANZY_PROFILE=1,
+# one call in PROFILE_EVERY profiled (all stats computations), pstats or collapsed stacks file per session
+PROFILE = os.environ.get("TRANZY_PROFILE", "") not in ("", "0")
+PROFILE_EVERY = int(os.environ.get("TRANZY_PROFILE_EVERY", 10))
+# deterministic: cProfile, exact call counts (.prof); sampling: stack sampler, low overhead (.folded)
+PROFILE_MODE = os.environ.get("TRANZY_PROFILE_MODE", "deterministic")
+PROFILE_STATS_EVERY = 1
+PROFILE_DIR = "profiles"
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+
+# benchmarks (tranzy_bench): generated fixture dbs and baseline results
+BENCH_DIR = "bench"
+BENCH_BASELINE = "bench/baseline.json"
@@ -6,25 +6,36 @@ from tkinter import *
 from tkinter import ttk, messagebox
 
 from datetime import datetime, timedelta, time
+from time import monotonic
+import math
+import queue
 
 from sqlalchemy.orm import Session
 
 from config import POLLING_INTERVAL, TIME_TO_RUN, AGENCY_ID
-from tranzy_db_tools import get_monitored_trips, get_monitor_config, insert_position, export_csv, delete_trip_data
-from tranzy_req import get_agency_name, get_vehicles
+from tranzy_collector import Collector
+from tranzy_db_tools import get_monitored_trips, get_monitor_index, delete_trip_data
+from tranzy_export import export_csv, export_trips_parquet, pa
+from tranzy_req import get_agency_name, client
 
 
 class MainWindow:
     def __init__(self, r: Tk, s: Session):
-        self.after_countdown_id = None  # id to cancel scheduling of countdown (single polling)
-        self.after_stop_polling_id = None  # id to cancel scheduling of stop polling (time to run)
+        self.after_countdown_id = None  # id to cancel scheduling of countdown (next poll display)
         self.after_actual_start_id = None  # id to cancel scheduling of deferred start
+        self.after_drain_id = None  # id to cancel scheduling of collector messages processing
+        self.collector = None  # background thread polling vehicles
+        self.collector_messages = queue.Queue()  # messages from collector thread to GUI
+        self.next_poll = None  # monotonic time of next poll, from collector
+        self.monitoring_end = None  # monotonic time of monitoring end
+        self.counters = {}  # last counters received from collector
+        self.poll_timing = {}  # last poll timing statistics received from collector
+        self.poll_metrics = None  # stats line of the last poll received from collector
         self.time_to_run = TIME_TO_RUN  # default time to run the polling (minutes)
         self.monitoring = False  # monitoring in progress
         self.trip_id_list = []  # to support multiple trips monitoring
         self.session = s  # SQLAlchemy session
-        self.trip_list = []  # to support multiple trips monitoring
-        self.stops_object_list_list = []  # to support multiple trips monitoring
+        self.monitor_index = None  # spatial index of the monitored stops of all monitored trips
         # dict to define widget's state based on execution state
         self.widget_states = {
             "idle_no_trip": {
@@ -181,7 +192,7 @@ class MainWindow:
         self.start_monitoring_button.grid(column=0, columnspan=4, row=10)
 
         self.raw_log_var = BooleanVar(value=False)
-        self.raw_log_check = ttk.Checkbutton(left_frame, text="Raw logging vehicles JSON (big size)",
+        self.raw_log_check = ttk.Checkbutton(left_frame, text="Raw logging vehicles JSON (compressed)",
                                         variable=self.raw_log_var, onvalue=True, offvalue=False)
         self.raw_log_check.grid(column=0, columnspan=4, row=11)
 
@@ -269,13 +280,8 @@ class MainWindow:
         """
         self.set_widget_state("monitoring")
         self.raw_log_check.configure(state=DISABLED)
-        self.trip_list.clear()
-        self.stops_object_list_list.clear()
         self.set_trip_id_list()
-        for t_id in self.trip_id_list:
-            temp_t, temp_stops_list, start_stop, end_stop = get_monitor_config(self.session, t_id)
-            self.trip_list.append(temp_t)
-            self.stops_object_list_list.append(temp_stops_list)
+        self.monitor_index = get_monitor_index(self.session, self.trip_id_list)
 
         # disable widgets under radio buttons
         self.minutes_to_run_label.configure(state=DISABLED)
@@ -319,11 +325,16 @@ class MainWindow:
         self.after_actual_start_id = None
         self.write_log(f"polling vehicles for trip {', '.join(self.trip_id_list)} for {self.time_to_run} minutes")
         self.monitoring = True
-        # call countdown_total which will call stop_monitoring after time_to_run
-        self.countdown_total(self.time_to_run)
-        # first call to countdown which will call itself every second for polling_interval_var
-        # when timer reaches 0 it polls vehicles
-        self.countdown(0)
+        # polling runs in background thread until monitoring_end, GUI processes its messages
+        self.monitoring_end = monotonic() + self.time_to_run * 60
+        self.collector_messages = queue.Queue()
+        self.collector = Collector(self.session.get_bind(), self.trip_id_list, self.monitor_index,
+                                   int(self.polling_interval_var.get()), self.raw_log_var.get(),
+                                   self.collector_messages, self.monitoring_end)
+        self.collector.start()
+        self.next_poll = None
+        self.countdown()
+        self.process_collector_messages()
 
     def stop_monitoring(self):
         """
@@ -332,14 +343,14 @@ class MainWindow:
         """
         self.timer_var.set("--")
         self.remaining_var.set(value="--")
-        # cancel polling if in progress
+        # stop polling thread if in progress
+        if self.collector:
+            self.collector.stop()
+            self.collector = None
+        # cancel countdown display if in progress
         if self.after_countdown_id:
             self.root.after_cancel(self.after_countdown_id)
             self.after_countdown_id = None
-        # cancel total run time if in progress
-        if self.after_stop_polling_id:
-            self.root.after_cancel(self.after_stop_polling_id)
-            self.after_stop_polling_id = None
         # cancel deferred start if in progress
         if self.after_actual_start_id:
             self.root.after_cancel(self.after_actual_start_id)
@@ -347,50 +358,76 @@ class MainWindow:
         self.set_widget_state("idle_trip")
         self.raw_log_check.configure(state=NORMAL)
         self.monitoring = False
+        # log messages already sent by collector
+        if self.after_drain_id:
+            self.root.after_cancel(self.after_drain_id)
+            self.after_drain_id = None
+            self.process_collector_messages(reschedule=False)
         self.write_log("polling stopped")
+        if self.counters:
+            self.write_log(f"{self.counters['polls']} polls, {self.counters['stored']} positions saved, "
+                           f"{self.counters['skipped']} skipped, {self.counters['errors']} errors")
+            self.counters = {}
+        if self.poll_timing:
+            self.write_log(f"poll duration max {self.poll_timing['max_duration']:.2f} s, "
+                           f"jitter mean {self.poll_timing['mean_jitter'] * 1000:.0f} ms / "
+                           f"max {self.poll_timing['max_jitter'] * 1000:.0f} ms, "
+                           f"{self.poll_timing['skipped_ticks']} missed polls merged")
+            self.poll_timing = {}
+        http_stats = client.connection_stats()
+        self.write_log(f"HTTP: {http_stats['requests']} requests over {http_stats['connections']} connections, "
+                       f"reuse rate {http_stats['reuse_rate']:.0%}")
         # enable corresponding widgets under radio buttons
         self.select_interval_type()
         self.deselect_config_trips()
 
-    def countdown(self, timer: int):
+    def countdown(self):
         """
-        Countdown for set timer in seconds. Poll vehicles when reaches zero.
-        :param timer: Countdown seconds
+        Display seconds until next poll and minutes until end of monitoring, refreshed every second.
         :return: None
         """
-        self.timer_var.set(value=str(timer))
-        if timer > 0:
-            self.after_countdown_id = self.root.after(1000, self.countdown, timer - 1)
+        if self.next_poll:
+            self.timer_var.set(value=str(max(0, math.ceil(self.next_poll - monotonic()))))
         else:
-            # poll vehicles from the API and insert in db
             self.timer_var.set("--")
-            self.timer_label.update()
-            if self.monitoring:
-                vehicles = get_vehicles(self.trip_id_list, self.raw_log_var.get())
-                if not vehicles or len(vehicles) == 0:
-                    self.write_log("no vehicles on route", 2)
-                else:
-                    for v in vehicles:
-                        # for each vehicle find the objects list index to send correct parameters to insert_position
-                        list_index = next(self.trip_list.index(item)
-                                          for item in self.trip_list if item.trip_id == v["trip_id"])
-                        msg, msg_type = insert_position(self.session, self.trip_list[list_index], v,
-                                                        self.stops_object_list_list[list_index])
-                        self.write_log(msg, msg_type)
-                self.countdown(int(self.polling_interval_var.get()))
-
-    def countdown_total(self, total_timer: int):
-        """
-        Countdown for total timer. Stop monitoring when reaches zero.
-        :param total_timer: Remaining countdown in minutes
+        self.remaining_var.set(value=str(max(0, math.ceil((self.monitoring_end - monotonic()) / 60))))
+        self.after_countdown_id = self.root.after(1000, self.countdown)
+
+    def process_collector_messages(self, reschedule: bool = True):
+        """
+        Process messages sent by the collector thread (log lines, next poll time, counters, timing).
+        Stops monitoring when the collector reached the end time.
+        :param reschedule: Call itself again after 200 ms
         :return: None
         """
-        self.remaining_var.set(value=str(total_timer))
-        if total_timer > 0:
-            self.after_stop_polling_id = self.root.after(60000, self.countdown_total, total_timer - 1)
-        else:
-            self.remaining_var.set(value="--")
+        finished = False
+        while True:
+            try:
+                msg = self.collector_messages.get_nowait()
+            except queue.Empty:
+                break
+            if msg[0] == "log":
+                self.write_log(msg[1], msg[2])
+            elif msg[0] == "next_poll":
+                self.next_poll = msg[1]
+            elif msg[0] == "counters":
+                self.counters = msg[1]
+            elif msg[0] == "poll_metrics":
+                self.poll_metrics = msg[1]
+            elif msg[0] == "poll_timing":
+                self.poll_timing = msg[1]
+                # poll_metrics of the same poll is sent before
+                self.write_log(f"poll took {msg[1]['last_duration']:.2f} s, "
+                               f"started {msg[1]['last_jitter'] * 1000:.0f} ms after schedule"
+                               f"{' - ' + self.poll_metrics if self.poll_metrics else ''}")
+            elif msg[0] == "finished":
+                finished = True
+        if finished and self.monitoring:
+            # collector reached the end of monitoring time
+            self.after_drain_id = None
             self.stop_monitoring()
+        elif reschedule:
+            self.after_drain_id = self.root.after(200, self.process_collector_messages)
 
     def write_log(self, message, msg_type=0):
         """
@@ -455,18 +492,45 @@ class MainWindow:
 
     def export_trip(self):
         """
-        Export statistics of selected trip to csv
+        Export statistics of selected trip to csv, or of multiple selected trips to parquet files
         :return: File name
         """
         self.set_trip_id_list()
         if len(self.trip_id_list) == 1:
-            f = export_csv(self.session, self.trip_id_list[0])
+            f = export_csv(self.session, self.trip_id_list[0], progress=self.export_progress)
             if f:
                 messagebox.showinfo("CSV export", f"File saved\n{f}")
             else:
                 messagebox.showerror("CSV export", "No data to export!")
+        elif pa is None:
+            messagebox.showerror("Parquet export", "Multiple trips are exported to parquet files, "
+                                                   "install pyarrow for this operation!")
         else:
-            messagebox.showerror("CSV export", "Select a single trip for this operation!")
+            files = export_trips_parquet(self.session.get_bind(), self.trip_id_list,
+                                         progress=self.export_trips_progress)
+            saved = [f for f in files.values() if f]
+            if saved:
+                messagebox.showinfo("Parquet export", "Files saved\n" + "\n".join(saved))
+            else:
+                messagebox.showerror("Parquet export", "No data to export!")
+
+    def export_progress(self, written, total):
+        """
+        Log export progress and refresh the window while the rows are written
+        :param written: Rows written
+        :param total: Rows to export
+        :return: None
+        """
+        self.write_log(f"Export: {written} of {total} rows ({written * 100 // total}%)")
+        self.root.update_idletasks()
+
+    def export_trips_progress(self, trip_id, file_name, rows, done, total):
+        """
+        Log progress of a multiple trips export
+        :return: None
+        """
+        self.write_log(f"Export {done}/{total}: {trip_id} - {f'{rows} rows' if file_name else 'no data'}")
+        self.root.update_idletasks()
 
     def delete_trip(self):
         """
@@ -6,13 +6,15 @@ from tkinter import *
 from tkinter import ttk, messagebox
 
 from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from config import AGENCY_ID
 from interface import MainWindow
 from tranzy_db import Trip, StopOrder, MonitoredStops
-from tranzy_db_tools import update_stops, get_route_stops
-from tranzy_req import get_route, get_trips, get_stop_order
+from tranzy_db_tools import update_stops, get_trip_stops
+from tranzy_gtfs import repository
+from tranzy_req import expire_cache
 
 
 class AddTripWindow:
@@ -28,7 +30,7 @@ class AddTripWindow:
 
         self.add_trip_window = Toplevel(self.root)
         self.add_trip_window.title("Add trip")
-        add_trip_frame = ttk.Frame(self.add_trip_window, width=500, height=430)
+        add_trip_frame = ttk.Frame(self.add_trip_window, width=500, height=480)
         add_trip_frame.grid_propagate(False)
         add_trip_frame.grid(column=0, row=0)
 
@@ -80,6 +82,10 @@ class AddTripWindow:
                                           command=self.commit_trip)
         self.add_trip_button.grid(column=2, row=3)
 
+        refresh_data_button = ttk.Button(add_trip_frame, width=30, text="Refresh API data",
+                                         command=self.refresh_data)
+        refresh_data_button.grid(column=2, row=4)
+
         for child in add_trip_frame.winfo_children():
             child.grid_configure(padx=5, pady=10)
 
@@ -93,9 +99,9 @@ class AddTripWindow:
         Search route and corresponding trips and create the Trip object. Command for search_trips_button.
         :return: None
         """
-        route = get_route(self.line_number_var.get())
+        route = repository.routes(self.line_number_var.get())
         if route:
-            self.route_trips = get_trips(route[0]["route_id"])
+            self.route_trips = repository.trips(route[0]["route_id"])
             self.trips_var.set(value="0")
             self.trip0_var.set(value=f"{route[0]['route_short_name']} to {self.route_trips[0]['trip_headsign']}")
             self.trip1_var.set(value=f"{route[0]['route_short_name']} to {self.route_trips[1]['trip_headsign']}")
@@ -146,31 +152,20 @@ class AddTripWindow:
         and Stop object retrieve from db. Command for search_stops_button.
         :return: None
         """
-        # retrieve stops order for selected trip from API
-        stops_order = get_stop_order(self.route_trips[int(self.trips_var.get())]["trip_id"])
-        if stops_order:
-            stop_id_list = [s_o["stop_id"] for s_o in stops_order]
-            # retrieve Stop objects from db
-            stop_object_list = get_route_stops(self.session, stop_id_list)
+        # retrieve stops order for selected trip from repository, with Stop objects from db
+        trip_stops = get_trip_stops(self.session, self.route_trips[int(self.trips_var.get())]["trip_id"])
+        if trip_stops:
             # create objects for stops order
             self.stops_order_object_list = []
             self.stops_choices = []
-            for s_o in stops_order:
-                # enumerate all trip's stops
-                try:
-                    stop_idx, stop_name = next(
-                        (item.idx, item.stop_name) for item in stop_object_list if item.stop_id == s_o["stop_id"])
-                except StopIteration:
-                    print(f"Stop {s_o['stop_id']} not found in db!")
-                else:
-                    # corresponding stop object found in db
-                    # create StopOrder object linked to Trip and Stop objects
-                    self.stops_order_object_list.append(StopOrder(
-                        stop_order=s_o["stop_sequence"],
-                        trip=self.trip,
-                        stop_idx=stop_idx
-                    ))
-                    self.stops_choices.append(f"{s_o['stop_sequence']} - {stop_name}")
+            for stop_sequence, stop in trip_stops:
+                # create StopOrder object linked to Trip and Stop objects
+                self.stops_order_object_list.append(StopOrder(
+                    stop_order=stop_sequence,
+                    trip=self.trip,
+                    stop_idx=stop.idx
+                ))
+                self.stops_choices.append(f"{stop_sequence} - {stop.stop_name}")
 
             # update stops_list widget
             self.stops_choices_var.set(self.stops_choices)
@@ -192,7 +187,14 @@ class AddTripWindow:
         self.session.add(self.trip)
         self.session.add_all(self.stops_order_object_list)
         self.session.add(m)
-        self.session.commit()
+        try:
+            self.session.commit()
+        except IntegrityError:
+            # trip_id is unique
+            self.session.rollback()
+            messagebox.showerror("Error", f"Trip {self.trip.trip_id} is already configured!",
+                                 parent=self.add_trip_window)
+            return
         messagebox.showinfo("Information", "Trip added to database", parent=self.add_trip_window)
         self.window_close()
 
@@ -230,6 +232,17 @@ class AddTripWindow:
         self.main_window.deselect_config_trips()
         self.add_trip_window.destroy()
 
+    def refresh_data(self):
+        """
+        Expire cached routes, trips, stops and stop times, revalidate them with the server and refresh stops in db.
+        Cached data is replaced only by a successful download.
+        Command for refresh_data_button.
+        :return: None
+        """
+        expire_cache()
+        update_stops(self.session)
+        messagebox.showinfo("Information", "API data refreshed", parent=self.add_trip_window)
+
     def cr_pressed(self, event):
         """
         Search for trips if Enter pressed while focus is on line_number_entry or search_trips_button.
@@ -10,8 +10,7 @@ from sqlalchemy.orm import Session
 
 from interface import MainWindow
 from tranzy_db import Trip
-from tranzy_db_tools import get_monitor_config, get_route_stops, update_monitored_stops
-from tranzy_req import get_stop_order
+from tranzy_db_tools import get_monitor_config, get_trip_stops, update_monitored_stops
 
 
 class ModTripWindow:
@@ -60,23 +59,10 @@ class ModTripWindow:
         """
         self.trip, stops_list, self.start_stop, self.end_stop = get_monitor_config(self.session,
                                                                                    self.main_window.trip_id_list[0])
-        stops_order = get_stop_order(self.trip.trip_id)
-        if stops_order:
-            stop_id_list = [s_o["stop_id"] for s_o in stops_order]
-            # retrieve Stop objects from db
-            stop_object_list = get_route_stops(self.session, stop_id_list)
-            # create objects for stops order
-            self.stops_choices = []
-            for s_o in stops_order:
-                # enumerate all trip's stops
-                try:
-                    stop_idx, stop_name = next(
-                        (item.idx, item.stop_name) for item in stop_object_list if item.stop_id == s_o["stop_id"])
-                except StopIteration:
-                    print(f"Stop {s_o['stop_id']} not found in db!")
-                else:
-                    # corresponding stop object found in db - append to list var
-                    self.stops_choices.append(f"{s_o['stop_sequence']} - {stop_name}")
+        trip_stops = get_trip_stops(self.session, self.trip.trip_id)
+        if trip_stops:
+            # enumerate all trip's stops
+            self.stops_choices = [f"{stop_sequence} - {stop.stop_name}" for stop_sequence, stop in trip_stops]
 
             # update stops_list widget
             self.stops_choices_var.set(self.stops_choices)
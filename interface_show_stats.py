@@ -1,7 +1,7 @@
 """
 Interface to show statistics for selected trip at specific start/end stops
 """
-from datetime import timezone, timedelta
+from datetime import date, timezone, timedelta
 
 from tkinter import *
 from tkinter import ttk, messagebox
@@ -9,10 +9,13 @@ from tkinter import ttk, messagebox
 from sqlalchemy import inspect
 from sqlalchemy.orm import Session
 
+from config import PROFILE_STATS_EVERY
 from interface import MainWindow
 from tranzy_db import Trip
-from tranzy_db_tools import get_monitor_config, get_route_stops, get_trip_stats
-from tranzy_req import get_stop_order
+from tranzy_db_tools import get_monitor_config, get_trip_stops, get_trip_stats
+from tranzy_traversals import get_segment_stats, traversals_built
+from tranzy_profile import profiled
+from tranzy_recommend import departure_table, recommend_departure
 
 
 class ShowStatsWindow:
@@ -32,10 +35,10 @@ class ShowStatsWindow:
         trip_desc_label.grid(column=0, columnspan=2, row=0)
         trip_desc_label.grid_configure(padx=5, pady=10)
 
-        left_frame = ttk.Frame(self.show_stats_window, width=250, height=450)
+        left_frame = ttk.Frame(self.show_stats_window, width=250, height=500)
         left_frame.grid_propagate(False)
         left_frame.grid(column=0, row=1)
-        right_frame = ttk.Frame(self.show_stats_window, width=420, height=450)
+        right_frame = ttk.Frame(self.show_stats_window, width=420, height=500)
         right_frame.grid_propagate(False)
         right_frame.grid(column=1, row=1)
 
@@ -53,6 +56,10 @@ class ShowStatsWindow:
                                             state=DISABLED, command=self.show_stats)
         self.show_stats_button.grid(column=0, row=2)
 
+        self.departures_button = ttk.Button(left_frame, width=30, text="When to leave",
+                                            state=DISABLED, command=self.show_departures)
+        self.departures_button.grid(column=0, row=3)
+
         for child in left_frame.winfo_children():
             child.grid_configure(padx=5, pady=10)
 
@@ -92,25 +99,11 @@ class ShowStatsWindow:
         """
         self.trip, stops_list, self.start_stop, self.end_stop = get_monitor_config(self.session,
                                                                                    self.main_window.trip_id_list[0])
-        stops_order = get_stop_order(self.trip.trip_id)
-        if stops_order:
-            stop_id_list = [s_o["stop_id"] for s_o in stops_order]
-            # retrieve Stop objects from db
-            stop_object_list = get_route_stops(self.session, stop_id_list)
-            # create objects for stops order
-            self.stops_choices = []
-            self.stop_idx_list = []
-            for s_o in stops_order:
-                # enumerate all trip's stops
-                try:
-                    stop_idx, stop_name = next(
-                        (item.idx, item.stop_name) for item in stop_object_list if item.stop_id == s_o["stop_id"])
-                except StopIteration:
-                    print(f"Stop {s_o['stop_id']} not found in db!")
-                else:
-                    # corresponding stop object found in db - append to list var
-                    self.stops_choices.append(f"{s_o['stop_sequence']} - {stop_name}")
-                    self.stop_idx_list.append(stop_idx)
+        trip_stops = get_trip_stops(self.session, self.trip.trip_id)
+        if trip_stops:
+            # enumerate all trip's stops
+            self.stops_choices = [f"{stop_sequence} - {stop.stop_name}" for stop_sequence, stop in trip_stops]
+            self.stop_idx_list = [stop.idx for stop_sequence, stop in trip_stops]
 
             # update stops_list widget with just the monitored stops
             self.stops_choices = self.stops_choices[self.start_stop: self.end_stop + 1]
@@ -126,37 +119,43 @@ class ShowStatsWindow:
         idx_tuple = self.stops_list.curselection()
         if len(idx_tuple) > 1:
             self.show_stats_button.configure(state=NORMAL)
+            self.departures_button.configure(state=NORMAL)
             self.start_stop = min(idx_tuple)
             self.end_stop = max(idx_tuple)
             self.start_label_var.set(value=self.stops_choices[self.start_stop].split(" - ")[1])
             self.end_label_var.set(value=self.stops_choices[self.end_stop].split(" - ")[1])
         else:
             self.show_stats_button.configure(state=DISABLED)
+            self.departures_button.configure(state=DISABLED)
             self.start_stop = 0
             self.end_stop = 0
 
+    @profiled("show_stats", PROFILE_STATS_EVERY)
     def show_stats(self):
         """
         Retrieve db data and insert in Text widget
         :return: None
         """
-        positions_start, positions_end = get_trip_stats(self.session, self.trip.idx,
-                                                        self.stop_idx_list[self.start_stop],
-                                                        self.stop_idx_list[self.end_stop])
+        # precomputed traversals, pairing from positions if the history is not built (upgraded db before backfill)
+        if traversals_built(self.session, self.trip.idx):
+            trip_stats = get_segment_stats(self.session, self.trip.idx,
+                                           self.stop_idx_list[self.start_stop],
+                                           self.stop_idx_list[self.end_stop])
+        else:
+            trip_stats = get_trip_stats(self.session, self.trip.idx,
+                                        self.stop_idx_list[self.start_stop],
+                                        self.stop_idx_list[self.end_stop])
         self.stats_text.configure(state=NORMAL)
-        if positions_start and positions_end:
+        if trip_stats:
             self.stats_text.delete("1.0", END)
-            for i in range(len(positions_start)):
-                row = f"{positions_start[i].vehicle_no} : "
-                row += f"{positions_start[i].timestamp.replace(tzinfo=timezone.utc).astimezone(tz=None).strftime('%d.%m.%Y %H:%M:%S')}"
-                row += " >>> no data\n"
-                # find the correspondent vehicle in positions_end
-                for j in range(max(0, i - 10), min(len(positions_end), i + 10)):
-                    if positions_start[i].vehicle_no == positions_end[j].vehicle_no \
-                            and timedelta(0) < (positions_end[j].timestamp - positions_start[i].timestamp) < timedelta(60):
-                        travel_time = str(positions_end[j].timestamp - positions_start[i].timestamp)
-                        row = row.replace("no data", f"{positions_end[j].timestamp.replace(tzinfo=timezone.utc).astimezone(tz=None).strftime('%H:%M:%S')} in {travel_time[travel_time.find(':') + 1:]}")
-                        break
+            for s in trip_stats:
+                row = f"{s.vehicle_no} : "
+                row += f"{s.departure.replace(tzinfo=timezone.utc).astimezone(tz=None).strftime('%d.%m.%Y %H:%M:%S')}"
+                if s.arrival:
+                    travel_time = str(timedelta(seconds=s.travel_time))
+                    row += f" >>> {s.arrival.replace(tzinfo=timezone.utc).astimezone(tz=None).strftime('%H:%M:%S')} in {travel_time[travel_time.find(':') + 1:]}\n"
+                else:
+                    row += " >>> no data\n"
                 self.stats_text.insert(END, row)
             self.stats_text.see(END)
         else:
@@ -165,6 +164,39 @@ class ShowStatsWindow:
             self.stats_text.delete("1.0", END)
         self.stats_text.configure(state=DISABLED)
 
+    def show_departures(self):
+        """
+        Show travel time percentiles by time of day for today's weekday and the recommended departure
+        :return: None
+        """
+        if not traversals_built(self.session, self.trip.idx):
+            messagebox.showerror(title="When to leave",
+                                 message="Travel times of the collected history are not built yet, run:\n"
+                                         "python -m tranzy_stats backfill",
+                                 parent=self.show_stats_window)
+            return
+        start_stop_idx = self.stop_idx_list[self.start_stop]
+        end_stop_idx = self.stop_idx_list[self.end_stop]
+        table = departure_table(self.session, self.trip.idx, start_stop_idx, end_stop_idx, date.today().isoweekday())
+        self.stats_text.configure(state=NORMAL)
+        self.stats_text.delete("1.0", END)
+        if table:
+            best = recommend_departure(self.session, self.trip.idx, start_stop_idx, end_stop_idx)
+            if best:
+                self.stats_text.insert(END, f"Best in the next hour: {best['time'].strftime('%H:%M')}, arrival "
+                                            f"{best['p50_arrival'].strftime('%H:%M')} (p90 "
+                                            f"{best['p90_arrival'].strftime('%H:%M')})\n\n")
+            self.stats_text.insert(END, "At stop   wait   travel   total p50/p90  days\n")
+            for row in table:
+                travel = f"{row['travel_p50'] / 60:4.0f}'" if row["travel_p50"] is not None else "   -"
+                self.stats_text.insert(END, f"{row['time'].strftime('%H:%M')}    {row['wait_p50'] / 60:4.0f}'   "
+                                            f"{travel:>5}    {row['total_p50'] / 60:4.0f}' / "
+                                            f"{row['total_p90'] / 60:3.0f}'    {row['samples']}\n")
+        else:
+            messagebox.showerror(title="When to leave", message="No complete days of data for this weekday!",
+                                 parent=self.show_stats_window)
+        self.stats_text.configure(state=DISABLED)
+
     def window_close(self):
         """
         On exit main window widgets states and refresh configured_trips
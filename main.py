@@ -1,18 +1,16 @@
 
 from tkinter import Tk
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
-from tranzy_db import Base
+from tranzy_db import open_db
 from interface import MainWindow
 
 
 def main():
 
     # connect to db
-    engine = create_engine("sqlite+pysqlite:///tranzy.db?charset=utf8mb4", echo=False)
-    Base.metadata.create_all(engine)
+    engine = open_db()
     session = Session(engine)
 
     root = Tk()
@@ -0,0 +1,27 @@
+"""
+Haversine distance of tranzy_geo against the WGS-84 geodesic distance of geopy.
+"""
+
+import numpy as np
+import pytest
+
+from config import MAX_DIST_TO_STOP
+from tranzy_geo import haversine, HAVERSINE_MAX_REL_ERROR
+
+distance = pytest.importorskip("geopy.distance")
+
+
+def test_haversine_error_bound():
+    """
+    Random points up to MAX_DIST_TO_STOP apart: the relative error of haversine stays below HAVERSINE_MAX_REL_ERROR
+    """
+    rng = np.random.default_rng(42)
+    max_error = 0.0
+    for _ in range(10000):
+        start = (rng.uniform(-70, 70), rng.uniform(-180, 180))
+        d = rng.uniform(1, MAX_DIST_TO_STOP)
+        end = distance.distance(meters=d).destination(start, rng.uniform(0, 360))
+        geodesic = distance.distance(start, (end.latitude, end.longitude)).m
+        approx = haversine(*np.radians([start[0], start[1], end.latitude, end.longitude]))
+        max_error = max(max_error, abs(approx - geodesic) / geodesic)
+    assert max_error <= HAVERSINE_MAX_REL_ERROR, f"haversine error {max_error:.4%} above bound"
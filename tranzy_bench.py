@@ -0,0 +1,277 @@
+"""
+Benchmarks of the ingest and stats hot paths, on synthetic data generated from a fixed seed:
+ - insert_positions: one poll of N vehicles on trips with S monitored stops (evaluation, insert, traversals)
+ - get_trip_stats: travel times between the first and last stop of a trip, with a position table of P rows
+ - export_csv: export of all the positions of that trip
+ - update_stops: stops refresh from the API (mock server in this process), all new and nothing new
+Each case reports latency percentiles, throughput (items per second) and peak Python memory (tracemalloc,
+measured in an extra run because it slows the code down). Results are saved as JSON and compared with a baseline.
+Position tables are synthetic histories (tranzy_synth) generated once per size and seed and kept in BENCH_DIR,
+so later runs start at once; a larger db made with the synth command can be given by its manifest instead.
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import Engine, select, insert, delete, func
+from sqlalchemy.orm import Session
+
+import tranzy_req
+from config import BENCH_DIR
+from tranzy_db import Trip, Stop, StopOrder, MonitoredStops, Position, open_db
+from tranzy_db_tools import get_monitor_index, insert_positions, get_trip_stats, update_stops
+from tranzy_export import export_csv
+from tranzy_mock import MockNetwork, MockServer
+from tranzy_synth import generate, manifest_file
+
+# sizes of each suite; repeat: timed runs per case
+SUITES = {
+    "quick": {"vehicles": [1000], "stops": [10, 100], "positions": [100000], "update_stops": [2500], "repeat": 5},
+    "full": {"vehicles": [1000, 10000], "stops": [10, 100], "positions": [1000000, 10000000],
+             "update_stops": [2500, 10000], "repeat": 20},
+}
+POSITIONS_ROUTES = 2  # routes (4 trips) of the position table fixtures
+
+
+def measure(run, setup=None, repeat: int = 5, items: int = 1) -> dict:
+    """
+    :param run: Function to measure, called with the arguments returned by setup
+    :param setup: Function called before each run (not timed), returning a tuple of arguments, or None
+    :param repeat: Timed runs
+    :param items: Items processed by a run, for throughput
+    :return: Dict: runs, p50_ms, p95_ms, p99_ms, mean_ms, items, items_per_s (at p50), peak_mb
+    """
+    durations = []
+    for i in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        run(*args)
+        durations.append(time.perf_counter() - start)
+    args = setup() if setup else ()
+    tracemalloc.start()
+    try:
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    ms = np.array(durations) * 1000
+    p50 = float(np.percentile(ms, 50))
+    return {"runs": repeat, "p50_ms": round(p50, 3), "p95_ms": round(float(np.percentile(ms, 95)), 3),
+            "p99_ms": round(float(np.percentile(ms, 99)), 3), "mean_ms": round(float(ms.mean()), 3),
+            "items": items, "items_per_s": round(items / p50 * 1000, 1) if p50 else None,
+            "peak_mb": round(peak / 2 ** 20, 3)}
+
+
+def network_db(engine: Engine, network: MockNetwork):
+    """
+    Save the stops and trips of a synthetic network in db, all stops of all trips monitored
+    :param engine: Engine of an empty db
+    :param network: MockNetwork
+    :return: None
+    """
+    with Session(engine) as session:
+        session.execute(insert(Stop), [{k: s[k] for k in ("stop_id", "stop_name", "stop_lat", "stop_lon")}
+                                       for s in network.stops])
+        stop_idx = dict(session.execute(select(Stop.stop_id, Stop.idx)).all())
+        routes = {r["route_id"]: r for r in network.routes}
+        for t in network.trips:
+            route = routes[t["route_id"]]
+            trip = Trip(agency_id=route["agency_id"], route_id=route["route_id"], trip_id=t["trip_id"],
+                        shape_id=t["shape_id"], route_short_name=route["route_short_name"],
+                        route_long_name=route["route_long_name"], trip_headsign=t["trip_headsign"], monitored=True)
+            session.add(trip)
+            stop_times = [s for s in network.stop_times if s["trip_id"] == t["trip_id"]]
+            session.add_all([StopOrder(stop_order=s["stop_sequence"], trip=trip, stop_idx=stop_idx[s["stop_id"]])
+                             for s in stop_times])
+            session.add(MonitoredStops(start_stop=0, end_stop=len(stop_times) - 1, trip=trip))
+        session.commit()
+
+
+def positions_fixture(rows: int, seed: int, work_dir: str = BENCH_DIR) -> str:
+    """
+    Db with a position table of the given size: synthetic history (tranzy_synth) of 2 routes (4 trips),
+    without segment traversals. Generated once per size and seed.
+    :param rows: Positions
+    :param seed: Random seed
+    :param work_dir: Folder of the fixture dbs
+    :return: Db URL
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    file_name = os.path.join(work_dir, f"synth_{rows}_seed{seed}.db")
+    url = f"sqlite+pysqlite:///{file_name}"
+    if os.path.exists(file_name):
+        return url
+    tmp_name = os.path.join(work_dir, f"synth_{rows}_seed{seed}.tmp.db")
+    for f in (tmp_name, f"{tmp_name}-wal", f"{tmp_name}-shm", manifest_file(tmp_name)):
+        if os.path.exists(f):
+            os.remove(f)
+    generate(tmp_name, days=1, routes=POSITIONS_ROUTES, seed=seed, max_rows=rows, traversals=False)
+    os.replace(tmp_name, file_name)
+    os.replace(manifest_file(tmp_name), manifest_file(file_name))
+    return url
+
+
+def bench_insert_positions(vehicles: int, stops: int, seed: int, repeat: int, work_dir: str = BENCH_DIR) -> dict:
+    """
+    insert_positions with one poll of vehicles on monitored trips (all within distance of a stop, 5% stale)
+    :return: Dict case name -> measure results
+    """
+    routes = max(1, stops // 25)
+    network = MockNetwork(routes=routes, stops_per_trip=stops // routes, vehicles=vehicles, seed=seed)
+    os.makedirs(work_dir, exist_ok=True)
+    file_name = os.path.join(work_dir, "insert.db")
+    for f in (file_name, f"{file_name}-wal", f"{file_name}-shm"):
+        if os.path.exists(f):
+            os.remove(f)
+    engine = open_db(f"sqlite+pysqlite:///{file_name}")
+    network_db(engine, network)
+    with Session(engine) as session:
+        monitor_index = get_monitor_index(session, list(network.paths))
+        # positions are timestamped at each run, within TIME_TOLERANCE
+        result = measure(lambda vehicles_data: insert_positions(session, vehicles_data, monitor_index),
+                         lambda: (network.vehicles(),), repeat, vehicles)
+    engine.dispose()
+    return {f"insert_positions[vehicles={vehicles},stops={stops}]": result}
+
+
+def bench_positions(rows: int, seed: int, repeat: int, work_dir: str = BENCH_DIR, db_url: str = None) -> dict:
+    """
+    get_trip_stats and export_csv of one trip on a position table of the given size
+    :param db_url: Db to use (e.g. from a tranzy_synth manifest) instead of the generated fixture
+    :return: Dict case name -> measure results
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    engine = open_db(db_url or positions_fixture(rows, seed, work_dir))
+    results = {}
+    with Session(engine) as session:
+        trip = session.execute(select(Trip).order_by(Trip.idx)).scalars().first()
+        order = session.execute(select(StopOrder.stop_idx).where(StopOrder.trip_idx == trip.idx)
+                                .order_by(StopOrder.stop_order)).scalars().all()
+        trip_rows = session.execute(select(func.count(Position.idx)).where(Position.trip_idx == trip.idx)).scalar()
+        results[f"get_trip_stats[positions={rows}]"] = measure(
+            lambda: get_trip_stats(session, trip.idx, order[0], order[-1]), repeat=repeat, items=trip_rows)
+        file_name = os.path.join(work_dir, "export.csv")
+
+        def remove_export():
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            return ()
+
+        results[f"export_csv[positions={rows}]"] = measure(
+            lambda: export_csv(session, trip.trip_id, file_name=file_name), remove_export, repeat, trip_rows)
+        remove_export()
+    engine.dispose()
+    return results
+
+
+def bench_update_stops(stops: int, seed: int, repeat: int, work_dir: str = BENCH_DIR) -> dict:
+    """
+    update_stops with an empty stop table and with all stops already saved
+    :return: Dict case name -> measure results
+    """
+    network = MockNetwork(routes=max(1, stops // 25), vehicles=0, seed=seed)
+    server = MockServer(network, seed=seed).start()
+    tranzy_req.use_api(server.url, os.path.join(work_dir, "cache"))
+    file_name = os.path.join(work_dir, "stops.db")
+    for f in (file_name, f"{file_name}-wal", f"{file_name}-shm"):
+        if os.path.exists(f):
+            os.remove(f)
+    engine = open_db(f"sqlite+pysqlite:///{file_name}")
+    results = {}
+    try:
+        with Session(engine) as session, contextlib.redirect_stdout(io.StringIO()):
+            # first call downloads and indexes the stops
+            update_stops(session)
+
+            def empty_table():
+                session.execute(delete(Stop))
+                session.commit()
+                return ()
+
+            results[f"update_stops[stops={len(network.stops)},new]"] = measure(
+                lambda: update_stops(session), empty_table, repeat, len(network.stops))
+            update_stops(session)
+            results[f"update_stops[stops={len(network.stops)},unchanged]"] = measure(
+                lambda: update_stops(session), repeat=repeat, items=len(network.stops))
+    finally:
+        engine.dispose()
+        server.stop()
+    return results
+
+
+def run_suite(suite: str = "quick", seed: int = 1, only: str = None, work_dir: str = BENCH_DIR, log=print,
+              fixture: str = None) -> dict:
+    """
+    :param suite: Suite name (SUITES)
+    :param seed: Random seed of the synthetic data
+    :param only: Run only the cases whose name contains this text, None for all
+    :param work_dir: Folder of the fixture dbs
+    :param log: Function to log each case result
+    :param fixture: Manifest of a db made by tranzy_synth, used for the position table cases instead of the
+     suite sizes, None to generate them
+    :return: Dict with meta (environment) and results (case name -> measure results)
+    """
+    sizes = SUITES[suite]
+    manifest = None
+    if fixture:
+        with open(fixture, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    repeat = sizes["repeat"]
+    # (names of the cases, function running them)
+    groups = []
+    for vehicles in sizes["vehicles"]:
+        for stops in sizes["stops"]:
+            groups.append((f"insert_positions[vehicles={vehicles},stops={stops}]",
+                           lambda v=vehicles, s=stops: bench_insert_positions(v, s, seed, repeat, work_dir)))
+    if manifest:
+        rows = manifest["rows"]["position"]
+        groups.append((f"get_trip_stats[positions={rows}] export_csv[positions={rows}]",
+                       lambda: bench_positions(rows, seed, repeat, work_dir, f"sqlite+pysqlite:///{manifest['db']}")))
+    else:
+        for rows in sizes["positions"]:
+            groups.append((f"get_trip_stats[positions={rows}] export_csv[positions={rows}]",
+                           lambda r=rows: bench_positions(r, seed, repeat, work_dir)))
+    for stops in sizes["update_stops"]:
+        groups.append((f"update_stops[stops={stops}]", lambda s=stops: bench_update_stops(s, seed, repeat, work_dir)))
+    results = {}
+    for names, run in groups:
+        if only and only not in names:
+            continue
+        for name, result in run().items():
+            results[name] = result
+            log(f"{name}: p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, "
+                f"{result['items_per_s']} items/s, peak {result['peak_mb']} MB")
+    meta = {"suite": suite, "seed": seed, "date": datetime.now().astimezone().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0], "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+            "machine": platform.machine(), "cpus": os.cpu_count(), "fixture": manifest["db"] if manifest else None}
+    return {"meta": meta, "results": results}
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.2) -> list[tuple]:
+    """
+    Compare results with a baseline: a case regresses if its p50 latency or peak memory is more than
+    tolerance above the baseline (and by more than 1 ms / 1 MB, for very small values).
+    :param report: Results of run_suite
+    :param baseline: Results of run_suite saved before
+    :param tolerance: Relative increase accepted
+    :return: List of (case, metric, baseline value, new value, relative change, regression), for the cases in both
+    """
+    rows = []
+    for case, new in report["results"].items():
+        old = baseline["results"].get(case)
+        if not old:
+            continue
+        for metric, floor in (("p50_ms", 1), ("peak_mb", 1)):
+            change = (new[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+            rows.append((case, metric, old[metric], new[metric], change,
+                         new[metric] > old[metric] * (1 + tolerance) and new[metric] - old[metric] > floor))
+    return rows
@@ -0,0 +1,114 @@
+"""
+On-disk cache for the static GTFS datasets of Tranzy API (routes, trips, stops, stop_times).
+Each dataset is saved per agency, with the validators (ETag / Last-Modified) returned by the server,
+so that expired entries can be revalidated with a conditional request instead of a full download.
+"""
+
+import json
+import os
+import time
+
+from config import AGENCY_ID, CACHE_DIR, CACHE_TTL
+
+
+class ReferenceCache:
+    """
+    Agency-keyed JSON file cache with time to live.
+    """
+    def __init__(self, agency_id: str = AGENCY_ID, cache_dir: str = CACHE_DIR, ttl: int = CACHE_TTL):
+        self.agency_id = agency_id
+        self.cache_dir = cache_dir
+        self.ttl = ttl * 3600  # hours to seconds
+        self.entries = {}  # in-memory copy of loaded entries, avoids parsing big files at every call
+
+    def path(self, endpoint: str) -> str:
+        """
+        :param endpoint: API endpoint name
+        :return: Cache file name for the endpoint
+        """
+        return os.path.join(self.cache_dir, f"agency_{self.agency_id}_{endpoint}.json")
+
+    def load(self, endpoint: str):
+        """
+        Load cache entry for an endpoint, from memory or disk.
+        :param endpoint: API endpoint name
+        :return: Dict with keys fetched_at, etag, last_modified, data; or None if not cached
+        """
+        if endpoint in self.entries:
+            return self.entries[endpoint]
+        try:
+            with open(self.path(endpoint), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.entries[endpoint] = entry
+        return entry
+
+    def save(self, endpoint: str, data, etag: str = None, last_modified: str = None, fetched_at: float = None):
+        """
+        Save downloaded data with its validators. File is replaced atomically.
+        :param endpoint: API endpoint name
+        :param data: JSON data returned by the API
+        :param etag: ETag header of the response, if any
+        :param last_modified: Last-Modified header of the response, if any
+        :param fetched_at: Download time (Unix time), None for now
+        :return: Saved entry
+        """
+        entry = {"fetched_at": time.time() if fetched_at is None else fetched_at, "etag": etag, "last_modified": last_modified, "data": data}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = f"{self.path(endpoint)}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_file, self.path(endpoint))
+        self.entries[endpoint] = entry
+        return entry
+
+    def touch(self, endpoint: str):
+        """
+        Mark an entry as fresh again (server answered 304 Not Modified).
+        :param endpoint: API endpoint name
+        :return: None
+        """
+        entry = self.load(endpoint)
+        if entry:
+            self.save(endpoint, entry["data"], entry["etag"], entry["last_modified"])
+
+    def is_fresh(self, entry) -> bool:
+        """
+        :param entry: Entry returned by load()
+        :return: True if the entry is younger than the time to live
+        """
+        return entry is not None and time.time() - entry["fetched_at"] < self.ttl
+
+    def conditional_headers(self, entry) -> dict:
+        """
+        :param entry: Entry returned by load()
+        :return: Headers for a conditional request, empty if the server sent no validators
+        """
+        h = {}
+        if entry:
+            if entry.get("etag"):
+                h["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                h["If-Modified-Since"] = entry["last_modified"]
+        return h
+
+    def expire(self, endpoint: str = None):
+        """
+        Mark cached data as expired, forcing a revalidation at next use. The data is kept: it's replaced only when
+        the server sends new data, and still used if the API can't be reached.
+        :param endpoint: API endpoint name, or None for all endpoints of the agency
+        :return: None
+        """
+        if endpoint:
+            endpoints = [endpoint]
+        else:
+            prefix = f"agency_{self.agency_id}_"
+            endpoints = list(self.entries)
+            if os.path.isdir(self.cache_dir):
+                endpoints += [f[len(prefix):-len(".json")] for f in os.listdir(self.cache_dir)
+                              if f.startswith(prefix) and f.endswith(".json")]
+        for e in set(endpoints):
+            entry = self.load(e)
+            if entry:
+                self.save(e, entry["data"], entry["etag"], entry["last_modified"], fetched_at=0)
@@ -0,0 +1,97 @@
+"""
+Background collector: polls vehicles, evaluates and saves positions outside of the GUI thread.
+Messages for the GUI (log lines, next poll time, counters) are sent through a thread-safe queue.
+Each poll is instrumented (tranzy_metrics): stage timings and counters go to the metrics registry of the process.
+Doesn't depend on tkinter, so it can run headless.
+"""
+
+import queue
+import threading
+
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+
+from tranzy_db_tools import insert_positions
+from tranzy_geo import StopIndex
+from tranzy_metrics import PollMetrics, registry
+from tranzy_profile import profiled
+from tranzy_req import get_vehicles
+from tranzy_scheduler import PollScheduler
+
+
+class Collector(threading.Thread):
+    """
+    Worker thread polling vehicles every polling_interval seconds (fixed deadlines) until end or stopped.
+    Queue messages are tuples:
+     - ("log", message, message type) - message types as in MainWindow.write_log
+     - ("next_poll", monotonic time of next poll)
+     - ("counters", dict of counters)
+     - ("poll_metrics", compact stats line of the poll: bytes, vehicles, stage timings)
+     - ("poll_timing", dict of PollScheduler statistics)
+     - ("finished",) - thread is ending
+    """
+    def __init__(self, engine: Engine, trip_id_list: list[str], monitor_index: StopIndex,
+                 polling_interval: int, raw_log: bool, messages: queue.Queue, end: float = None):
+        super().__init__(name="collector", daemon=True)
+        self.engine = engine
+        self.trip_id_list = list(trip_id_list)
+        self.monitor_index = monitor_index
+        self.polling_interval = polling_interval
+        self.raw_log = raw_log
+        self.messages = messages
+        self.end = end  # monotonic time to stop, None to run until stop()
+        self.scheduler = None
+        self.stop_event = threading.Event()
+        self.counters = {"polls": 0, "vehicles": 0, "stored": 0, "skipped": 0, "errors": 0}
+        self.last_metrics = None  # PollMetrics of the last poll
+
+    def run(self):
+        """
+        Poll at fixed deadlines until end time or stop() is called
+        :return: None
+        """
+        self.scheduler = PollScheduler(self.polling_interval, self.end)
+        with Session(self.engine) as session:
+            while self.scheduler.wait(self.stop_event):
+                self.poll(session)
+                self.scheduler.done()
+                self.messages.put(("poll_timing", self.scheduler.stats()))
+                self.messages.put(("next_poll", self.scheduler.next_deadline))
+        self.messages.put(("finished",))
+
+    @profiled("poll")
+    def poll(self, session: Session):
+        """
+        Single poll: get vehicles from the API and save positions in db
+        :param session: Session owned by the collector thread
+        :return: None
+        """
+        self.counters["polls"] += 1
+        metrics = PollMetrics()
+        try:
+            vehicles = get_vehicles(self.trip_id_list, self.raw_log, metrics)
+            if not vehicles or len(vehicles) == 0:
+                self.messages.put(("log", "no vehicles on route", 2))
+            else:
+                # evaluate all vehicles and save accepted positions in one transaction
+                for msg, msg_type in insert_positions(session, vehicles, self.monitor_index, metrics):
+                    self.messages.put(("log", msg, msg_type))
+                    self.counters["vehicles"] += 1
+                    self.counters["stored" if msg_type == 1 else "skipped"] += 1
+        except (Exception, SystemExit) as err:
+            # keep collecting at next poll, errors are reported to the log
+            session.rollback()
+            self.counters["errors"] += 1
+            metrics.error = True
+            self.messages.put(("log", f"poll failed: {err!r}", 2))
+        registry.record_poll(metrics.finish())
+        self.last_metrics = metrics
+        self.messages.put(("counters", dict(self.counters)))
+        self.messages.put(("poll_metrics", metrics.summary()))
+
+    def stop(self):
+        """
+        Ask the thread to stop; a poll in progress is finished first
+        :return: None
+        """
+        self.stop_event.set()
@@ -2,11 +2,15 @@
 SQLAlchemy ORM classes definitions for the tranzy database tables
 """
 
-from datetime import datetime
+from datetime import datetime, date, time
 
-from sqlalchemy import ForeignKey, String, DateTime, Integer, Float, Boolean
+from sqlalchemy import ForeignKey, String, DateTime, Date, Integer, Float, Boolean, Time, Engine, Index, \
+    create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+from config import DB_URL, SQLITE_PRAGMAS
+
 
 class Base(DeclarativeBase):
     pass
@@ -18,6 +22,9 @@ class Trip(Base):
     trip_id is route_id suffixed by "_0" for main direction, and "_1" for return trip.
     """
     __tablename__ = "trip"
+    __table_args__ = (
+        Index("ix_trip_trip_id", "trip_id", unique=True),
+    )
 
     idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
     agency_id: Mapped[int] = mapped_column(Integer)
@@ -28,6 +35,8 @@ class Trip(Base):
     route_long_name: Mapped[str] = mapped_column(String)
     trip_headsign: Mapped[str] = mapped_column(String)
     monitored: Mapped[bool] = mapped_column(Boolean)
+    # segment traversals cover all the positions: built by backfill, or no positions before they were collected
+    traversals_built: Mapped[bool] = mapped_column(Boolean, default=True)
 
     positions: Mapped["Position"] = relationship(back_populates="trip")
     trip_stops: Mapped["StopOrder"] = relationship(back_populates="trip")
@@ -45,6 +54,12 @@ class Position(Base):
     Vehicle positions for the monitored trips.
     """
     __tablename__ = "position"
+    __table_args__ = (
+        # stats: positions of a trip at a stop, in time order
+        Index("ix_position_trip_stop_timestamp", "trip_idx", "stop_idx", "timestamp"),
+        # export: positions of a trip in insertion (idx) order, streamed without sorting
+        Index("ix_position_trip_idx", "trip_idx"),
+    )
 
     idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
     vehicle_no: Mapped[str] = mapped_column(String)
@@ -72,6 +87,9 @@ class Stop(Base):
     Table with all the stops of the monitored trips.
     """
     __tablename__ = "stop"
+    __table_args__ = (
+        Index("ix_stop_stop_id", "stop_id", unique=True),
+    )
 
     idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
     stop_id: Mapped[int] = mapped_column(Integer)
@@ -91,6 +109,9 @@ class StopOrder(Base):
     Table with the stops order for each monitored trip.
     """
     __tablename__ = "stop_order"
+    __table_args__ = (
+        Index("ix_stop_order_trip_stop_order", "trip_idx", "stop_order"),
+    )
 
     idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
     stop_order: Mapped[int] = mapped_column(Integer)
@@ -109,6 +130,9 @@ class MonitoredStops(Base):
     Table with the stops to monitor, by defining a start and end stop
     """
     __tablename__ = "monitored_stops"
+    __table_args__ = (
+        Index("ix_monitored_stops_trip_idx", "trip_idx"),
+    )
 
     idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
     start_stop: Mapped[int] = mapped_column(Integer)
@@ -119,3 +143,225 @@ class MonitoredStops(Base):
 
     def __repr__(self):
         return f"MonitoredStop(start={self.start_stop}, end={self.end_stop}), trip_idx={self.trip_idx}"
+
+
+class StopPassage(Base):
+    """
+    Passage of a vehicle at a monitored stop: consecutive positions at the stop (no more than PASSAGE_GAP apart),
+    represented by the position closest to the stop. Maintained by tranzy_traversals.
+    """
+    __tablename__ = "stop_passage"
+    __table_args__ = (
+        # passages of a vehicle still open / changed since a given time
+        Index("ix_stop_passage_trip_vehicle_last", "trip_idx", "vehicle_no", "last_timestamp"),
+    )
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    vehicle_no: Mapped[str] = mapped_column(String)
+    timestamp: Mapped[datetime] = mapped_column(DateTime)  # position closest to the stop
+    stop_distance: Mapped[int] = mapped_column(Integer)
+    last_timestamp: Mapped[datetime] = mapped_column(DateTime)  # last position of the passage
+    trip_idx = mapped_column(ForeignKey("trip.idx"))
+    stop_idx = mapped_column(ForeignKey("stop.idx"))
+
+    def __repr__(self):
+        return f"StopPassage(vehicle_no={self.vehicle_no}, stop_idx={self.stop_idx}, timestamp={self.timestamp})"
+
+
+class SegmentTraversal(Base):
+    """
+    Travel of a vehicle between two monitored stops (from before to in stop order), derived from stop passages.
+    Arrival and duration are null if the vehicle was not seen at to stop after departure.
+    """
+    __tablename__ = "segment_traversal"
+    __table_args__ = (
+        # stats of a stop pair in time order
+        Index("ix_segment_traversal_trip_from_to_departure", "trip_idx", "from_stop_idx", "to_stop_idx",
+              "departure"),
+        # incremental update of a vehicle
+        Index("ix_segment_traversal_trip_vehicle_departure", "trip_idx", "vehicle_no", "departure"),
+    )
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    vehicle_no: Mapped[str] = mapped_column(String)
+    departure: Mapped[datetime] = mapped_column(DateTime)
+    arrival: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    duration: Mapped[int] = mapped_column(Integer, nullable=True)  # seconds
+    trip_idx = mapped_column(ForeignKey("trip.idx"))
+    from_stop_idx = mapped_column(ForeignKey("stop.idx"))
+    to_stop_idx = mapped_column(ForeignKey("stop.idx"))
+
+    def __repr__(self):
+        return f"SegmentTraversal(vehicle_no={self.vehicle_no}, from_stop_idx={self.from_stop_idx}, " \
+               f"to_stop_idx={self.to_stop_idx}, departure={self.departure}, duration={self.duration})"
+
+
+class TravelHistogram(Base):
+    """
+    Travel, wait and total time histograms of a stop pair for a weekday and time of day bin (tranzy_recommend).
+    """
+    __tablename__ = "travel_histogram"
+    __table_args__ = (
+        Index("ix_travel_histogram_trip_from_to_weekday", "trip_idx", "from_stop_idx", "to_stop_idx", "weekday"),
+    )
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    weekday: Mapped[int] = mapped_column(Integer)  # ISO weekday
+    bin: Mapped[int] = mapped_column(Integer)  # time of day bin (local time)
+    travel: Mapped[str] = mapped_column(String)  # JSON list of counts per bucket
+    wait: Mapped[str] = mapped_column(String)
+    total: Mapped[str] = mapped_column(String)
+    trip_idx = mapped_column(ForeignKey("trip.idx"))
+    from_stop_idx = mapped_column(ForeignKey("stop.idx"))
+    to_stop_idx = mapped_column(ForeignKey("stop.idx"))
+
+    def __repr__(self):
+        return f"TravelHistogram(trip_idx={self.trip_idx}, from_stop_idx={self.from_stop_idx}, " \
+               f"to_stop_idx={self.to_stop_idx}, weekday={self.weekday}, bin={self.bin})"
+
+
+class HistogramWatermark(Base):
+    """
+    Days aggregated in the histograms of a stop pair: all days before aggregated_until (local date).
+    aggregated_at changes with every write of the histograms, including a rebuild after a reset.
+    """
+    __tablename__ = "histogram_watermark"
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    aggregated_until: Mapped[date] = mapped_column(Date)
+    aggregated_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    trip_idx = mapped_column(ForeignKey("trip.idx"))
+    from_stop_idx = mapped_column(ForeignKey("stop.idx"))
+    to_stop_idx = mapped_column(ForeignKey("stop.idx"))
+
+    def __repr__(self):
+        return f"HistogramWatermark(trip_idx={self.trip_idx}, from_stop_idx={self.from_stop_idx}, " \
+               f"to_stop_idx={self.to_stop_idx}, aggregated_until={self.aggregated_until})"
+
+
+class ExportWatermark(Base):
+    """
+    Positions of a trip already exported incrementally in a format: all positions with idx <= last_position_idx.
+    """
+    __tablename__ = "export_watermark"
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    kind: Mapped[str] = mapped_column(String)  # csv, csv.gz, parquet
+    last_position_idx: Mapped[int] = mapped_column(Integer)
+    exported_at: Mapped[datetime] = mapped_column(DateTime)
+    trip_idx = mapped_column(ForeignKey("trip.idx"))
+
+    def __repr__(self):
+        return f"ExportWatermark(trip_idx={self.trip_idx}, kind={self.kind}, " \
+               f"last_position_idx={self.last_position_idx}, exported_at={self.exported_at})"
+
+
+class SchemaVersion(Base):
+    """
+    Applied schema migrations (tranzy_migrate).
+    """
+    __tablename__ = "schema_version"
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    version: Mapped[int] = mapped_column(Integer)
+    description: Mapped[str] = mapped_column(String)
+    applied_at: Mapped[datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return f"SchemaVersion(version={self.version}, applied_at={self.applied_at})"
+
+
+class Schedule(Base):
+    """
+    Recurring collection window: on the selected weekdays, between start and end time (local time),
+    for a set of trips. End time before start time means the window ends the next day.
+    """
+    __tablename__ = "schedule"
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    name: Mapped[str] = mapped_column(String)
+    weekdays: Mapped[str] = mapped_column(String)  # ISO weekday digits, e.g. "12345" for Monday to Friday
+    start_time: Mapped[time] = mapped_column(Time)
+    end_time: Mapped[time] = mapped_column(Time)
+    polling_interval: Mapped[int] = mapped_column(Integer)
+    enabled: Mapped[bool] = mapped_column(Boolean)
+    last_run: Mapped[datetime] = mapped_column(DateTime, nullable=True)  # last time the window was (re)started
+
+    schedule_trips: Mapped[list["ScheduleTrip"]] = relationship(back_populates="schedule")
+
+    def __repr__(self):
+        return f"Schedule(idx={self.idx}, name={self.name}, weekdays={self.weekdays}, " \
+               f"start_time={self.start_time}, end_time={self.end_time})"
+
+
+class ScheduleTrip(Base):
+    """
+    Trips monitored by a schedule.
+    """
+    __tablename__ = "schedule_trip"
+
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)  # db auto id
+    schedule_idx = mapped_column(ForeignKey("schedule.idx"))
+    trip_idx = mapped_column(ForeignKey("trip.idx"))
+
+    schedule: Mapped[Schedule] = relationship(back_populates="schedule_trips")
+    trip: Mapped[Trip] = relationship()
+
+    def __repr__(self):
+        return f"ScheduleTrip(schedule_idx={self.schedule_idx}, trip_idx={self.trip_idx})"
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Apply SQLITE_PRAGMAS to a new connection. Listener for engine "connect" event.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def create_indexes(engine: Engine):
+    """
+    Create indexes missing in an existing db (create_all only adds them with new tables).
+    Used by schema migrations.
+    :param engine: Engine
+    :return: None
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except IntegrityError as err:
+                # unique index on a table with duplicates, create it non unique to keep queries fast
+                print(f"Index {index.name} created without unique constraint: {err.orig}")
+                columns = ", ".join(c.name for c in index.columns)
+                with engine.begin() as conn:
+                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index.name} ON {table.name} ({columns})"))
+
+
+def connect_db(db_url: str = DB_URL) -> Engine:
+    """
+    Connect to an existing db with the performance profile (e.g. from worker processes)
+    :param db_url: SQLAlchemy database URL
+    :return: Engine
+    """
+    engine = create_engine(db_url, echo=False)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+def open_db(db_url: str = DB_URL) -> Engine:
+    """
+    Connect to db with the performance profile, create missing tables and apply schema migrations
+    :param db_url: SQLAlchemy database URL
+    :return: Engine
+    """
+    from tranzy_migrate import migrate
+
+    engine = connect_db(db_url)
+    new_db = not inspect(engine).has_table(Trip.__tablename__)
+    Base.metadata.create_all(engine)
+    migrate(engine, new_db)
+    return engine
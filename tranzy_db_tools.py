@@ -2,18 +2,18 @@
 Functions for interaction with the database
 """
 
-from sqlalchemy import select, and_, delete, update, func, extract
+from sqlalchemy import select, and_, or_, delete, update, func, insert, case, cast
 from sqlalchemy.orm import Session
 
 from datetime import timedelta, timezone
 
-from geopy import distance
-
-import csv
-
-from config import MAX_DIST_TO_STOP, TIME_TOLERANCE, CSV_ENC
+from config import TIME_TOLERANCE, PASSAGE_GAP, MAX_TRAVEL_TIME
 from tranzy_db import *
 from tranzy_req import *
+from tranzy_gtfs import repository
+from tranzy_geo import StopIndex
+from tranzy_metrics import PollMetrics
+from tranzy_traversals import update_traversals
 
 
 def update_stops(session: Session):
@@ -22,15 +22,11 @@ def update_stops(session: Session):
     :param session: db session
     :return: None
     """
-    stops = get_stops()
-    stop_id_list = []
-    for s in stops:
-        stop_id_list.append(s["stop_id"])
+    stops = repository.stops()
 
     # retrieve all stops already saved in db
-    stmt = select(Stop.stop_id).where(Stop.stop_id.in_(stop_id_list))
-    result = session.execute(stmt)
-    existing_stop_id_list = result.scalars().all()
+    stmt = select(Stop.stop_id)
+    existing_stop_id_list = set(session.execute(stmt).scalars())
 
     # create objects if stop_id doesn't already exist
     stop_object_list = []
@@ -66,6 +62,35 @@ def get_route_stops(session: Session, stop_id_list):
     return result.scalars().all()
 
 
+def get_stops_index(session: Session, stop_id_list) -> dict[int, Stop]:
+    """
+    Retrieve stops from the db based on their Tranzy ID, indexed by Tranzy ID.
+    :param session: Session
+    :param stop_id_list: List of Tranzy stop IDs
+    :return: Dict stop_id -> Stop object
+    """
+    return {s.stop_id: s for s in get_route_stops(session, stop_id_list)}
+
+
+def get_trip_stops(session: Session, trip_id: str) -> list[tuple[int, Stop]]:
+    """
+    Retrieve the ordered stops of a trip: order from the GTFS repository, Stop objects from the db.
+    :param session: Session
+    :param trip_id: Tranzy trip ID
+    :return: List of (stop_sequence, Stop object); stops not found in db are skipped
+    """
+    stops_order = repository.stop_times(trip_id)
+    stops_index = get_stops_index(session, [s_o["stop_id"] for s_o in stops_order])
+    trip_stops = []
+    for s_o in stops_order:
+        stop = stops_index.get(s_o["stop_id"])
+        if stop:
+            trip_stops.append((s_o["stop_sequence"], stop))
+        else:
+            print(f"Stop {s_o['stop_id']} not found in db!")
+    return trip_stops
+
+
 def get_monitored_trips(session: Session):
     """
     Retrieve trips configured for monitoring
@@ -106,6 +131,75 @@ def get_monitor_config(session: Session, trip_id) -> (Trip, list[Stop]):
     return row.Trip, stops_object_list, start_stop, end_stop
 
 
+def get_monitor_index(session: Session, trip_id_list: list[str]) -> StopIndex:
+    """
+    Build the spatial index of the monitored stops of all monitored trips
+    :param session: The open Session to the db
+    :param trip_id_list: IDs of the monitored trips
+    :return: StopIndex object
+    """
+    trip_stops = {}
+    for trip_id in trip_id_list:
+        trip, stops_object_list, start_stop, end_stop = get_monitor_config(session, trip_id)
+        trip_stops[trip_id] = (trip.idx, stops_object_list)
+    return StopIndex(trip_stops)
+
+
+def evaluate_positions(vehicles: list[dict], monitor_index: StopIndex, dt_now: datetime = None,
+                       metrics: PollMetrics = None) -> (list[dict], list[tuple[str, int]]):
+    """
+    Check which vehicle positions must be logged: valid datetime and close to the monitored stops.
+    Closest stops of all vehicles are found with one spatial index query.
+    :param vehicles: JSON from Tranzy API, as returned by get_vehicles
+    :param monitor_index: StopIndex returned by get_monitor_index
+    :param dt_now: Reference time for datetime tolerance, default current time
+    :param metrics: PollMetrics of the poll (stages validate, distance and skip reasons), or None
+    :return: List of Position rows as dicts, list of (message to log, message type) for each vehicle
+    """
+    metrics = metrics or PollMetrics()
+    if dt_now is None:
+        dt_now = datetime.now(timezone.utc)
+    messages = [None] * len(vehicles)
+    # vehicles with valid datetime: list of (vehicle index, datetime)
+    valid = []
+    with metrics.stage("validate"):
+        for i, v in enumerate(vehicles):
+            dt = datetime.fromisoformat(v['timestamp'])
+            if dt_now - timedelta(seconds=TIME_TOLERANCE) < dt < dt_now + timedelta(seconds=TIME_TOLERANCE):
+                valid.append((i, dt))
+            else:
+                messages[i] = (f"{v['trip_id']}-{v['label']} skipped - bad datetime: "
+                               f"{dt.astimezone().strftime('%Y-%m-%d %H:%M:%S')}", 2)
+    metrics.count("bad_datetime", len(vehicles) - len(valid))
+
+    rows = []
+    # get the closest monitored stop within tolerable distance
+    with metrics.stage("distance"):
+        closest_list, distance_list = monitor_index.nearest([vehicles[i]['trip_id'] for i, dt in valid],
+                                                            [vehicles[i]['latitude'] for i, dt in valid],
+                                                            [vehicles[i]['longitude'] for i, dt in valid])
+    for (i, dt), closest, min_distance in zip(valid, closest_list, distance_list):
+        v = vehicles[i]
+        if closest >= 0:
+            min_distance = int(round(min_distance, 0))
+            rows.append({
+                "vehicle_no": v['label'],
+                "latitude": v['latitude'],
+                "longitude": v['longitude'],
+                "timestamp": dt,
+                "speed": v['speed'],
+                "stop_distance": min_distance,
+                "trip_idx": monitor_index.trip_idx[v['trip_id']],
+                "stop_idx": monitor_index.stop_idx[closest]
+            })
+            messages[i] = (f"{v['trip_id']}-{v['label']}, {dt.astimezone().strftime('%H:%M:%S')}, "
+                           f"{monitor_index.stop_name[closest]} at {min_distance} meters", 1)
+        else:
+            messages[i] = (f"{v['trip_id']}-{v['label']} outside monitored segment", 2)
+    metrics.count("outside_segment", len(valid) - len(rows))
+    return rows, messages
+
+
 def insert_position(session: Session, trip, vehicle, stops_object_list: list[Stop]) -> (str, int):
     """
     Insert new position into db if it's close to the monitored stops
@@ -115,67 +209,31 @@ def insert_position(session: Session, trip, vehicle, stops_object_list: list[Sto
     :param stops_object_list: Stop objects that must be closed to vehicle position
     :return: Message to log, message type
     """
-    dt = datetime.fromisoformat(vehicle['timestamp'])
-    dt_now = datetime.now(timezone.utc)
-    if dt_now - timedelta(seconds=TIME_TOLERANCE) < dt < dt_now + timedelta(seconds=TIME_TOLERANCE):
-        # calculate distance to each monitored stop and get the closest stop
-        distance_list = [distance.distance((vehicle['latitude'], vehicle['longitude']),
-                                           (s.stop_lat, s.stop_lon)).m for s in stops_object_list]
-        min_distance = min(distance_list)
-        closest_stop = stops_object_list[distance_list.index(min_distance)]
-        min_distance = int(round(min_distance, 0))
-
-        # check if closest stop is within a tolerable distance
-        if min_distance <= MAX_DIST_TO_STOP:
-            new_position = Position(
-                vehicle_no=vehicle['label'],
-                latitude=vehicle['latitude'],
-                longitude=vehicle['longitude'],
-                timestamp=dt,
-                speed=vehicle['speed'],
-                stop_distance=min_distance,
-                trip_idx=trip.idx,
-                stop_idx=closest_stop.idx
-            )
-            session.add(new_position)
-            session.commit()
-            return f"{vehicle['trip_id']}-{vehicle['label']}, {dt.astimezone().strftime('%H:%M:%S')}, " \
-                   f"{closest_stop.stop_name} at {min_distance} meters", 1
-        else:
-            return f"{vehicle['trip_id']}-{vehicle['label']} outside monitored segment", 2
-    else:
-        return f"{vehicle['trip_id']}-{vehicle['label']} skipped - bad datetime: " \
-               f"{dt.astimezone().strftime('%Y-%m-%d %H:%M:%S')}", 2
+    return insert_positions(session, [vehicle], StopIndex({trip.trip_id: (trip.idx, stops_object_list)}))[0]
 
 
-def export_csv(session: Session, trip_id):
+def insert_positions(session: Session, vehicles: list[dict], monitor_index: StopIndex,
+                     metrics: PollMetrics = None) -> list[tuple[str, int]]:
     """
-    Export trip statistics to csv
-    :param session: Session
-    :param trip_id: Trip id
-    :return: File name
-    """
-    # select statement
-    stmt = select(Trip.idx, Trip.agency_id, Trip.trip_id,
-                  Trip.route_short_name, Trip.route_long_name, Trip.trip_headsign,
-                  Position.vehicle_no, Position.latitude, Position.longitude,
-                  Position.timestamp, Position.speed, Position.stop_distance,
-                  Stop.stop_name)\
-        .join_from(Trip, Position)\
-        .join_from(Position, Stop)\
-        .where(Trip.trip_id == trip_id)
-    # get data as list of Result objects (named tuple)
-    results = session.execute(stmt).all()
-    if results:
-        file_name = f"exports/tranzy_{results[0].route_short_name}_{trip_id}" \
-                    f"_{datetime.now().astimezone().strftime('%Y%m%d_%H%M%S')}.csv"
-        with open(file_name, "w", newline='', encoding=CSV_ENC) as f:
-            writer = csv.writer(f, delimiter=",", dialect="excel")
-            writer.writerow(results[0]._fields)
-            writer.writerows(results)
-        return file_name
-    else:
-        return None
+    Evaluate all vehicles of a poll and insert the accepted positions with a single bulk insert / commit.
+    Stop passages and segment traversals of the vehicles are updated in the same transaction.
+    :param session: The open Session to the db
+    :param vehicles: JSON from Tranzy API, as returned by get_vehicles
+    :param monitor_index: StopIndex returned by get_monitor_index
+    :param metrics: PollMetrics of the poll (evaluation and db write stages, positions stored), or None
+    :return: List of (message to log, message type), one per vehicle
+    """
+    metrics = metrics or PollMetrics()
+    rows, messages = evaluate_positions(vehicles, monitor_index, metrics=metrics)
+    if rows:
+        with metrics.stage("insert"):
+            session.execute(insert(Position), rows)
+        with metrics.stage("traversals"):
+            update_traversals(session, rows)
+        with metrics.stage("commit"):
+            session.commit()
+        metrics.count("stored", len(rows))
+    return messages
 
 
 def delete_trip_data(session: Session, trip_id):
@@ -191,11 +249,23 @@ def delete_trip_data(session: Session, trip_id):
         trip_idx = int(trip_idx)
         # delete statements
         del_monitored_stops_stmt = delete(MonitoredStops).where(MonitoredStops.trip_idx == trip_idx)
+        del_schedule_trip_stmt = delete(ScheduleTrip).where(ScheduleTrip.trip_idx == trip_idx)
         del_stop_order_stmt = delete(StopOrder).where(StopOrder.trip_idx == trip_idx)
         del_position_stmt = delete(Position).where(Position.trip_idx == trip_idx)
+        del_export_watermark_stmt = delete(ExportWatermark).where(ExportWatermark.trip_idx == trip_idx)
+        del_watermark_stmt = delete(HistogramWatermark).where(HistogramWatermark.trip_idx == trip_idx)
+        del_histogram_stmt = delete(TravelHistogram).where(TravelHistogram.trip_idx == trip_idx)
+        del_traversal_stmt = delete(SegmentTraversal).where(SegmentTraversal.trip_idx == trip_idx)
+        del_passage_stmt = delete(StopPassage).where(StopPassage.trip_idx == trip_idx)
         del_trip_stmt = delete(Trip).where(Trip.idx == trip_idx)
         session.execute(del_monitored_stops_stmt)
+        session.execute(del_schedule_trip_stmt)
         session.execute(del_stop_order_stmt)
+        session.execute(del_export_watermark_stmt)
+        session.execute(del_watermark_stmt)
+        session.execute(del_histogram_stmt)
+        session.execute(del_traversal_stmt)
+        session.execute(del_passage_stmt)
         session.execute(del_position_stmt)
         session.execute(del_trip_stmt)
         session.commit()
@@ -218,33 +288,115 @@ def update_monitored_stops(session: Session, trip: Trip, s_stop: int, e_stop: in
     session.commit()
 
 
+def add_schedule(session: Session, name: str, weekdays: str, start_time, end_time,
+                 trip_id_list: list[str], polling_interval: int) -> Schedule:
+    """
+    Save a recurring collection schedule
+    :param session: Session
+    :param name: Schedule name
+    :param weekdays: ISO weekday digits, e.g. "12345" for Monday to Friday
+    :param start_time: Window start (datetime.time, local time)
+    :param end_time: Window end (datetime.time, local time), before start_time if it ends next day
+    :param trip_id_list: Trip IDs to monitor, must be configured in db
+    :param polling_interval: Polling interval in seconds
+    :return: Schedule object
+    """
+    schedule = Schedule(name=name, weekdays=weekdays, start_time=start_time, end_time=end_time,
+                        polling_interval=polling_interval, enabled=True)
+    trips = session.execute(select(Trip).where(Trip.trip_id.in_(trip_id_list))).scalars().all()
+    schedule.schedule_trips = [ScheduleTrip(trip=t) for t in trips]
+    session.add(schedule)
+    session.commit()
+    return schedule
+
+
+def get_schedules(session: Session, enabled_only: bool = False) -> list[Schedule]:
+    """
+    Retrieve recurring collection schedules, with their trips
+    :param session: Session
+    :param enabled_only: Only enabled schedules
+    :return: List of Schedule objects
+    """
+    stmt = select(Schedule).order_by(Schedule.idx)
+    if enabled_only:
+        stmt = stmt.where(Schedule.enabled)
+    return session.execute(stmt).scalars().all()
+
+
+def delete_schedule(session: Session, schedule_idx: int):
+    """
+    Delete a recurring collection schedule
+    :param session: Session
+    :param schedule_idx: Schedule db idx
+    :return: True if deleted, False if there is no such schedule
+    """
+    session.execute(delete(ScheduleTrip).where(ScheduleTrip.schedule_idx == schedule_idx))
+    deleted = session.execute(delete(Schedule).where(Schedule.idx == schedule_idx)).rowcount
+    session.commit()
+    return deleted > 0
+
+
+def seconds_between(later, earlier):
+    """
+    SQL expression of the seconds between two timestamps (SQLite julianday)
+    :param later: Timestamp column / expression
+    :param earlier: Timestamp column / expression
+    :return: Float SQL expression, rounded to ms (julianday float error would break exact PASSAGE_GAP comparisons)
+    """
+    return func.round((func.julianday(later) - func.julianday(earlier)) * 86400, 3)
+
+
 def get_trip_stats(session: Session, trip_idx, start_stop_idx, end_stop_idx):
     """
-    Retrieve two list of Positions closest to the stops.
+    Travel times between two stops, computed in a single statement with window functions:
+     - positions of a vehicle at a stop are split in passages (no position for PASSAGE_GAP minutes in between)
+     - the position closest to the stop is kept for each passage (ROW_NUMBER)
+     - each start stop passage is paired with the next passage of the same vehicle (LEAD), if it is at the end stop
+       within MAX_TRAVEL_TIME minutes
+    Positions are read through index ix_position_trip_stop_timestamp.
     :param session: Session
     :param trip_idx: DB trip idx
     :param start_stop_idx: DB stop idx of the stop from where to display stats
     :param end_stop_idx: DB stop idx of the stop to where to display stats
-    :return: List of positions for each given stop
-    """
-    stmt = select(Position, func.min(Position.stop_distance))\
-        .where(and_(Position.trip_idx == trip_idx, Position.stop_idx == start_stop_idx))\
-        .group_by(extract('year', Position.timestamp),
-                  extract('month', Position.timestamp),
-                  extract('day', Position.timestamp),
-                  extract('hour', Position.timestamp),
-                  Position.vehicle_no,
-                  Position.stop_idx)\
-        .order_by(Position.timestamp)
-    positions_start = session.execute(stmt).scalars()
-    stmt = select(Position, func.min(Position.stop_distance))\
-        .where(and_(Position.trip_idx == trip_idx, Position.stop_idx == end_stop_idx))\
-        .group_by(extract('year', Position.timestamp),
-                  extract('month', Position.timestamp),
-                  extract('day', Position.timestamp),
-                  extract('hour', Position.timestamp),
-                  Position.vehicle_no,
-                  Position.stop_idx)\
-        .order_by(Position.timestamp)
-    positions_end = session.execute(stmt).scalars()
-    return positions_start.all(), positions_end.all()
+    :return: List of rows (vehicle_no, departure, arrival, travel_time) ordered by departure;
+     timestamps are UTC, arrival and travel_time (seconds) are None if no end stop passage was found
+    """
+    # positions at the two stops with the previous position of the vehicle at the same stop
+    points = select(Position.vehicle_no, Position.stop_idx, Position.timestamp, Position.stop_distance,
+                    func.lag(Position.timestamp, type_=DateTime)
+                    .over(partition_by=(Position.stop_idx, Position.vehicle_no), order_by=Position.timestamp)
+                    .label("prev_timestamp"))\
+        .where(and_(Position.trip_idx == trip_idx, Position.stop_idx.in_((start_stop_idx, end_stop_idx))))\
+        .subquery("points")
+    # number the passages: running count of positions starting a passage
+    new_passage = case((or_(points.c.prev_timestamp.is_(None),
+                            seconds_between(points.c.timestamp, points.c.prev_timestamp) > PASSAGE_GAP * 60), 1),
+                       else_=0)
+    passages = select(points.c.vehicle_no, points.c.stop_idx, points.c.timestamp, points.c.stop_distance,
+                      func.sum(new_passage)
+                      .over(partition_by=(points.c.stop_idx, points.c.vehicle_no), order_by=points.c.timestamp)
+                      .label("passage"))\
+        .subquery("passages")
+    # rank positions in each passage by distance to the stop
+    closest = select(passages.c.vehicle_no, passages.c.stop_idx, passages.c.timestamp,
+                     func.row_number()
+                     .over(partition_by=(passages.c.stop_idx, passages.c.vehicle_no, passages.c.passage),
+                           order_by=(passages.c.stop_distance, passages.c.timestamp))
+                     .label("rank"))\
+        .subquery("closest")
+    # next passage of the same vehicle, at any of the two stops
+    next_passage = {"partition_by": closest.c.vehicle_no, "order_by": closest.c.timestamp}
+    paired = select(closest.c.vehicle_no, closest.c.stop_idx, closest.c.timestamp,
+                    func.lead(closest.c.stop_idx, type_=Integer).over(**next_passage).label("next_stop_idx"),
+                    func.lead(closest.c.timestamp, type_=DateTime).over(**next_passage).label("next_timestamp"))\
+        .where(closest.c.rank == 1)\
+        .subquery("paired")
+    travel_time = seconds_between(paired.c.next_timestamp, paired.c.timestamp)
+    matched = and_(paired.c.next_stop_idx == end_stop_idx, travel_time > 0, travel_time <= MAX_TRAVEL_TIME * 60)
+    stmt = select(paired.c.vehicle_no,
+                  paired.c.timestamp.label("departure"),
+                  case((matched, paired.c.next_timestamp)).label("arrival"),
+                  case((matched, cast(func.round(travel_time), Integer))).label("travel_time"))\
+        .where(paired.c.stop_idx == start_stop_idx)\
+        .order_by(paired.c.timestamp)
+    return session.execute(stmt).all()
@@ -0,0 +1,380 @@
+"""
+Export of collected positions.
+Rows are streamed from the db in chunks of EXPORT_BATCH (yield_per), so memory use doesn't depend on the size
+of the trip history.
+ - csv: one trip per file, optionally gzip compressed
+ - parquet (needs pyarrow): typed columns, one row group per day, several trips exported in parallel
+Incremental export writes only the positions saved since the previous one, tracked per trip and format in
+export_watermark: csv rows are appended to one file per trip, parquet rows go to a new part file in a folder
+per trip. Each increment is written to a temporary file, which is appended or renamed only when complete, together
+with the watermark commit, so an interrupted export is repeated, neither lost nor duplicated.
+"""
+
+import csv
+import gzip
+import os
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, date
+
+from sqlalchemy import select, func, and_, cast, Integer, Engine
+from sqlalchemy.orm import Session
+
+from config import CSV_ENC, EXPORT_DIR, EXPORT_BATCH, EXPORT_WORKERS
+from tranzy_db import Trip, Position, Stop, ExportWatermark, connect_db
+from tranzy_time import local_day_bounds
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+def export_filter(trip_id: str, first_day: date = None, last_day: date = None, idx_range: tuple[int, int] = None):
+    """
+    :param trip_id: Trip id
+    :param first_day: First local date to export, None for no limit
+    :param last_day: Last local date to export (included), None for no limit
+    :param idx_range: Positions to export as (after idx, up to idx included), None for no limit
+    :return: Where clause for the positions to export
+    """
+    conditions = [Trip.trip_id == trip_id]
+    if idx_range:
+        conditions.extend([Position.idx > idx_range[0], Position.idx <= idx_range[1]])
+    if first_day:
+        conditions.append(Position.timestamp >= local_day_bounds(first_day)[0])
+    if last_day:
+        conditions.append(Position.timestamp < local_day_bounds(last_day)[1])
+    return and_(*conditions)
+
+
+def export_statement(trip_id: str, first_day: date = None, last_day: date = None, idx_range: tuple[int, int] = None):
+    """
+    :param trip_id: Trip id
+    :param first_day: First local date to export, None for no limit
+    :param last_day: Last local date to export (included), None for no limit
+    :param idx_range: Positions to export as (after idx, up to idx included), None for no limit
+    :return: Select statement of the exported columns, in position order
+    """
+    return select(Trip.idx, Trip.agency_id, Trip.trip_id,
+                  Trip.route_short_name, Trip.route_long_name, Trip.trip_headsign,
+                  Position.vehicle_no, Position.latitude, Position.longitude,
+                  Position.timestamp, Position.speed, Position.stop_distance,
+                  Stop.stop_name)\
+        .join_from(Trip, Position)\
+        .join_from(Position, Stop)\
+        .where(export_filter(trip_id, first_day, last_day, idx_range))\
+        .order_by(Position.idx)
+
+
+def count_rows(session: Session, trip_id: str, first_day: date = None, last_day: date = None,
+               idx_range: tuple[int, int] = None) -> int:
+    """
+    :return: Number of positions to export, for progress reporting
+    """
+    stmt = select(func.count(Position.idx)).join_from(Trip, Position)\
+        .where(export_filter(trip_id, first_day, last_day, idx_range))
+    return session.execute(stmt).scalar()
+
+
+def write_csv(session: Session, file_name: str, trip_id, first_day: date = None, last_day: date = None,
+              compress: bool = False, progress=None, batch_size: int = EXPORT_BATCH,
+              idx_range: tuple[int, int] = None, header: bool = True, encoding: str = CSV_ENC) -> int:
+    """
+    Write trip positions to a new csv file, see export_csv for the parameters
+    :param file_name: File name, not created if there is no data to export
+    :param header: Write the column names on the first line
+    :param encoding: File encoding
+    :return: Number of rows written
+    """
+    total = count_rows(session, trip_id, first_day, last_day, idx_range)
+    if not total:
+        return 0
+    result = session.execute(export_statement(trip_id, first_day, last_day, idx_range)
+                             .execution_options(yield_per=batch_size))
+    written = 0
+    with (gzip.open(file_name, "wt", newline='', encoding=encoding) if compress
+          else open(file_name, "w", newline='', encoding=encoding)) as f:
+        writer = csv.writer(f, delimiter=",", dialect="excel")
+        if header:
+            writer.writerow(result.keys())
+        for chunk in result.partitions():
+            writer.writerows(chunk)
+            written += len(chunk)
+            if progress:
+                progress(written, total)
+    return written
+
+
+def export_csv(session: Session, trip_id, first_day: date = None, last_day: date = None, compress: bool = False,
+               progress=None, batch_size: int = EXPORT_BATCH, idx_range: tuple[int, int] = None,
+               file_name: str = None):
+    """
+    Export trip statistics to csv
+    :param session: Session
+    :param trip_id: Trip id
+    :param first_day: First local date to export, None for no limit
+    :param last_day: Last local date to export (included), None for no limit
+    :param compress: Write a gzip compressed file (.csv.gz)
+    :param progress: Function called after each chunk with (rows written, total rows), or None
+    :param batch_size: Rows fetched from the db at a time
+    :param idx_range: Positions to export as (after idx, up to idx included), None for no limit
+    :param file_name: File to write, None for a new timestamped file
+    :return: File name, None if there is no data to export
+    """
+    file_name = file_name or export_file_name(session, trip_id, "csv.gz" if compress else "csv")
+    if not write_csv(session, file_name, trip_id, first_day, last_day, compress, progress, batch_size, idx_range):
+        return None
+    return file_name
+
+
+def export_file_name(session: Session, trip_id: str, extension: str) -> str:
+    """
+    :param session: Session
+    :param trip_id: Trip id
+    :param extension: File extension
+    :return: Export file name with route number, trip id and timestamp; the export folder is created if missing
+    """
+    route_short_name = session.execute(select(Trip.route_short_name).where(Trip.trip_id == trip_id)).scalar()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    return f"{EXPORT_DIR}/tranzy_{route_short_name}_{trip_id}" \
+           f"_{datetime.now().astimezone().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+
+def parquet_schema():
+    """
+    :return: Arrow schema of the parquet export: UTC timestamps, dictionary encoded strings
+    """
+    text = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([("idx", pa.int32()), ("agency_id", pa.int32()), ("trip_id", text),
+                      ("route_short_name", text), ("route_long_name", text), ("trip_headsign", text),
+                      ("vehicle_no", text), ("latitude", pa.float64()), ("longitude", pa.float64()),
+                      ("timestamp", pa.timestamp("us", tz="UTC")), ("speed", pa.int32()),
+                      ("stop_distance", pa.int32()), ("stop_name", text)])
+
+
+def parquet_statement(trip_id: str, first_day: date = None, last_day: date = None,
+                      idx_range: tuple[int, int] = None):
+    """
+    Columns of export_statement with the timestamp as microseconds since epoch (no datetime objects created)
+    and the local day of the position, in position order.
+    """
+    # stored as "YYYY-MM-DD HH:MM:SS.ffffff" (UTC)
+    epoch_us = cast(func.strftime("%s", Position.timestamp), Integer) * 1000000 \
+        + cast(func.substr(Position.timestamp, 21, 6), Integer)
+    return select(Trip.idx, Trip.agency_id, Trip.trip_id,
+                  Trip.route_short_name, Trip.route_long_name, Trip.trip_headsign,
+                  Position.vehicle_no, Position.latitude, Position.longitude,
+                  epoch_us.label("timestamp"), Position.speed, Position.stop_distance,
+                  Stop.stop_name, func.date(Position.timestamp, "localtime").label("day"))\
+        .join_from(Trip, Position)\
+        .join_from(Position, Stop)\
+        .where(export_filter(trip_id, first_day, last_day, idx_range))\
+        .order_by(Position.idx)
+
+
+def export_parquet(session: Session, trip_id, first_day: date = None, last_day: date = None,
+                   batch_size: int = EXPORT_BATCH, idx_range: tuple[int, int] = None, file_name: str = None):
+    """
+    Export trip positions to a parquet file, one row group per day (local time).
+    Rows are in position order, so positions saved out of time order (e.g. replayed) start new row groups.
+    :param session: Session
+    :param trip_id: Trip id
+    :param first_day: First local date to export, None for no limit
+    :param last_day: Last local date to export (included), None for no limit
+    :param batch_size: Rows fetched from the db at a time
+    :param idx_range: Positions to export as (after idx, up to idx included), None for no limit
+    :param file_name: File to write, None for a new timestamped file
+    :return: File name and number of rows, file name is None if there is no data to export
+    """
+    if pa is None:
+        raise RuntimeError("parquet export needs pyarrow (pip install pyarrow)")
+    schema = parquet_schema()
+    file_name = file_name or export_file_name(session, trip_id, "parquet")
+    result = session.execute(parquet_statement(trip_id, first_day, last_day, idx_range)
+                             .execution_options(yield_per=batch_size))
+    writer = None
+    day, day_batches, rows = None, [], 0
+
+    def write_day():
+        if day_batches:
+            table = pa.Table.from_batches(day_batches, schema)
+            writer.write_table(table, row_group_size=table.num_rows)
+            day_batches.clear()
+
+    try:
+        for chunk in result.partitions():
+            if writer is None:
+                writer = pq.ParquetWriter(file_name, schema)
+            columns = list(zip(*chunk))
+            days = columns[-1]
+            batch = pa.record_batch([pa.array(values, type=field.type.value_type).dictionary_encode()
+                                     if pa.types.is_dictionary(field.type) else pa.array(values, type=field.type)
+                                     for values, field in zip(columns, schema)], schema=schema)
+            # split the chunk at day changes
+            start = 0
+            for i in range(1, len(chunk) + 1):
+                if i == len(chunk) or days[i] != days[start]:
+                    if days[start] != day:
+                        write_day()
+                        day = days[start]
+                    day_batches.append(batch.slice(start, i - start))
+                    start = i
+            rows += len(chunk)
+        if writer:
+            write_day()
+    finally:
+        if writer:
+            writer.close()
+    return (file_name if writer else None), rows
+
+
+def get_export_watermark(session: Session, trip_idx: int, kind: str):
+    """
+    :return: ExportWatermark of the trip and format, or None if never exported incrementally
+    """
+    stmt = select(ExportWatermark).where(and_(ExportWatermark.trip_idx == trip_idx, ExportWatermark.kind == kind))
+    return session.execute(stmt).scalars().first()
+
+
+def export_incremental(session: Session, trip_id: str, kind: str, progress=None,
+                       batch_size: int = EXPORT_BATCH) -> tuple[str, int]:
+    """
+    Export the positions of a trip saved since the previous incremental export in the same format.
+     - csv, csv.gz: rows appended to {EXPORT_DIR}/tranzy_{route}_{trip_id}.{kind}
+     - parquet: new file {EXPORT_DIR}/tranzy_{route}_{trip_id}/part_{first idx}_{last idx}.parquet
+    :param session: Session
+    :param trip_id: Trip id
+    :param kind: csv, csv.gz or parquet
+    :param progress: Function called after each chunk with (rows written, total rows), or None (csv only)
+    :param batch_size: Rows fetched from the db at a time
+    :return: File name and number of rows, file name is None if there are no new positions
+    """
+    if kind not in ("csv", "csv.gz", "parquet"):
+        raise ValueError(f"unknown export format {kind}")
+    trip_idx, route_short_name = session.execute(select(Trip.idx, Trip.route_short_name)
+                                                 .where(Trip.trip_id == trip_id)).one()
+    watermark = get_export_watermark(session, trip_idx, kind)
+    after = watermark.last_position_idx if watermark else 0
+    # positions saved during the export are left for the next one
+    upto = session.execute(select(func.max(Position.idx)).where(Position.trip_idx == trip_idx)).scalar() or 0
+    if upto <= after:
+        return None, 0
+    base_name = f"{EXPORT_DIR}/tranzy_{route_short_name}_{trip_id}"
+    if kind == "parquet":
+        os.makedirs(base_name, exist_ok=True)
+        file_name = f"{base_name}/part_{after + 1:010d}_{upto:010d}.parquet"
+        append = False
+        _, rows = export_parquet(session, trip_id, batch_size=batch_size, idx_range=(after, upto),
+                                 file_name=f"{file_name}.tmp")
+    else:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        file_name = f"{base_name}.{kind}"
+        append = os.path.exists(file_name)
+        # appended rows have no header and no BOM (utf-8-sig writes one at the start of each gzip member)
+        rows = write_csv(session, f"{file_name}.tmp", trip_id, compress=kind == "csv.gz", progress=progress,
+                         batch_size=batch_size, idx_range=(after, upto), header=not append,
+                         encoding=CSV_ENC.removesuffix("-sig") if append else CSV_ENC)
+    if watermark:
+        watermark.last_position_idx = upto
+        watermark.exported_at = datetime.now()
+    else:
+        session.add(ExportWatermark(trip_idx=trip_idx, kind=kind, last_position_idx=upto,
+                                    exported_at=datetime.now()))
+    if not rows:
+        session.commit()
+        return None, 0
+    commit_export(session, f"{file_name}.tmp", file_name, append)
+    return file_name, rows
+
+
+def commit_export(session: Session, tmp_name: str, file_name: str, append: bool):
+    """
+    Move a written increment to the export file and commit the watermark, as one step: if either fails, the export
+    file is restored and the watermark is not saved, so the increment is exported again without duplicate rows.
+    An interrupted export leaves only the temporary file (.tmp).
+    :param session: Session with the updated watermark
+    :param tmp_name: Increment file
+    :param file_name: Export file, appended to (a new gzip member for csv.gz) or replaced by the increment
+    :param append: Append to the export file, else rename the increment
+    :return: None
+    """
+    size = os.path.getsize(file_name) if append else None
+    try:
+        if append:
+            with open(tmp_name, "rb") as src, open(file_name, "ab") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(tmp_name)
+        else:
+            os.replace(tmp_name, file_name)
+        session.commit()
+    except BaseException:
+        session.rollback()
+        if append:
+            os.truncate(file_name, size)
+        elif os.path.exists(file_name):
+            os.remove(file_name)
+        raise
+
+
+def export_trip_process(db_url: str, trip_id: str, first_day: date, last_day: date,
+                        incremental: bool = False) -> tuple[str, int]:
+    """
+    Worker of export_trips_parquet, runs in a separate process with its own connection
+    :return: File name (None if no data), number of rows
+    """
+    engine = connect_db(db_url)
+    try:
+        with Session(engine) as session:
+            if incremental:
+                return export_incremental(session, trip_id, "parquet")
+            return export_parquet(session, trip_id, first_day, last_day)
+    finally:
+        engine.dispose()
+
+
+def export_trips_parquet(engine: Engine, trip_ids: list[str] = None, first_day: date = None, last_day: date = None,
+                         progress=None, workers: int = EXPORT_WORKERS, incremental: bool = False) -> dict:
+    """
+    Export several trips to parquet files in parallel. Converting rows is CPU bound, so trips are exported
+    by worker processes (started with spawn, safe with the GUI / collector threads).
+    :param engine: Engine
+    :param trip_ids: Trip ids, None for all trips in db
+    :param first_day: First local date to export, None for no limit
+    :param last_day: Last local date to export (included), None for no limit
+    :param progress: Function called in the calling thread when a trip is done, with
+     (trip id, file name or None, rows, trips done, trips total), or None
+    :param workers: Maximum number of trips exported at the same time (limited to the number of CPUs)
+    :param incremental: Export only the positions saved since the previous incremental export (see
+     export_incremental), first_day and last_day are ignored
+    :return: Dict trip id -> file name (None if no data)
+    """
+    if pa is None:
+        raise RuntimeError("parquet export needs pyarrow (pip install pyarrow)")
+    if trip_ids is None:
+        with Session(engine) as session:
+            trip_ids = session.execute(select(Trip.trip_id).order_by(Trip.idx)).scalars().all()
+    files = {}
+
+    def trip_done(trip_id, file_name, rows):
+        files[trip_id] = file_name
+        if progress:
+            progress(trip_id, file_name, rows, len(files), len(trip_ids))
+
+    workers = min(workers, len(trip_ids), os.cpu_count() or 1)
+    if workers <= 1:
+        # no gain from worker processes, export in this process
+        with Session(engine) as session:
+            for trip_id in trip_ids:
+                trip_done(trip_id, *(export_incremental(session, trip_id, "parquet") if incremental
+                                     else export_parquet(session, trip_id, first_day, last_day)))
+        return files
+    db_url = engine.url.render_as_string(hide_password=False)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(export_trip_process, db_url, trip_id, first_day, last_day, incremental): trip_id
+                   for trip_id in trip_ids}
+        for future in as_completed(futures):
+            trip_done(futures[future], *future.result())
+    return files
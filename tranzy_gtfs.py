@@ -0,0 +1,96 @@
+"""
+In-memory repository of the static GTFS datasets (routes, trips, stop_times, stops), with hash indexes.
+Datasets come from the on-disk cache of tranzy_req and are indexed once; an index is rebuilt only
+when the cached dataset changes (downloaded again after expiring).
+"""
+
+from config import ROUTES, TRIPS, STOPS, STOP_TIMES
+from tranzy_req import get_static
+
+
+class GtfsRepository:
+    """
+    Indexes:
+     - route_short_name (lower case) -> routes
+     - route_id -> trips
+     - trip_id -> stop_times ordered by stop_sequence
+     - stop_id -> stop
+    """
+    def __init__(self):
+        self.sources = {}  # endpoint -> dataset the index was built from
+        self.indexes = {}  # endpoint -> index dict
+
+    def index(self, endpoint: str, required_key: str, build):
+        """
+        Return the index of a dataset, building it if the dataset is new or changed.
+        :param endpoint: API endpoint name
+        :param required_key: Key that must be present in valid data
+        :param build: Function building the index dict from the dataset
+        :return: Index dict (empty if the API returned invalid data)
+        """
+        data = get_static(endpoint, required_key)
+        if data is not self.sources.get(endpoint):
+            if type(data) == list and len(data) != 0 and type(data[0]) == dict and required_key in data[0]:
+                self.indexes[endpoint] = build(data)
+            else:
+                print(f"Invalid data for {endpoint}: {data}")
+                self.indexes[endpoint] = {}
+            self.sources[endpoint] = data
+        return self.indexes[endpoint]
+
+    def routes(self, line_number: str):
+        """
+        :param line_number: Route short name (case insensitive)
+        :return: List of json data for the route. Normally should have only 1 element.
+        """
+        idx = self.index(ROUTES, "route_short_name", lambda data: group_by(data, lambda r: r["route_short_name"].lower()))
+        return idx.get(line_number.lower(), [])
+
+    def trips(self, route_id: int):
+        """
+        :param route_id: Route ID
+        :return: List of json data for the trips of the route. Normally should have 2 elements.
+        """
+        idx = self.index(TRIPS, "route_id", lambda data: group_by(data, lambda t: t["route_id"]))
+        return idx.get(route_id, [])
+
+    def stop_times(self, trip_id: str):
+        """
+        :param trip_id: Trip ID
+        :return: List of json data for the stops of the trip, ordered by stop_sequence
+        """
+        idx = self.index(STOP_TIMES, "stop_sequence", build_stop_times)
+        return idx.get(trip_id, [])
+
+    def stops(self):
+        """
+        :return: List of json data for all stops of the agency
+        """
+        return list(self.index(STOPS, "stop_id", lambda data: {s["stop_id"]: s for s in data}).values())
+
+
+def group_by(data: list[dict], key) -> dict:
+    """
+    :param data: List of dicts
+    :param key: Function returning the grouping key of an element
+    :return: Dict key -> list of elements
+    """
+    groups = {}
+    for d in data:
+        groups.setdefault(key(d), []).append(d)
+    return groups
+
+
+def build_stop_times(data: list[dict]) -> dict:
+    """
+    :param data: stop_times dataset
+    :return: Dict trip_id -> stop_times ordered by stop_sequence
+    """
+    groups = group_by(data, lambda s: s["trip_id"])
+    for stop_times in groups.values():
+        stop_times.sort(key=lambda s: s["stop_sequence"])
+    return groups
+
+
+# repository shared by all windows and db tools
+repository = GtfsRepository()
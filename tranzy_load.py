@@ -0,0 +1,94 @@
+"""
+Load generator: drives the collector against a Tranzy API server (normally the mock server of tranzy_mock)
+with a throwaway db, to measure the poll pipeline offline: API request, evaluation of the vehicles and insert.
+Polls run back to back (or at a fixed interval) through Collector.poll, as in live collection.
+"""
+
+import queue
+import time
+
+import numpy as np
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+
+import tranzy_req
+from config import ROUTES
+from tranzy_collector import Collector
+from tranzy_db import Trip, StopOrder, MonitoredStops
+from tranzy_db_tools import update_stops, get_trip_stops, get_monitor_index
+from tranzy_gtfs import repository
+
+
+def configure_trips(session: Session, trip_id_list: list[str], start_stop: int = 0, end_stop: int = None):
+    """
+    Configure trips for monitoring from the API static data, as the Add trip window does.
+    Trips already configured are left as they are.
+    :param session: Session
+    :param trip_id_list: Tranzy trip IDs (route_id suffixed by _0 or _1)
+    :param start_stop: First monitored stop order
+    :param end_stop: Last monitored stop order, default last stop of the trip
+    :return: None
+    """
+    update_stops(session)
+    routes = {r["route_id"]: r for r in tranzy_req.get_static(ROUTES, "route_short_name")}
+    configured = set(session.execute(select(Trip.trip_id)).scalars())
+    for trip_id in trip_id_list:
+        if trip_id in configured:
+            continue
+        route = routes[int(trip_id.split("_")[0])]
+        t = next(t for t in repository.trips(route["route_id"]) if t["trip_id"] == trip_id)
+        trip = Trip(agency_id=route["agency_id"], route_id=route["route_id"], trip_id=trip_id,
+                    shape_id=t["shape_id"], route_short_name=route["route_short_name"],
+                    route_long_name=route["route_long_name"], trip_headsign=t["trip_headsign"], monitored=True)
+        trip_stops = get_trip_stops(session, trip_id)
+        session.add(trip)
+        session.add_all([StopOrder(stop_order=stop_sequence, trip=trip, stop_idx=stop.idx)
+                         for stop_sequence, stop in trip_stops])
+        session.add(MonitoredStops(start_stop=start_stop,
+                                   end_stop=trip_stops[-1][0] if end_stop is None else end_stop, trip=trip))
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+
+
+def run_load(engine: Engine, trip_id_list: list[str], polls: int, interval: float = 0) -> dict:
+    """
+    Poll vehicles and save positions of the trips, timing every poll.
+    :param engine: Engine of a db with the trips configured
+    :param trip_id_list: Trip IDs to collect
+    :param polls: Number of polls
+    :param interval: Seconds between poll starts, 0 for back to back polls
+    :return: Dict of results: polls, seconds, polls_per_s, poll_ms (p50, p95, p99, max), stage_ms (p50 of each
+     stage of the polls, tranzy_metrics), both of the successful polls (NaN if none), collector counters (vehicles, stored, skipped, errors) and the connection
+     stats of the API client
+    """
+    with Session(engine) as session:
+        monitor_index = get_monitor_index(session, trip_id_list)
+    collector = Collector(engine, trip_id_list, monitor_index, max(int(interval), 1), False, queue.Queue())
+    durations, stages = [], {}
+    start = time.perf_counter()
+    with Session(engine) as session:
+        for i in range(polls):
+            if interval:
+                time.sleep(max(start + i * interval - time.perf_counter(), 0))
+            t = time.perf_counter()
+            collector.poll(session)
+            # failed polls (e.g. 429 / 500 answers) are counted in errors, their fast return is not a poll time
+            if not collector.last_metrics.error:
+                durations.append(time.perf_counter() - t)
+                for stage, seconds in collector.last_metrics.stages.items():
+                    stages.setdefault(stage, []).append(seconds * 1000)
+            # messages are not displayed, don't let them pile up
+            while not collector.messages.empty():
+                collector.messages.get_nowait()
+    seconds = time.perf_counter() - start
+    ms = np.array(durations or [np.nan]) * 1000
+    c = collector.counters
+    return {"polls": polls, "seconds": round(seconds, 3), "polls_per_s": round(polls / seconds, 2),
+            "poll_ms": {"p50": round(float(np.percentile(ms, 50)), 2), "p95": round(float(np.percentile(ms, 95)), 2),
+                        "p99": round(float(np.percentile(ms, 99)), 2), "max": round(float(ms.max()), 2)},
+            "stage_ms": {stage: round(float(np.percentile(v, 50)), 2) for stage, v in stages.items()},
+            "vehicles": c["vehicles"], "stored": c["stored"], "skipped": c["skipped"], "errors": c["errors"],
+            "connections": tranzy_req.client.connection_stats()}
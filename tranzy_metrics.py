@@ -0,0 +1,314 @@
+"""
+Poll instrumentation: time spent in each stage of a poll and counters of the data it handled, to find out what
+makes polling slow (API request, JSON decoding, trip filter, distance computation or db write).
+A PollMetrics records one poll as it goes through get_vehicles and insert_positions; the collector adds it to the
+registry of the process (registry), which keeps totals and latency histograms. The registry is read in-process
+(snapshot), written in Prometheus text format to a file after each poll (METRICS_FILE, e.g. for the node_exporter
+textfile collector) or served on http://host:port/metrics by MetricsServer, for headless runs.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import METRICS_FILE
+
+# stages of a poll, in execution order: (stage, short name of the stats line)
+STAGES = (("http", "http"), ("decode", "json"), ("filter", "filter"), ("validate", "time"),
+          ("distance", "dist"), ("insert", "insert"), ("traversals", "trav"), ("commit", "commit"))
+DB_STAGES = ("insert", "traversals", "commit")
+# reasons a matched vehicle is not saved
+SKIP_REASONS = ("bad_datetime", "outside_segment")
+# histogram buckets, seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# exported metrics: name -> (type, help)
+METRICS = {
+    "tranzy_polls_total": ("counter", "Polls of the vehicles endpoint"),
+    "tranzy_poll_errors_total": ("counter", "Polls failed with an error"),
+    "tranzy_received_bytes_total": ("counter", "Bytes of vehicles data received (decompressed body)"),
+    "tranzy_vehicles_total": ("counter", "Vehicles in the API responses"),
+    "tranzy_vehicles_matched_total": ("counter", "Vehicles on the monitored trips"),
+    "tranzy_vehicles_stored_total": ("counter", "Positions saved"),
+    "tranzy_vehicles_skipped_total": ("counter", "Vehicles of the monitored trips not saved, by reason"),
+    "tranzy_poll_duration_seconds": ("histogram", "Duration of a poll"),
+    "tranzy_poll_stage_seconds": ("histogram", "Duration of a stage of a poll"),
+    "tranzy_db_write_seconds": ("histogram", "Insert, traversals update and commit of the positions of a poll"),
+    "tranzy_last_poll_timestamp_seconds": ("gauge", "Unix time of the end of the last poll"),
+}
+
+
+class PollMetrics:
+    """
+    Stage durations and counters of a single poll.
+    Counters: bytes, vehicles (all in the response), matched (on the monitored trips), stored and skip reasons.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.duration = None  # seconds, set by finish()
+        self.stages = {}  # stage -> seconds
+        self.counts = dict.fromkeys(("bytes", "vehicles", "matched", "stored") + SKIP_REASONS, 0)
+        self.error = False
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a block as a stage of the poll (a stage run twice adds up)
+        :param name: Stage name (STAGES)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1):
+        """
+        :param name: Counter name
+        :param n: Value to add
+        :return: None
+        """
+        self.counts[name] += n
+
+    def finish(self):
+        """
+        End of the poll
+        :return: Self
+        """
+        self.duration = time.perf_counter() - self.start
+        return self
+
+    def db_write(self) -> float:
+        """
+        :return: Seconds spent writing to db (0 if nothing was saved)
+        """
+        return sum(self.stages.get(s, 0.0) for s in DB_STAGES)
+
+    def summary(self) -> str:
+        """
+        :return: Compact stats line, e.g. "412 KB, 1200 vehicles, 14 matched, 11 saved, 3 skipped (1 time, 2 far) |
+         ms: http 310, json 42, filter 1, time 0, dist 2, insert 3, trav 5, commit 8"
+        """
+        c = self.counts
+        skipped = c["bad_datetime"] + c["outside_segment"]
+        line = f"{c['bytes'] / 1024:.0f} KB, {c['vehicles']} vehicles, {c['matched']} matched, {c['stored']} saved, " \
+               f"{skipped} skipped ({c['bad_datetime']} time, {c['outside_segment']} far)"
+        stages = [f"{short} {self.stages[name] * 1000:.0f}" for name, short in STAGES if name in self.stages]
+        return f"{line} | ms: {', '.join(stages)}" if stages else line
+
+
+class MetricsRegistry:
+    """
+    Totals and histograms of the polls of the process, thread safe. Series are keyed by metric name and labels.
+    """
+    def __init__(self, file: str = METRICS_FILE):
+        """
+        :param file: Prometheus text file rewritten after each poll, None for no file
+        """
+        self.file = file
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels) -> counter / gauge value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.last_poll = None  # PollMetrics of the last poll
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Add to a counter
+        :param name: Metric name (METRICS)
+        :param value: Value to add
+        :param labels: Labels of the series
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """
+        Set a gauge
+        :param name: Metric name (METRICS)
+        :param value: Value
+        :param labels: Labels of the series
+        :return: None
+        """
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Add an observation to a histogram
+        :param name: Metric name (METRICS)
+        :param seconds: Observed value
+        :param labels: Labels of the series
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    h[i] += 1
+            h[len(BUCKETS)] += 1
+            h[-1] += seconds
+
+    def record_poll(self, poll: PollMetrics):
+        """
+        Add a finished poll to the totals, and rewrite the metrics file if any
+        :param poll: PollMetrics
+        :return: None
+        """
+        c = poll.counts
+        self.inc("tranzy_polls_total")
+        if poll.error:
+            self.inc("tranzy_poll_errors_total")
+        self.inc("tranzy_received_bytes_total", c["bytes"])
+        self.inc("tranzy_vehicles_total", c["vehicles"])
+        self.inc("tranzy_vehicles_matched_total", c["matched"])
+        self.inc("tranzy_vehicles_stored_total", c["stored"])
+        for reason in SKIP_REASONS:
+            self.inc("tranzy_vehicles_skipped_total", c[reason], reason=reason)
+        self.observe("tranzy_poll_duration_seconds", poll.duration)
+        for stage, seconds in poll.stages.items():
+            self.observe("tranzy_poll_stage_seconds", seconds, stage=stage)
+        if any(s in poll.stages for s in DB_STAGES):
+            self.observe("tranzy_db_write_seconds", poll.db_write())
+        self.set("tranzy_last_poll_timestamp_seconds", round(time.time(), 3))
+        self.last_poll = poll
+        if self.file:
+            try:
+                self.write_file(self.file)
+            except OSError as err:
+                # metrics are not a reason to stop polling
+                print(f"metrics file: {err!r}")
+
+    def snapshot(self) -> dict:
+        """
+        :return: Dict of the current values: series name ("name{label=value}") -> value for counters and gauges,
+         {"count", "sum", "mean"} for histograms; last_poll: stages (ms) and counters of the last poll
+        """
+        with self.lock:
+            result = {series_name(name, labels): value for (name, labels), value in sorted(self.values.items())}
+            for (name, labels), h in sorted(self.histograms.items()):
+                count = h[len(BUCKETS)]
+                result[series_name(name, labels)] = {"count": count, "sum": round(h[-1], 6),
+                                                     "mean": round(h[-1] / count, 6) if count else None}
+            poll = self.last_poll
+        if poll:
+            result["last_poll"] = {"duration_ms": round(poll.duration * 1000, 3),
+                                   "stages_ms": {s: round(t * 1000, 3) for s, t in poll.stages.items()},
+                                   **poll.counts}
+        return result
+
+    def prometheus(self) -> str:
+        """
+        :return: Metrics in Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, (kind, text) in METRICS.items():
+                values = sorted((labels, v) for (n, labels), v in self.values.items() if n == name)
+                histograms = sorted((labels, h) for (n, labels), h in self.histograms.items() if n == name)
+                if not values and not histograms:
+                    continue
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    lines.append(f"{series_name(name, labels)} {value}")
+                for labels, h in histograms:
+                    for i, bound in enumerate(BUCKETS):
+                        lines.append(f"{series_name(name + '_bucket', labels + (('le', str(bound)),))} {h[i]}")
+                    lines.append(f"{series_name(name + '_bucket', labels + (('le', '+Inf'),))} {h[len(BUCKETS)]}")
+                    lines.append(f"{series_name(name + '_sum', labels)} {round(h[-1], 6)}")
+                    lines.append(f"{series_name(name + '_count', labels)} {h[len(BUCKETS)]}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, file_name: str):
+        """
+        Write the metrics in Prometheus text format, replacing the file at once (readers never see half a file)
+        :param file_name: File name
+        :return: None
+        """
+        tmp_name = f"{file_name}.tmp"
+        with open(tmp_name, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_name, file_name)
+
+    def reset(self):
+        """
+        Clear all values
+        :return: None
+        """
+        with self.lock:
+            self.values.clear()
+            self.histograms.clear()
+            self.last_poll = None
+
+
+def series_name(name: str, labels: tuple) -> str:
+    """
+    :param name: Metric name
+    :param labels: Tuple of (label, value)
+    :return: Series name as in Prometheus text format, e.g. tranzy_poll_stage_seconds{stage="http"}
+    """
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+# registry of this process, polls are added by the collector
+registry = MetricsRegistry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the registry of the server (MetricsServer) on /metrics.
+    """
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not logged
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Prometheus endpoint, serving in a background thread after start().
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int, host: str = "127.0.0.1", metrics: MetricsRegistry = None):
+        """
+        :param port: Listening port
+        :param host: Listening address, local only by default (0.0.0.0 for all interfaces)
+        :param metrics: Registry to serve, default the registry of the process
+        """
+        super().__init__((host, port), MetricsHandler)
+        self.registry = metrics or registry
+        self.thread = None
+
+    def start(self):
+        """
+        Serve in a background thread
+        :return: Self
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name="metrics_server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        :return: None
+        """
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,108 @@
+"""
+Schema migrations for tranzy.db
+New db: tables are created from the ORM classes and stamped with the latest version.
+Existing db: migration steps newer than the version in schema_version are applied in order, each one recorded
+when done, so an upgrade keeps the collected data. Steps must be idempotent (a step interrupted by a crash
+runs again at next start).
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Engine, select, func, insert, update, inspect, text
+
+from tranzy_db import SchemaVersion, HistogramWatermark, Trip, Position, StopPassage, SegmentTraversal, create_indexes
+
+
+def migration_1(engine: Engine):
+    """
+    Indexes for stats / export queries and unique trip_id / stop_id
+    """
+    create_indexes(engine)
+
+
+def migration_2(engine: Engine):
+    """
+    Stop passages and segment traversals tables, filled from then on by the collector. Building them from the
+    positions history takes long on a large db, so it is left to the backfill command instead of blocking startup.
+    """
+    for table in (StopPassage.__table__, SegmentTraversal.__table__):
+        table.create(engine, checkfirst=True)
+
+
+def migration_3(engine: Engine):
+    """
+    Index on position trip_idx, for streaming export in idx order
+    """
+    create_indexes(engine)
+
+
+def migration_4(engine: Engine):
+    """
+    Trips whose segment traversals cover their positions history: none of the trips with positions, until the
+    backfill command builds them (stats and recommendations use the positions meanwhile)
+    """
+    with engine.begin() as conn:
+        if "traversals_built" not in {c["name"] for c in inspect(conn).get_columns(Trip.__tablename__)}:
+            conn.execute(text("ALTER TABLE trip ADD COLUMN traversals_built BOOLEAN NOT NULL DEFAULT 1"))
+        conn.execute(update(Trip).where(select(Position.idx).where(Position.trip_idx == Trip.idx).exists())
+                     .values(traversals_built=False))
+    print("Segment traversals of the positions history are not built, run: python -m tranzy_stats backfill")
+
+
+def migration_5(engine: Engine):
+    """
+    Time of the last histograms update of a stop pair, identifies the version of the saved histograms
+    """
+    with engine.begin() as conn:
+        if "aggregated_at" not in {c["name"] for c in inspect(conn).get_columns(HistogramWatermark.__tablename__)}:
+            conn.execute(text("ALTER TABLE histogram_watermark ADD COLUMN aggregated_at DATETIME"))
+
+
+# ordered migration steps: (version, description, function(engine))
+MIGRATIONS = [
+    (1, "indexes on position, trip, stop, stop_order, monitored_stops", migration_1),
+    (2, "stop passage and segment traversal tables", migration_2),
+    (3, "index on position trip_idx", migration_3),
+    (4, "trip traversals_built flag", migration_4),
+    (5, "histogram_watermark aggregated_at", migration_5),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(engine: Engine) -> int:
+    """
+    :param engine: Engine
+    :return: Schema version of the db, 0 for a db created before migrations existed
+    """
+    with engine.connect() as conn:
+        return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def record_version(engine: Engine, version: int, description: str):
+    """
+    :param engine: Engine
+    :param version: Applied version
+    :param description: Migration description
+    :return: None
+    """
+    with engine.begin() as conn:
+        conn.execute(insert(SchemaVersion).values(version=version, description=description,
+                                                  applied_at=datetime.now()))
+
+
+def migrate(engine: Engine, new_db: bool):
+    """
+    Bring the db schema to the latest version. Called after create_all.
+    :param engine: Engine
+    :param new_db: True if the tables were just created (nothing to migrate)
+    :return: None
+    """
+    version = current_version(engine)
+    if new_db and version == 0:
+        record_version(engine, LATEST_VERSION, "new database")
+        return
+    for step_version, description, step in MIGRATIONS:
+        if step_version > version:
+            print(f"Migrating database to version {step_version}: {description}")
+            step(engine)
+            record_version(engine, step_version, description)
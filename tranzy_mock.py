@@ -0,0 +1,247 @@
+"""
+Local stand-in for the Tranzy API, for measurements and tests without API key or quota.
+Serves a synthetic network (agency, routes, trips, stop_times, stops) and vehicles moving along the trips,
+generated from a seed, so runs are repeatable. Faults can be injected: response latency, 429 / 500 errors
+and vehicles with stale timestamps. Static datasets have an ETag (conditional requests get 304) and responses
+are gzip compressed when the client accepts it, as the real API does.
+Point the application at it with the TRANZY_URL environment variable, e.g.:
+    python -m tranzy_stats mock-server --port 8080 --vehicles 500
+    TRANZY_URL=http://127.0.0.1:8080/ python -m tranzy_stats collect --trip 1_0
+"""
+
+import gzip
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import AGENCY_ID, AGENCY, VEHICLES, ROUTES, TRIPS, STOPS, STOP_TIMES
+
+CENTER = (46.7700, 23.5900)  # lat, lon of the synthetic city
+STOP_SPACING = 400  # meters between consecutive stops
+METERS_PER_DEGREE = 111320
+
+
+class MockNetwork:
+    """
+    Synthetic static data and vehicle positions. Each route is a straight line of stops in a random direction
+    through the city; trip 0 runs along it and trip 1 back. Vehicles loop on their trip at constant speed.
+    """
+    def __init__(self, routes: int = 20, stops_per_trip: int = 25, vehicles: int = 300, speed: float = 20,
+                 stale_rate: float = 0.05, seed: int = 1, agency_id: str = AGENCY_ID):
+        """
+        :param routes: Number of routes (2 trips each)
+        :param stops_per_trip: Stops of each trip
+        :param vehicles: Fleet size, vehicles are assigned to trips in turn
+        :param speed: Vehicles speed in km/h
+        :param stale_rate: Fraction of vehicles reporting a timestamp older than TIME_TOLERANCE (config)
+        :param seed: Random seed of the network and fleet
+        :param agency_id: Agency ID
+        """
+        rnd = random.Random(seed)
+        self.agency_id = int(agency_id)
+        self.speed = speed / 3.6  # m/s
+        self.routes, self.trips, self.stop_times, self.stops = [], [], [], []
+        self.paths = {}  # trip_id -> list of (lat, lon) of its stops
+        stop_id = 1000
+        for route_id in range(1, routes + 1):
+            angle = rnd.uniform(0, math.pi)
+            length = STOP_SPACING * (stops_per_trip - 1)
+            # line centered near the city center
+            offset = rnd.uniform(-0.3, 0.3) * length
+            route_stops = []
+            for i in range(stops_per_trip):
+                d = i * STOP_SPACING - length / 2 + offset
+                lat = CENTER[0] + d * math.cos(angle) / METERS_PER_DEGREE
+                lon = CENTER[1] + d * math.sin(angle) / (METERS_PER_DEGREE * math.cos(math.radians(CENTER[0])))
+                route_stops.append({"stop_id": stop_id, "stop_name": f"Stop {stop_id}", "stop_code": str(stop_id),
+                                    "stop_lat": round(lat, 6), "stop_lon": round(lon, 6), "location_type": 0})
+                stop_id += 1
+            self.stops.extend(route_stops)
+            self.routes.append({"agency_id": self.agency_id, "route_id": route_id, "route_short_name": str(route_id),
+                                "route_long_name": f"{route_stops[0]['stop_name']} - {route_stops[-1]['stop_name']}",
+                                "route_color": "#1E90FF", "route_type": 3, "route_desc": None})
+            for direction, trip_stops in enumerate((route_stops, route_stops[::-1])):
+                trip_id = f"{route_id}_{direction}"
+                self.trips.append({"route_id": route_id, "trip_id": trip_id, "direction_id": direction,
+                                   "trip_headsign": trip_stops[-1]["stop_name"], "block_id": 0,
+                                   "shape_id": f"{route_id}_{direction}"})
+                self.stop_times.extend({"trip_id": trip_id, "stop_id": s["stop_id"], "stop_sequence": i}
+                                       for i, s in enumerate(trip_stops))
+                self.paths[trip_id] = [(s["stop_lat"], s["stop_lon"]) for s in trip_stops]
+        trip_ids = list(self.paths)
+        # vehicle: (label, trip_id, phase in seconds, age of the stale timestamp in seconds or None)
+        self.fleet = []
+        for i in range(vehicles):
+            trip_id = trip_ids[i % len(trip_ids)]
+            self.fleet.append((str(100 + i), trip_id, rnd.uniform(0, self.loop_time(trip_id)),
+                               rnd.uniform(120, 1800) if rnd.random() < stale_rate else None))
+
+    def loop_time(self, trip_id: str) -> float:
+        """
+        :param trip_id: Trip ID
+        :return: Seconds to run the trip (vehicles start again from the first stop)
+        """
+        return STOP_SPACING * (len(self.paths[trip_id]) - 1) / self.speed
+
+    def position(self, trip_id: str, t: float) -> tuple[float, float]:
+        """
+        :param trip_id: Trip ID
+        :param t: Seconds since the start of the trip
+        :return: Latitude, longitude
+        """
+        path = self.paths[trip_id]
+        d = (t % self.loop_time(trip_id)) * self.speed / STOP_SPACING
+        i = min(int(d), len(path) - 2)
+        f = d - i
+        return (round(path[i][0] + (path[i + 1][0] - path[i][0]) * f, 6),
+                round(path[i][1] + (path[i + 1][1] - path[i][1]) * f, 6))
+
+    def vehicles(self, now: datetime = None) -> list[dict]:
+        """
+        :param now: Current time (aware), default now
+        :return: Vehicles feed as returned by the vehicles endpoint
+        """
+        now = now or datetime.now(timezone.utc)
+        epoch = now.timestamp()
+        data = []
+        for label, trip_id, phase, stale_age in self.fleet:
+            # reports are 0-20 s old, stale vehicles stopped reporting 2-30 minutes ago
+            age = stale_age or int(epoch + phase) % 20
+            lat, lon = self.position(trip_id, epoch + phase - age)
+            data.append({"id": int(label), "label": label, "latitude": lat, "longitude": lon,
+                         "timestamp": (now - timedelta(seconds=age)).replace(microsecond=0).isoformat(),
+                         "vehicle_type": 3, "bike_accessible": "BIKE_INACCESSIBLE",
+                         "wheelchair_accessible": "WHEELCHAIR_ACCESSIBLE", "speed": round(self.speed * 3.6),
+                         "route_id": int(trip_id.split("_")[0]), "trip_id": trip_id})
+        return data
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Request handler, the network and fault settings are attributes of the server (MockServer).
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real API
+
+    def do_GET(self):
+        server = self.server
+        endpoint = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        server.count("requests")
+        if server.latency:
+            time.sleep(server.rnd.uniform(0.5, 1.5) * server.latency / 1000)
+        if endpoint != AGENCY and self.headers.get("X-Agency-Id") != str(server.network.agency_id):
+            return self.reply(403, {"message": "Invalid X-Agency-Id"})
+        roll = server.rnd.random()
+        if roll < server.error_429:
+            server.count("errors_429")
+            return self.reply(429, {"message": "Too Many Requests"})
+        if roll < server.error_429 + server.error_500:
+            server.count("errors_500")
+            return self.reply(500, {"message": "Internal Server Error"})
+        if endpoint == VEHICLES:
+            server.count("vehicles")
+            return self.reply(200, server.network.vehicles())
+        if endpoint not in server.static:
+            return self.reply(404, {"message": f"Unknown endpoint {endpoint}"})
+        body, etag = server.static[endpoint]
+        if self.headers.get("If-None-Match") == etag:
+            server.count("not_modified")
+            return self.reply(304, None, etag=etag)
+        return self.reply(200, body, etag=etag)
+
+    def reply(self, status: int, data, etag: str = None):
+        """
+        :param status: HTTP status
+        :param data: JSON data, or already encoded bytes, None for no body
+        :param etag: ETag header, if any
+        :return: None
+        """
+        body = b"" if data is None else data if type(data) == bytes else json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        if body:
+            self.send_header("Content-Type", "application/json")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body, compresslevel=1)
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # no access log, it would slow down load tests
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Mock Tranzy API server, serving in a background thread after start().
+    """
+    daemon_threads = True
+
+    def __init__(self, network: MockNetwork = None, host: str = "127.0.0.1", port: int = 0, latency: float = 0,
+                 error_429: float = 0, error_500: float = 0, seed: int = 1):
+        """
+        :param network: MockNetwork, default one with default settings
+        :param host: Listening address
+        :param port: Listening port, 0 for a free port
+        :param latency: Mean response delay in ms (uniform between 0.5x and 1.5x)
+        :param error_429: Fraction of requests answered 429 Too Many Requests
+        :param error_500: Fraction of requests answered 500 Internal Server Error
+        :param seed: Random seed of latency and errors
+        """
+        super().__init__((host, port), MockHandler)
+        self.network = network or MockNetwork()
+        self.latency = latency
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.rnd = random.Random(seed)
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        # static datasets are encoded once, ETag from the content
+        self.static = {}
+        agency = [{"agency_id": self.network.agency_id, "agency_name": "Mock Transit", "agency_url": "http://localhost",
+                   "agency_timezone": "Europe/Bucharest", "agency_lang": "ro"}]
+        for endpoint, data in ((AGENCY, agency), (ROUTES, self.network.routes), (TRIPS, self.network.trips),
+                               (STOPS, self.network.stops), (STOP_TIMES, self.network.stop_times)):
+            body = json.dumps(data).encode("utf-8")
+            self.static[endpoint] = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+
+    @property
+    def url(self) -> str:
+        """
+        :return: Base URL, to use as TRANZY_URL
+        """
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/"
+
+    def count(self, name: str):
+        """
+        :param name: Counter name
+        :return: None
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def start(self):
+        """
+        Serve in a background thread
+        :return: Self
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name="mock_server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        :return: None
+        """
+        self.shutdown()
+        self.server_close()
+
@@ -0,0 +1,196 @@
+"""
+Opt-in profiling of the hot code paths (collector poll, stats window computation) in real runs, without changing
+code: set TRANZY_PROFILE=1 (or PROFILE in config, --profile N on the command line). Decorated functions are then
+profiled one call in N (PROFILE_EVERY), other calls run as usual; when profiling is off the decorator only checks
+a flag.
+A profiled call runs in one of two modes (PROFILE_MODE), never both: the overhead of cProfile on every function call
+would skew the samples.
+ - deterministic: cProfile, exact call counts and times
+ - sampling: a stack sampler thread reads the stack of the profiled thread every PROFILE_SAMPLE_INTERVAL seconds,
+   with a low overhead, timings close to unprofiled runs
+Results of all the profiled calls of a session (process run) are added up and rewritten after each call, in
+PROFILE_DIR:
+ - {name}_{YYYYMMDD_HHMMSS}_{pid}.prof (deterministic): pstats file (python -m pstats, snakeviz...)
+ - {name}_{YYYYMMDD_HHMMSS}_{pid}.folded (sampling): collapsed stacks ("frame;frame;frame samples" lines), input of
+   flamegraph.pl, speedscope or inferno
+"""
+
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+
+from config import PROFILE, PROFILE_EVERY, PROFILE_MODE, PROFILE_DIR, PROFILE_SAMPLE_INTERVAL
+
+# profiling modes, the first one is used for an unknown PROFILE_MODE
+MODES = ("deterministic", "sampling")
+
+# settings of the process, see configure()
+enabled = PROFILE
+every = PROFILE_EVERY
+mode = PROFILE_MODE if PROFILE_MODE in MODES else MODES[0]
+out_dir = PROFILE_DIR
+# profilers of the session by name
+profilers = {}
+
+
+def configure(enable: bool = True, calls: int = None, folder: str = None, profile_mode: str = None):
+    """
+    Change the profiling settings of the process (e.g. from command line options), before the profiled calls
+    :param enable: Profile decorated functions
+    :param calls: Profile one call in this number, None to keep PROFILE_EVERY
+    :param folder: Output folder, None to keep PROFILE_DIR
+    :param profile_mode: deterministic or sampling (MODES), None to keep PROFILE_MODE
+    :return: None
+    """
+    global enabled, every, out_dir, mode
+    if profile_mode and profile_mode not in MODES:
+        raise ValueError(f"unknown profile mode {profile_mode}")
+    enabled = enable
+    every = calls or every
+    out_dir = folder or out_dir
+    mode = profile_mode or mode
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of a thread at a fixed interval, counting identical stacks.
+    """
+    def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL):
+        """
+        :param thread_id: Thread to sample (threading.get_ident() of the thread)
+        :param interval: Seconds between samples
+        """
+        super().__init__(name="profile_sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()  # "outer;...;inner" frames -> samples
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def stop(self):
+        """
+        Stop sampling and wait for the thread
+        :return: None
+        """
+        self.stop_event.set()
+        self.join()
+
+
+class Profiler:
+    """
+    Profiles one call in N of a code path and keeps the results of the session.
+    """
+    def __init__(self, name: str, calls: int = None, profile_mode: str = None):
+        """
+        :param name: Name of the profiled code path, prefix of the output files
+        :param calls: Profile one call in this number, None for the setting of the process (every)
+        :param profile_mode: deterministic or sampling, None for the setting of the process (mode)
+        """
+        self.name = name
+        self.every = calls
+        self.mode = profile_mode or mode
+        self.calls = 0
+        self.profiled = 0
+        self.stats = None  # pstats.Stats of the profiled calls
+        self.stacks = Counter()
+        self.file_name = None  # output files without extension, set at the first profiled call
+        self.lock = threading.Lock()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call a function, profiling it if it's its turn
+        :param func: Function
+        :return: Result of the function
+        """
+        with self.lock:
+            self.calls += 1
+            turn = (self.calls - 1) % (self.every or every) == 0
+        if not turn:
+            return func(*args, **kwargs)
+        if self.mode == "sampling":
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                sampler.stop()
+                self.add(stacks=sampler.stacks)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler active (Python 3.12+ allows one at a time), run without
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self.add(profile=profile)
+
+    def add(self, profile: cProfile.Profile = None, stacks: Counter = None):
+        """
+        Add the results of a profiled call and rewrite the output file of the mode
+        :param profile: cProfile.Profile of the call (deterministic)
+        :param stacks: Stack samples of the call (sampling)
+        :return: None
+        """
+        with self.lock:
+            if self.file_name is None:
+                os.makedirs(out_dir, exist_ok=True)
+                self.file_name = os.path.join(out_dir, f"{self.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_"
+                                                       f"{os.getpid()}")
+                extension = "folded" if self.mode == "sampling" else "prof"
+                print(f"profiling {self.name} ({self.mode}): one call in {self.every or every}, "
+                      f"{self.file_name}.{extension}")
+            self.profiled += 1
+            if profile is not None:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+            if stacks is not None:
+                self.stacks.update(stacks)
+            try:
+                if self.stats is not None:
+                    self.stats.dump_stats(f"{self.file_name}.prof")
+                if self.stacks:
+                    with open(f"{self.file_name}.folded", "w", encoding="utf-8") as f:
+                        f.writelines(f"{stack} {samples}\n" for stack, samples in self.stacks.most_common())
+            except OSError as err:
+                # profiling is not a reason to stop the profiled code
+                print(f"profile {self.name}: {err!r}")
+
+
+def profiled(name: str, calls: int = None):
+    """
+    Decorator: profile the function when profiling is enabled (one profiler per name and process)
+    :param name: Name of the profiled code path, prefix of the output files
+    :param calls: Profile one call in this number, None for the setting of the process
+    :return: Decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            profiler = profilers.get(name)
+            if profiler is None:
+                profiler = profilers.setdefault(name, Profiler(name, calls))
+            return profiler.run(func, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,208 @@
+"""
+Raw log of the vehicles snapshots returned by the API, for debugging and offline replay.
+Each snapshot is one line of compact JSON (NDJSON) with the capture time:
+    {"captured_at": "2024-05-01T06:30:00.123456+00:00", "agency_id": "2", "vehicles": [...]}
+Lines are written by a background thread (the poll only queues the snapshot) to files compressed with zstd
+(optional package zstandard) or gzip. A new file is started every day (local time) and when the compressed size
+reaches RAW_LOG_MAX_SIZE, named vehicles_YYYYMMDD_HHMMSS.ndjson.zst / .gz after the first snapshot.
+read_snapshots iterates snapshots lazily, one line at a time, whatever the size of the log.
+"""
+
+import atexit
+import glob
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+
+from config import AGENCY_ID, RAW_LOG_DIR, RAW_LOG_COMPRESSION, RAW_LOG_MAX_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# file extension by compression
+EXTENSIONS = {"zstd": ".ndjson.zst", "gzip": ".ndjson.gz", "none": ".ndjson"}
+# errors of a compressed stream cut by a crash
+TRUNCATED_ERRORS = (EOFError, OSError) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def open_log(path: str):
+    """
+    :param path: Raw log file, compression from the extension (.zst, .gz, otherwise none)
+    :return: Binary file object for reading, iterates lines
+    """
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"{path}: zstd files need zstandard (pip install zstandard)")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+class RawLogWriter:
+    """
+    Writes snapshots to rotated, compressed NDJSON files from a background thread.
+    The thread is started by the first write; close() (also called at exit) writes the queued snapshots
+    and closes the current file.
+    """
+    def __init__(self, log_dir: str = RAW_LOG_DIR, compression: str = RAW_LOG_COMPRESSION,
+                 max_size: int = RAW_LOG_MAX_SIZE, agency_id: str = AGENCY_ID):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"unknown raw log compression {compression}")
+        if compression == "zstd" and zstandard is None:
+            compression = "gzip"
+        self.log_dir = log_dir
+        self.extension = EXTENSIONS[compression]
+        self.max_size = max_size * 1024 * 1024  # MiB to bytes
+        self.agency_id = agency_id
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.file = None  # compressed stream of the current file
+        self.raw_file = None  # underlying file, its position is the compressed size
+        self.file_day = None
+        self.file_name = None
+        atexit.register(self.close)
+
+    def write(self, data, captured_at: datetime = None):
+        """
+        Queue a snapshot, returns immediately
+        :param data: JSON data returned by the vehicles endpoint
+        :param captured_at: Time the response was received, default now
+        :return: None
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="raw_log", daemon=True)
+                self.thread.start()
+        self.queue.put((captured_at or datetime.now(timezone.utc), data))
+
+    def run(self):
+        """
+        Background thread: write queued snapshots until close()
+        :return: None
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write_line(*item)
+                if self.queue.empty():
+                    # make the snapshots written so far readable, in case of a crash
+                    self.file.flush()
+            except (OSError, RuntimeError, TypeError, ValueError) as err:
+                # a snapshot lost is not a reason to stop logging
+                print(f"raw log: {err!r}")
+        self.close_file()
+
+    def write_line(self, captured_at: datetime, data):
+        """
+        Write one snapshot, rotating the file if needed
+        :param captured_at: Capture time (aware)
+        :param data: JSON data
+        :return: None
+        """
+        local_time = captured_at.astimezone()
+        if self.file and (local_time.date() != self.file_day or self.raw_file.tell() >= self.max_size):
+            self.close_file()
+        if self.file is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            self.file_name = os.path.join(self.log_dir, f"vehicles_{local_time.strftime('%Y%m%d_%H%M%S')}"
+                                                        f"{self.extension}")
+            self.raw_file = open(self.file_name, "ab")
+            if self.extension.endswith(".zst"):
+                self.file = zstandard.ZstdCompressor().stream_writer(self.raw_file)
+            elif self.extension.endswith(".gz"):
+                self.file = gzip.GzipFile(fileobj=self.raw_file, mode="wb")
+            else:
+                self.file = self.raw_file
+            self.file_day = local_time.date()
+        line = json.dumps({"captured_at": captured_at.isoformat(), "agency_id": self.agency_id, "vehicles": data},
+                          ensure_ascii=False, separators=(",", ":"))
+        self.file.write(line.encode("utf-8") + b"\n")
+
+    def close_file(self):
+        """
+        Finish the compressed stream of the current file
+        :return: None
+        """
+        if self.file:
+            self.file.close()
+            if self.file is not self.raw_file:
+                self.raw_file.close()
+        self.file = self.raw_file = self.file_day = None
+
+    def close(self, timeout: float = 10):
+        """
+        Write the queued snapshots and close the current file, the next write starts a new thread and file
+        :param timeout: Seconds to wait for the writer thread
+        :return: None
+        """
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join(timeout)
+            self.thread = None
+
+
+def log_files(path: str = RAW_LOG_DIR) -> list[str]:
+    """
+    :param path: Raw log folder, or a single file
+    :return: Raw log files in time order
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "vehicles_*.ndjson*")))
+    return [path]
+
+
+def file_start(path: str):
+    """
+    :param path: Raw log file
+    :return: Local time of the first snapshot from the file name (naive), None if not a rotated file name
+    """
+    try:
+        return datetime.strptime(os.path.basename(path)[len("vehicles_"):][:15], "%Y%m%d_%H%M%S")
+    except ValueError:
+        return None
+
+
+def read_snapshots(path: str = RAW_LOG_DIR, since: datetime = None, until: datetime = None):
+    """
+    Iterate the snapshots of the raw log, reading one line at a time.
+    A file cut by a crash (truncated compressed stream or last line) is read up to the damage.
+    :param path: Raw log folder, or a single file
+    :param since: First capture time (aware), None for no limit
+    :param until: Last capture time (aware, excluded), None for no limit
+    :return: Generator of (capture time (aware UTC), vehicles JSON data)
+    """
+    files = log_files(path)
+    for i, file_name in enumerate(files):
+        start = file_start(file_name)
+        if until and start and start.astimezone() >= until:
+            break
+        # files are in time order: skip the ones ending before since
+        next_start = file_start(files[i + 1]) if i + 1 < len(files) else None
+        if since and next_start and next_start.astimezone() <= since:
+            continue
+        with open_log(file_name) as f:
+            try:
+                for line in f:
+                    try:
+                        snapshot = json.loads(line)
+                    except ValueError:
+                        print(f"{file_name}: invalid line skipped")
+                        continue
+                    captured_at = datetime.fromisoformat(snapshot["captured_at"])
+                    if (since and captured_at < since) or (until and captured_at >= until):
+                        continue
+                    yield captured_at, snapshot["vehicles"]
+            except TRUNCATED_ERRORS as err:
+                print(f"{file_name}: truncated ({err})")
@@ -0,0 +1,249 @@
+"""
+Departure time recommendation: when to be at the start stop to reach the end stop reliably.
+For a stop pair, the segment traversals of past days are aggregated in fixed-width histograms per weekday and
+time of day bin (local time):
+ - travel: travel time of the vehicles departing in the bin
+ - wait: time from the bin start to the next departure
+ - total: time from the bin start to the arrival of the next vehicle that reached the end stop
+Histograms are saved in db (travel_histogram) and updated incrementally with the days completed since the last
+update, so a recommendation only reads the 288 bins of a weekday, whatever the history length.
+"""
+
+import json
+from datetime import datetime, date, time, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import select, delete, insert, and_
+from sqlalchemy.orm import Session
+
+from tranzy_db import SegmentTraversal, TravelHistogram, HistogramWatermark
+from tranzy_time import local_day_bounds
+from tranzy_traversals import traversals_built
+
+BIN_MINUTES = 5  # time of day bin
+BINS = 24 * 60 // BIN_MINUTES
+BUCKET_SECONDS = 30  # histogram resolution
+BUCKETS = 240  # 2 hours, longer times are counted in the last bucket
+MAX_WAIT = 30  # minutes, bins with no departure for longer are not sampled (no collection at that time)
+METRICS = ("travel", "wait", "total")
+
+# weekday histograms already loaded: (trip_idx, from_stop_idx, to_stop_idx, weekday, aggregated_at) -> arrays
+_loaded = {}
+
+
+def bucket(seconds: float) -> int:
+    """
+    :param seconds: Duration
+    :return: Histogram bucket
+    """
+    return min(int(seconds // BUCKET_SECONDS), BUCKETS - 1)
+
+
+def day_histograms(traversals: list[tuple[datetime, datetime]], day: date) -> dict[int, np.ndarray]:
+    """
+    Histograms of one day.
+    :param traversals: List of (departure, arrival or None) as local naive datetimes, sorted by departure
+    :param day: Local date
+    :return: Dict bin -> array (len(METRICS), BUCKETS) of counts, for the sampled bins
+    """
+    hist = {}
+    if not traversals:
+        return hist
+    departures = [d for d, a in traversals]
+    midnight = datetime.combine(day, time())
+    max_wait = timedelta(minutes=MAX_WAIT)
+    # travel times by departure bin
+    for d, a in traversals:
+        if a:
+            h = hist.setdefault(int((d - midnight).total_seconds() // (BIN_MINUTES * 60)),
+                                np.zeros((len(METRICS), BUCKETS), dtype=np.int64))
+            h[0, bucket((a - d).total_seconds())] += 1
+    # wait and total time from each bin start, between two departures close enough
+    i = j = 0
+    for b in range(BINS):
+        t = midnight + timedelta(minutes=b * BIN_MINUTES)
+        while i < len(departures) and departures[i] < t:
+            i += 1
+        if i == 0 or i == len(departures) or t - departures[i - 1] > max_wait or departures[i] - t > max_wait:
+            continue
+        h = hist.setdefault(b, np.zeros((len(METRICS), BUCKETS), dtype=np.int64))
+        h[1, bucket((departures[i] - t).total_seconds())] += 1
+        # next vehicle that reached the end stop
+        j = max(j, i)
+        while j < len(traversals) and traversals[j][1] is None:
+            j += 1
+        if j < len(traversals):
+            h[2, bucket((traversals[j][1] - t).total_seconds())] += 1
+    return hist
+
+
+def get_watermark(session: Session, trip_idx, from_stop_idx, to_stop_idx):
+    """
+    :return: HistogramWatermark of the stop pair, or None if never aggregated
+    """
+    stmt = select(HistogramWatermark).where(and_(HistogramWatermark.trip_idx == trip_idx,
+                                                 HistogramWatermark.from_stop_idx == from_stop_idx,
+                                                 HistogramWatermark.to_stop_idx == to_stop_idx))
+    return session.execute(stmt).scalars().first()
+
+
+def update_histograms(session: Session, trip_idx, from_stop_idx, to_stop_idx, today: date = None) -> int:
+    """
+    Add the days completed since the last update to the histograms of a stop pair.
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :param from_stop_idx: DB stop idx of the start stop
+    :param to_stop_idx: DB stop idx of the end stop
+    :param today: Local date of today (days before it are complete), default today
+    :return: Number of days with traversals added; nothing is aggregated while the traversals of the trip don't
+     cover its history (traversals_built), the days missing from them would never be added
+    """
+    if not traversals_built(session, trip_idx):
+        return 0
+    today = today or date.today()
+    watermark = get_watermark(session, trip_idx, from_stop_idx, to_stop_idx)
+    if watermark and watermark.aggregated_until >= today:
+        return 0
+    stmt = select(SegmentTraversal.departure, SegmentTraversal.arrival)\
+        .where(and_(SegmentTraversal.trip_idx == trip_idx,
+                    SegmentTraversal.from_stop_idx == from_stop_idx,
+                    SegmentTraversal.to_stop_idx == to_stop_idx,
+                    SegmentTraversal.departure < local_day_bounds(today)[0]))\
+        .order_by(SegmentTraversal.departure)
+    if watermark:
+        stmt = stmt.where(SegmentTraversal.departure >= local_day_bounds(watermark.aggregated_until)[0])
+    # group traversals by local day
+    days = {}
+    for departure, arrival in session.execute(stmt):
+        d = departure.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+        a = arrival.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None) if arrival else None
+        days.setdefault(d.date(), []).append((d, a))
+    # new counts by (weekday, bin)
+    added = {}
+    for day, traversals in days.items():
+        for b, h in day_histograms(traversals, day).items():
+            key = (day.isoweekday(), b)
+            added[key] = added[key] + h if key in added else h
+    if added:
+        pair = and_(TravelHistogram.trip_idx == trip_idx, TravelHistogram.from_stop_idx == from_stop_idx,
+                    TravelHistogram.to_stop_idx == to_stop_idx)
+        # merge with the saved counts, rows are replaced
+        replaced = []
+        for row in session.execute(select(TravelHistogram).where(pair)).scalars():
+            key = (row.weekday, row.bin)
+            if key in added:
+                added[key] += np.array([json.loads(getattr(row, m)) for m in METRICS])
+                replaced.append(row.idx)
+        if replaced:
+            session.execute(delete(TravelHistogram).where(TravelHistogram.idx.in_(replaced)))
+        session.execute(insert(TravelHistogram), [
+            {"trip_idx": trip_idx, "from_stop_idx": from_stop_idx, "to_stop_idx": to_stop_idx,
+             "weekday": w, "bin": b, **{m: json.dumps(h[k].tolist()) for k, m in enumerate(METRICS)}}
+            for (w, b), h in added.items()])
+    if watermark:
+        watermark.aggregated_until = today
+        watermark.aggregated_at = datetime.now()
+    else:
+        session.add(HistogramWatermark(trip_idx=trip_idx, from_stop_idx=from_stop_idx, to_stop_idx=to_stop_idx,
+                                       aggregated_until=today, aggregated_at=datetime.now()))
+    session.commit()
+    return len(days)
+
+
+def load_weekday(session: Session, trip_idx, from_stop_idx, to_stop_idx, weekday: int) -> np.ndarray:
+    """
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :param from_stop_idx: DB stop idx of the start stop
+    :param to_stop_idx: DB stop idx of the end stop
+    :param weekday: ISO weekday
+    :return: Array (BINS, len(METRICS), BUCKETS) of counts, cached until the next update
+    """
+    watermark = get_watermark(session, trip_idx, from_stop_idx, to_stop_idx)
+    # the update time changes when the histograms are rebuilt (reset by backfill), the aggregated days may not
+    key = (trip_idx, from_stop_idx, to_stop_idx, weekday, watermark.aggregated_at if watermark else None)
+    if key not in _loaded:
+        counts = np.zeros((BINS, len(METRICS), BUCKETS), dtype=np.int64)
+        stmt = select(TravelHistogram).where(and_(TravelHistogram.trip_idx == trip_idx,
+                                                  TravelHistogram.from_stop_idx == from_stop_idx,
+                                                  TravelHistogram.to_stop_idx == to_stop_idx,
+                                                  TravelHistogram.weekday == weekday))
+        for row in session.execute(stmt).scalars():
+            counts[row.bin] = [json.loads(getattr(row, m)) for m in METRICS]
+        # keep only the current version of this weekday
+        for k in [k for k in _loaded if k[:4] == key[:4]]:
+            del _loaded[k]
+        _loaded[key] = counts
+    return _loaded[key]
+
+
+def percentiles(counts: np.ndarray, q: float) -> np.ndarray:
+    """
+    :param counts: Array (..., BUCKETS) of histogram counts
+    :param q: Quantile, 0 to 1
+    :return: Array (...) of the q quantile in seconds (bucket upper edge), NaN for empty histograms
+    """
+    cumulative = counts.cumsum(axis=-1)
+    total = cumulative[..., -1:]
+    idx = (cumulative >= np.maximum(q * total, 1)).argmax(axis=-1)
+    return np.where(total[..., 0] > 0, (idx + 1) * BUCKET_SECONDS, np.nan)
+
+
+def departure_table(session: Session, trip_idx, from_stop_idx, to_stop_idx, weekday: int) -> list[dict]:
+    """
+    Travel statistics for each sampled time of day bin of a weekday.
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :param from_stop_idx: DB stop idx of the start stop
+    :param to_stop_idx: DB stop idx of the end stop
+    :param weekday: ISO weekday
+    :return: List of dicts with keys: time (local time at the start stop), samples (days), wait_p50, travel_p50
+     (None if no vehicle departed in the bin), total_p50, total_p90 (seconds), ordered by time; empty if the traversals of the trip are not built (backfill)
+    """
+    if not traversals_built(session, trip_idx):
+        return []
+    update_histograms(session, trip_idx, from_stop_idx, to_stop_idx)
+    counts = load_weekday(session, trip_idx, from_stop_idx, to_stop_idx, weekday)
+    samples = counts[:, 2].sum(axis=-1)
+    wait_p50, travel_p50 = percentiles(counts[:, 1], 0.5), percentiles(counts[:, 0], 0.5)
+    total_p50, total_p90 = percentiles(counts[:, 2], 0.5), percentiles(counts[:, 2], 0.9)
+    # no departure in the bin: no travel time
+    return [{"time": (datetime.min + timedelta(minutes=int(b) * BIN_MINUTES)).time(), "samples": int(samples[b]),
+             "wait_p50": float(wait_p50[b]),
+             "travel_p50": float(travel_p50[b]) if counts[b, 0].any() else None,
+             "total_p50": float(total_p50[b]), "total_p90": float(total_p90[b])}
+            for b in np.flatnonzero(samples)]
+
+
+def recommend_departure(session: Session, trip_idx, from_stop_idx, to_stop_idx, weekday: int = None,
+                        leave_after: time = None, arrive_by: time = None, window: int = 60):
+    """
+    Best time of day bin to be at the start stop.
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :param from_stop_idx: DB stop idx of the start stop
+    :param to_stop_idx: DB stop idx of the end stop
+    :param weekday: ISO weekday, default today
+    :param leave_after: Earliest time to be at the start stop, default now
+    :param arrive_by: Latest p90 arrival: if given, the latest bin arriving in time is recommended
+    :param window: Minutes after leave_after to search for the fastest bin (p90 total time) if arrive_by is not given
+    :return: Dict as in departure_table with p50_arrival and p90_arrival (local times) added, or None if no data
+    """
+    now = datetime.now()
+    weekday = weekday or now.isoweekday()
+    leave_after = leave_after or now.time()
+    start = datetime.combine(date.min, leave_after)
+    candidates = []
+    for row in departure_table(session, trip_idx, from_stop_idx, to_stop_idx, weekday):
+        t = datetime.combine(date.min, row["time"])
+        row["p50_arrival"] = (t + timedelta(seconds=row["total_p50"])).time()
+        row["p90_arrival"] = (t + timedelta(seconds=row["total_p90"])).time()
+        if arrive_by:
+            if t >= start and t + timedelta(seconds=row["total_p90"]) <= datetime.combine(date.min, arrive_by):
+                # latest bin arriving in time
+                candidates.append((-(t - start).total_seconds(), row))
+        elif start <= t <= start + timedelta(minutes=window):
+            candidates.append((row["total_p90"], row))
+    if not candidates:
+        return None
+    return min(candidates, key=lambda c: c[0])[1]
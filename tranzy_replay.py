@@ -0,0 +1,146 @@
+"""
+Offline replay of the raw log: positions are rebuilt from recorded vehicles snapshots, without API calls,
+e.g. for a newly configured trip or after changing the monitored stops.
+Snapshots go through evaluate_positions, as in live collection, with the capture time of each snapshot as
+reference for the datetime tolerance. Days are evaluated by worker processes (parsing and distance computation
+are CPU bound), positions are inserted by the calling process in batches, in day order. Positions already in
+the db (same trip, vehicle and timestamp) are skipped, so a replay can be repeated or overlap live collection.
+Stop passages and segment traversals of the replayed trips are rebuilt at the end.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, time, timedelta
+from itertools import repeat
+
+from sqlalchemy import Engine, select, insert, update, and_
+from sqlalchemy.orm import Session
+
+from config import RAW_LOG_DIR, REPLAY_BATCH, REPLAY_WORKERS
+from tranzy_db import Position, Trip
+from tranzy_db_tools import get_monitor_index, evaluate_positions
+from tranzy_geo import StopIndex
+from tranzy_rawlog import log_files, file_start, read_snapshots
+from tranzy_time import utc_naive
+from tranzy_traversals import backfill_traversals
+
+
+def day_files(path: str = RAW_LOG_DIR, first_day: date = None, last_day: date = None) -> dict:
+    """
+    Group the raw log files by local day (files are rotated at least every day).
+    :param path: Raw log folder, or a single file
+    :param first_day: First local date to replay, None for no limit
+    :param last_day: Last local date to replay (included), None for no limit
+    :return: Dict day -> list of files, in day order; files without date in the name are under None
+    """
+    days = {}
+    for file_name in log_files(path):
+        start = file_start(file_name)
+        day = start.date() if start else None
+        if day and ((first_day and day < first_day) or (last_day and day > last_day)):
+            continue
+        days.setdefault(day, []).append(file_name)
+    return dict(sorted(days.items(), key=lambda d: d[0] or date.min))
+
+
+def replay_day(files: list[str], monitor_index: StopIndex, first_day: date = None,
+               last_day: date = None) -> tuple[int, list[dict]]:
+    """
+    Evaluate the snapshots of one day. Runs in a worker process (plain arguments and results, no db access).
+    :param files: Raw log files of the day
+    :param monitor_index: StopIndex of the replayed trips
+    :param first_day: First local date to replay, None for no limit
+    :param last_day: Last local date to replay (included), None for no limit
+    :return: Number of snapshots, Position rows as dicts (naive UTC timestamps, as stored)
+    """
+    since = datetime.combine(first_day, time()).astimezone() if first_day else None
+    until = datetime.combine(last_day + timedelta(days=1), time()).astimezone() if last_day else None
+    snapshots, rows = 0, []
+    for file_name in files:
+        for captured_at, data in read_snapshots(file_name, since, until):
+            snapshots += 1
+            if type(data) != list:
+                continue
+            vehicles = [v for v in data if type(v) == dict and v.get("trip_id") in monitor_index.trip_idx
+                        and v.get("timestamp") and v.get("latitude") is not None]
+            if vehicles:
+                day_rows, messages = evaluate_positions(vehicles, monitor_index, dt_now=captured_at)
+                rows.extend(day_rows)
+    for row in rows:
+        row["timestamp"] = utc_naive(row["timestamp"])
+    return snapshots, rows
+
+
+def existing_positions(session: Session, trip_idx_list: list[int], rows: list[dict]) -> set:
+    """
+    :param session: Session
+    :param trip_idx_list: DB trip idx of the replayed trips
+    :param rows: Replayed rows of a day
+    :return: Set of (trip_idx, vehicle_no, timestamp) already in db, in the time range of the rows
+    """
+    if not rows:
+        return set()
+    stmt = select(Position.trip_idx, Position.vehicle_no, Position.timestamp)\
+        .where(and_(Position.trip_idx.in_(trip_idx_list),
+                    Position.timestamp >= min(r["timestamp"] for r in rows),
+                    Position.timestamp <= max(r["timestamp"] for r in rows)))
+    return {tuple(row) for row in session.execute(stmt)}
+
+
+def replay(engine: Engine, trip_id_list: list[str], path: str = RAW_LOG_DIR, first_day: date = None,
+           last_day: date = None, progress=None, workers: int = REPLAY_WORKERS,
+           batch_size: int = REPLAY_BATCH) -> dict:
+    """
+    Rebuild positions of configured trips from the raw log.
+    :param engine: Engine
+    :param trip_id_list: Trip ids, configured with their monitored stops
+    :param path: Raw log folder, or a single file
+    :param first_day: First local date to replay, None for no limit
+    :param last_day: Last local date to replay (included), None for no limit
+    :param progress: Function called in the calling process when a day is saved, with
+     (day or None, snapshots, positions inserted, duplicates skipped, days done, days total), or None
+    :param workers: Maximum number of days evaluated at the same time (limited to the number of CPUs)
+    :param batch_size: Rows per bulk insert
+    :return: Dict with totals: days, snapshots, inserted, skipped
+    """
+    with Session(engine) as session:
+        monitor_index = get_monitor_index(session, trip_id_list)
+    trip_idx_list = list(monitor_index.trip_idx.values())
+    days = day_files(path, first_day, last_day)
+    totals = {"days": len(days), "snapshots": 0, "inserted": 0, "skipped": 0}
+    workers = min(workers, len(days), os.cpu_count() or 1)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) \
+        if workers > 1 else None
+    try:
+        if executor:
+            # map keeps day order, days are evaluated ahead by the workers
+            results = executor.map(replay_day, days.values(), repeat(monitor_index), repeat(first_day),
+                                   repeat(last_day))
+        else:
+            # no gain from worker processes, evaluate in this process one day at a time
+            results = (replay_day(files, monitor_index, first_day, last_day) for files in days.values())
+        with Session(engine) as session:
+            for done, (day, (snapshots, rows)) in enumerate(zip(days, results), start=1):
+                existing = existing_positions(session, trip_idx_list, rows)
+                new_rows = [r for r in rows if (r["trip_idx"], r["vehicle_no"], r["timestamp"]) not in existing]
+                for i in range(0, len(new_rows), batch_size):
+                    session.execute(insert(Position), new_rows[i:i + batch_size])
+                if new_rows:
+                    # rebuilt below, stats use the positions if the replay is interrupted before
+                    session.execute(update(Trip).where(Trip.idx.in_({r["trip_idx"] for r in new_rows}))
+                                    .values(traversals_built=False))
+                session.commit()
+                totals["snapshots"] += snapshots
+                totals["inserted"] += len(new_rows)
+                totals["skipped"] += len(rows) - len(new_rows)
+                if progress:
+                    progress(day, snapshots, len(new_rows), len(rows) - len(new_rows), done, len(days))
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    if totals["inserted"]:
+        with Session(engine) as session:
+            for trip_idx in trip_idx_list:
+                backfill_traversals(session, trip_idx)
+    return totals
@@ -7,19 +7,85 @@ Get your API key here (use Edge if Chrome doesn't work):
 https://tranzy.dev/accounts/my-apps
 """
 
-from datetime import datetime
+from datetime import datetime, timezone
 import requests
-import json
+from requests.adapters import HTTPAdapter
 
 from config import AGENCY_ID, TRANZY_KEY, TRANZY_URL, \
-    AGENCY, VEHICLES, ROUTES, TRIPS, STOPS, STOP_TIMES
+    AGENCY, VEHICLES, \
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_POOL_SIZE
+from tranzy_cache import ReferenceCache
+from tranzy_metrics import PollMetrics
+from tranzy_rawlog import RawLogWriter
 
-# calls to other endpoints than agency must have "X-Agency-Id" in headers
-headers = {
-    "Content-Type": "application/json",
-    "X-API-KEY": TRANZY_KEY,
-    "X-Agency-Id": AGENCY_ID
-}
+
+class TranzyClient:
+    """
+    Shared HTTP client for the Tranzy API. Keeps a pooled keep-alive session,
+    so consecutive polls reuse the same TCP+TLS connection.
+    """
+    def __init__(self, agency_id: str = AGENCY_ID, api_key: str = TRANZY_KEY, base_url: str = TRANZY_URL):
+        self.agency_id = agency_id
+        self.base_url = base_url
+        self.timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        self.requests_sent = 0
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+            "X-API-KEY": api_key
+        })
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def get(self, endpoint: str, agency: bool = True, headers: dict = None) -> requests.Response:
+        """
+        GET an API endpoint through the shared session.
+        :param endpoint: Endpoint name, appended to the base URL (TRANZY_URL)
+        :param agency: Send "X-Agency-Id" header (required by all endpoints except agency)
+        :param headers: Extra headers for this request only
+        :return: Response object
+        """
+        # calls to other endpoints than agency must have "X-Agency-Id" in headers
+        h = {"X-Agency-Id": self.agency_id} if agency else {}
+        if headers:
+            h.update(headers)
+        self.requests_sent += 1
+        return self.session.get(url=f"{self.base_url}{endpoint}", headers=h, timeout=self.timeout)
+
+    def connection_stats(self) -> dict:
+        """
+        Connection reuse statistics of the pooled session.
+        :return: Dict with requests sent, connections opened and reuse rate (0..1)
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = sum(pools[k].num_connections for k in pools.keys())
+        reuse_rate = 1 - connections / self.requests_sent if self.requests_sent else 0.0
+        return {"requests": self.requests_sent, "connections": connections, "reuse_rate": max(reuse_rate, 0.0)}
+
+
+# shared client used by all API calls of this module
+client = TranzyClient()
+# on-disk cache of static datasets
+cache = ReferenceCache()
+# raw log of the vehicles snapshots, written in background
+raw_writer = RawLogWriter()
+
+
+def use_api(base_url: str, cache_dir: str):
+    """
+    Send the API calls of this module to another server (e.g. the mock server of tranzy_mock), with a separate
+    cache for its static datasets.
+    :param base_url: API base URL
+    :param cache_dir: Cache folder for the static datasets of this server
+    :return: None
+    """
+    global client, cache
+    client = TranzyClient(base_url=base_url)
+    cache = ReferenceCache(cache_dir=cache_dir)
 
 
 def explain_error(s: str) -> str:
@@ -33,67 +99,82 @@ def explain_error(s: str) -> str:
         return "Unknown error"
 
 
-def get_agency_name(agency_id: str):
+def get_static(endpoint: str, required_key: str):
     """
-    Get agency name
-    :param agency_id: Tranzy agency ID
-    :return: Agency name
+    Get a static dataset (routes, trips, stops, stop_times) from the on-disk cache while it's fresh.
+    An expired entry is revalidated with a conditional request if the server sent ETag/Last-Modified,
+    and is still used if the API can't be reached.
+    :param endpoint: API endpoint name
+    :param required_key: Key that must be present in the elements of valid data (only valid data is cached)
+    :return: JSON data
     """
-    headers_ag = {k: headers[k] for k in headers if k != "X-Agency-Id"}
+    entry = cache.load(endpoint)
+    if cache.is_fresh(entry):
+        return entry["data"]
     try:
-        response = requests.get(url=f"{TRANZY_URL}{AGENCY}", headers=headers_ag)
+        response = client.get(endpoint, headers=cache.conditional_headers(entry))
+        if response.status_code == 304 and entry:
+            cache.touch(endpoint)
+            return entry["data"]
         response.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        print(explain_error(str(err)))
-        return "Agency name error"
-    else:
-        return next((a['agency_name'] for a in response.json() if a["agency_id"] == int(agency_id)), None)
-
-
-def get_route(line_number: str):
+    except requests.exceptions.RequestException as err:
+        if entry:
+            # stale data is better than no data
+            print(f"{explain_error(str(err))} - using cached {endpoint}")
+            return entry["data"]
+        raise
+    data = response.json()
+    if type(data) == list and len(data) != 0 and type(data[0]) == dict and required_key in data[0]:
+        cache.save(endpoint, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return data
+
+
+def expire_cache(endpoint: str = None):
     """
-    Get route information for specific line number.
-    :param line_number: A valid line number of chosen agency
-    :return: List of json data for the route. Normally should have only 1 element.
+    Expire cached static data, next calls revalidate it with the server (downloaded again only if changed).
+    :param endpoint: API endpoint name, or None for all static datasets
+    :return: None
     """
-    try:
-        response = requests.get(url=f"{TRANZY_URL}{ROUTES}", headers=headers)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as err:
-        print(explain_error(str(err)))
-        raise SystemExit(err)
-    else:
-        return [r for r in response.json()
-                if r["route_short_name"] in (line_number, line_number.upper(), line_number.lower())]
+    cache.expire(endpoint)
 
 
-def get_trips(route_id: int):
+def get_agency_name(agency_id: str):
     """
-    Get trips (way to and back) information for chosen route.
-    :param route_id: Route ID obtain from get_route return
-    :return: List of json data for the trips. Normally should have only 2 elements.
+    Get agency name
+    :param agency_id: Tranzy agency ID
+    :return: Agency name
     """
     try:
-        response = requests.get(url=f"{TRANZY_URL}{TRIPS}", headers=headers)
+        response = client.get(AGENCY, agency=False)
         response.raise_for_status()
     except requests.exceptions.HTTPError as err:
         print(explain_error(str(err)))
-        raise SystemExit(err)
+        return "Agency name error"
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+        print(err)
+        return "Agency name error"
     else:
-        return [t for t in response.json() if t["route_id"] == route_id]
+        return next((a['agency_name'] for a in response.json() if a["agency_id"] == int(agency_id)), None)
 
 
-def get_vehicles(trip_id: list[str], raw_log: bool):
+def get_vehicles(trip_id: list[str], raw_log: bool, metrics: PollMetrics = None):
     """
     Get vehicles positions.
-    :param raw_log: Enable raw logging of JSON data
-    :param trip_id: Trip ID obtain from get_trips return, used to filter output
-    :return: List of json data for the positions of vehicles linked to the respective trip
+    :param raw_log: Enable raw logging of JSON data (see tranzy_rawlog)
+    :param trip_id: Trip IDs, used to filter output
+    :param metrics: PollMetrics of the poll (stages http, decode, filter), or None
+    :return: List of json data for the positions of vehicles linked to the respective trip; raises HTTPError for
+     429 / 5xx responses (failed poll, the next one can succeed)
     """
+    metrics = metrics or PollMetrics()
     try:
-        response = requests.get(url=f"{TRANZY_URL}{VEHICLES}", headers=headers)
+        with metrics.stage("http"):
+            response = client.get(VEHICLES)
+            response.raise_for_status()
     except requests.exceptions.HTTPError as err:
         print(explain_error(str(err)))
+        if err.response is not None and (err.response.status_code == 429 or err.response.status_code >= 500):
+            raise
         raise SystemExit(err)
     except requests.exceptions.ConnectionError as err:
         print(err)
@@ -102,56 +183,19 @@ def get_vehicles(trip_id: list[str], raw_log: bool):
         print(err)
         return []
     else:
-        data = response.json()
+        captured_at = datetime.now(timezone.utc)
+        metrics.count("bytes", len(response.content))
+        with metrics.stage("decode"):
+            data = response.json()
         if raw_log:
-            with open(f"vehicles_{datetime.now().astimezone().strftime('%Y%m%d')}.json", "a", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+            raw_writer.write(data, captured_at)
         if type(data) == list and len(data) != 0 and type(data[0]) == dict and "trip_id" in data[0]:
-            return [v for v in response.json() if v["trip_id"] in trip_id]
+            with metrics.stage("filter"):
+                trip_ids = set(trip_id)
+                vehicles = [v for v in data if v["trip_id"] in trip_ids]
+            metrics.count("vehicles", len(data))
+            metrics.count("matched", len(vehicles))
+            return vehicles
         else:
             print(f"{datetime.now().astimezone().strftime('%H:%M:%S')} Invalid data for vehicles: {data}")
             return []
-
-
-def get_stop_order(trip_id: str):
-    """
-    Get stops order for a specific trip.
-    :param trip_id: Trip ID obtain from get_trips return, used to filter output
-    :return: List of json data for the stops on the trip
-    """
-    try:
-        response = requests.get(url=f"{TRANZY_URL}{STOP_TIMES}", headers=headers)
-    except requests.exceptions.HTTPError as err:
-        print(explain_error(str(err)))
-        raise SystemExit(err)
-    else:
-        data = response.json()
-        if type(data) == list and len(data) != 0 and type(data[0]) == dict and "stop_sequence" in data[0]:
-            return [s for s in response.json() if s["trip_id"] == trip_id]
-        else:
-            print(f"{datetime.now().astimezone().strftime('%H:%M:%S')} Invalid data for stop_times: {data}")
-            return []
-
-
-def get_stops(stops_list: list[int] = None):
-    """
-    Get all available stops.
-    :param stops_list: None, or specific stops IDs obtained from get_stop_order()
-    :return: List of json data for all stops, or for the specified IDs
-    """
-    try:
-        response = requests.get(url=f"{TRANZY_URL}{STOPS}", headers=headers)
-    except requests.exceptions.HTTPError as err:
-        print(explain_error(str(err)))
-        raise SystemExit(err)
-    else:
-        data = response.json()
-        if type(data) == list and len(data) != 0 and type(data[0]) == dict and "stop_id" in data[0]:
-            if stops_list:
-                # list of stop IDs was provided
-                return [s for s in response.json() if s["stop_id"] in stops_list]
-            else:
-                return response.json()
-        else:
-            print(f"{datetime.now().astimezone().strftime('%H:%M:%S')} Invalid data for stops: {data}")
-            return None
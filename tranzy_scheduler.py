@@ -0,0 +1,87 @@
+"""
+Drift-free polling scheduler: polls fire at fixed monotonic deadlines (start + n * interval),
+whatever the duration of each poll. If a poll overruns one or more deadlines, the missed ticks
+are merged into a single poll fired immediately, then the schedule continues on the same grid.
+"""
+
+import math
+import threading
+import time
+
+
+class PollScheduler:
+    """
+    Deadlines and timing statistics of a polling session.
+    """
+    def __init__(self, interval: float, end: float = None, clock=time.monotonic):
+        """
+        :param interval: Polling interval in seconds
+        :param end: Monotonic time when the session ends, None for no end
+        :param clock: Monotonic clock function
+        """
+        self.interval = interval
+        self.end = end
+        self.clock = clock
+        self.start = clock()
+        self.tick = 0  # index of next deadline
+        self.next_deadline = self.start
+        self.polls = 0
+        self.skipped_ticks = 0  # missed deadlines merged into a later poll
+        self.last_jitter = 0.0  # seconds between deadline and actual poll start
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        self.last_duration = 0.0  # seconds
+        self.max_duration = 0.0
+        self.poll_started = None
+
+    def wait(self, stop_event: threading.Event) -> bool:
+        """
+        Block until the next deadline.
+        :param stop_event: Event that interrupts the wait
+        :return: True if a poll must run now, False if stopped or session ended
+        """
+        while True:
+            now = self.clock()
+            if stop_event.is_set() or (self.end is not None and now >= self.end):
+                return False
+            if now >= self.next_deadline:
+                break
+            wait_until = self.next_deadline if self.end is None else min(self.next_deadline, self.end)
+            stop_event.wait(wait_until - now)
+        self.poll_started = now
+        self.last_jitter = now - self.next_deadline
+        self.max_jitter = max(self.max_jitter, self.last_jitter)
+        self.total_jitter += self.last_jitter
+        return True
+
+    def done(self):
+        """
+        Record the end of the poll started after wait() and compute the next deadline.
+        :return: None
+        """
+        now = self.clock()
+        self.polls += 1
+        self.last_duration = now - self.poll_started
+        self.max_duration = max(self.max_duration, self.last_duration)
+        self.tick += 1
+        # index of the last deadline already passed
+        passed = math.floor((now - self.start) / self.interval)
+        if passed > self.tick:
+            # poll overran several deadlines, merge them in one poll at the last passed deadline
+            self.skipped_ticks += passed - self.tick
+            self.tick = passed
+        self.next_deadline = self.start + self.tick * self.interval
+
+    def stats(self) -> dict:
+        """
+        :return: Timing statistics of the session, in seconds
+        """
+        return {
+            "polls": self.polls,
+            "skipped_ticks": self.skipped_ticks,
+            "last_jitter": self.last_jitter,
+            "max_jitter": self.max_jitter,
+            "mean_jitter": self.total_jitter / self.polls if self.polls else 0.0,
+            "last_duration": self.last_duration,
+            "max_duration": self.max_duration
+        }
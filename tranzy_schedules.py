@@ -0,0 +1,138 @@
+"""
+Recurring collection schedules (e.g. weekday rush hours) stored in the db.
+A single runner merges the windows active at a given time: one collector polls for the union of their trips,
+so each API call serves all active schedules. Windows are computed from the calendar and the schedules
+saved in db, so after a restart (or crash) the runner resumes the windows in progress right away.
+"""
+
+import queue
+import threading
+from datetime import datetime, timedelta
+from time import monotonic
+
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+
+from tranzy_collector import Collector
+from tranzy_db import Schedule
+from tranzy_db_tools import get_schedules, get_monitor_index
+
+# how long to sleep at most when idle, so new or modified schedules are picked up
+IDLE_CHECK = 60  # seconds
+
+
+def schedule_windows(schedule: Schedule, now: datetime, days: int = 8) -> list[tuple[datetime, datetime]]:
+    """
+    Windows of a schedule starting from yesterday (can be still active after midnight) to now + days.
+    :param schedule: Schedule object
+    :param now: Reference time (naive, local)
+    :param days: Number of days to look ahead
+    :return: List of (window start, window end)
+    """
+    windows = []
+    for d in range(-1, days):
+        day = now.date() + timedelta(days=d)
+        if str(day.isoweekday()) in schedule.weekdays:
+            start = datetime.combine(day, schedule.start_time)
+            end = datetime.combine(day, schedule.end_time)
+            if end <= start:
+                end += timedelta(days=1)
+            windows.append((start, end))
+    return windows
+
+
+def active_windows(schedules: list[Schedule], now: datetime) -> list[tuple[Schedule, datetime, datetime]]:
+    """
+    :param schedules: Schedule objects
+    :param now: Reference time (naive, local)
+    :return: List of (schedule, window start, window end) for windows in progress
+    """
+    return [(s, start, end) for s in schedules for start, end in schedule_windows(s, now) if start <= now < end]
+
+
+def next_window_start(schedules: list[Schedule], now: datetime):
+    """
+    :param schedules: Schedule objects
+    :param now: Reference time (naive, local)
+    :return: Start of the next window after now, or None
+    """
+    starts = [start for s in schedules for start, end in schedule_windows(s, now) if start > now]
+    return min(starts) if starts else None
+
+
+class ScheduleRunner:
+    """
+    Runs collectors for the enabled schedules, until stopped. Each segment (period with the same active
+    schedules) is served by one Collector; a new segment starts when a window starts or ends.
+    """
+    def __init__(self, engine: Engine, raw_log: bool = False):
+        self.engine = engine
+        self.raw_log = raw_log
+        self.stop_event = threading.Event()
+        self.collector = None
+        self.announced = None  # next window start already logged
+        self.started = datetime.now()
+
+    def next_segment(self):
+        """
+        Compute what to collect now.
+        :return: (trip IDs, polling interval, segment end datetime, monitor index, schedule names);
+         trip IDs is empty if no window is active, segment end is then the next window start (or None).
+         Names of windows that were already running before this runner started are suffixed with "(resumed)".
+        """
+        now = datetime.now()
+        with Session(self.engine) as session:
+            schedules = get_schedules(session, enabled_only=True)
+            active = active_windows(schedules, now)
+            next_start = next_window_start(schedules, now)
+            if not active:
+                return [], None, next_start, None, []
+            trip_id_list = sorted({st.trip.trip_id for s, start, end in active for st in s.schedule_trips})
+            polling_interval = min(s.polling_interval for s, start, end in active)
+            segment_end = min(end for s, start, end in active)
+            if next_start and next_start < segment_end:
+                segment_end = next_start
+            names = sorted({f"{s.name} (resumed)" if s.last_run and start <= s.last_run < self.started else s.name
+                            for s, start, end in active})
+            monitor_index = get_monitor_index(session, trip_id_list) if trip_id_list else None
+            # persist progress of the active schedules
+            for s, start, end in active:
+                s.last_run = now
+            session.commit()
+        return trip_id_list, polling_interval, segment_end, monitor_index, names
+
+    def run(self, consume, log=print):
+        """
+        Main loop.
+        :param consume: Function running a started Collector to its end, processing its messages
+        :param log: Function to log information messages
+        :return: None
+        """
+        while not self.stop_event.is_set():
+            trip_id_list, polling_interval, segment_end, monitor_index, names = self.next_segment()
+            if not trip_id_list:
+                wait_for = IDLE_CHECK
+                if segment_end:
+                    wait_for = min(wait_for, max((segment_end - datetime.now()).total_seconds(), 0))
+                    if segment_end != self.announced:
+                        log(f"next schedule window at {segment_end.strftime('%Y-%m-%d %H:%M')}")
+                        self.announced = segment_end
+                self.stop_event.wait(wait_for)
+                continue
+            log(f"schedules {', '.join(names)}: polling trips {', '.join(trip_id_list)} "
+                f"every {polling_interval} seconds until {segment_end.strftime('%H:%M')}")
+            self.collector = Collector(self.engine, trip_id_list, monitor_index, polling_interval, self.raw_log,
+                                       queue.Queue(), monotonic() + (segment_end - datetime.now()).total_seconds())
+            if self.stop_event.is_set():
+                break
+            consume(self.collector)
+            self.collector = None
+
+    def stop(self):
+        """
+        Stop the runner and the collector in progress
+        :return: None
+        """
+        self.stop_event.set()
+        if self.collector:
+            self.collector.stop()
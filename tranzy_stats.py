@@ -0,0 +1,658 @@
+"""
+Command line interface, runs without Tkinter (e.g. collection on a headless server).
+
+Examples:
+    python -m tranzy_stats trips
+    python -m tranzy_stats mock-server --port 8080 --vehicles 500 --latency 200 --error-429 0.05
+    python -m tranzy_stats load --trips 10 --polls 50 --vehicles 1000 --json load.json
+    python -m tranzy_stats bench --suite quick --json bench.json
+    python -m tranzy_stats synth --out bench/history.db --days 365 --routes 10 --no-traversals
+    python -m tranzy_stats bench --only get_trip_stats --fixture bench/history.manifest.json
+    python -m tranzy_stats collect --trip 42_0 --trip 24_1 --interval 15 --until 09:30
+    python -m tranzy_stats collect --trip 42_0 --duration 60 --log-file collect.log
+    python -m tranzy_stats --metrics-port 9108 schedule run
+    python -m tranzy_stats --profile 10 collect --trip 42_0
+    python -m tranzy_stats schedule add --name rush --days 12345 --start 07:00 --end 09:00 --trip 42_0 --trip 24_1
+    python -m tranzy_stats schedule run
+    python -m tranzy_stats backfill --trip 42_0
+    python -m tranzy_stats export --trip 42_0 --from 2024-05-01 --to 2024-05-31 --gzip
+    python -m tranzy_stats export --format parquet
+    python -m tranzy_stats export --incremental --gzip
+    python -m tranzy_stats replay --trip 42_0 --from 2024-05-01 --to 2024-05-31
+    python -m tranzy_stats rawlog --from 2024-05-01T07:00 --to 2024-05-01T09:00
+    python -m tranzy_stats recommend --trip 42_0 --from-stop 123 --to-stop 456 --arrive-by 08:30
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import signal
+import sys
+import tempfile
+from datetime import datetime, date, timedelta, time
+from time import monotonic
+
+from sqlalchemy.orm import Session
+
+from config import DB_URL, POLLING_INTERVAL, TIME_TO_RUN, EXPORT_WORKERS, RAW_LOG_DIR, REPLAY_WORKERS, BENCH_DIR, \
+    BENCH_BASELINE, METRICS_FILE
+from tranzy_bench import SUITES, run_suite, compare
+import tranzy_profile
+import tranzy_req
+from tranzy_collector import Collector
+from tranzy_db import open_db
+from tranzy_load import configure_trips, run_load
+from tranzy_metrics import registry, MetricsServer
+from tranzy_mock import MockNetwork, MockServer
+from tranzy_db_tools import get_monitored_trips, get_monitor_index, add_schedule, get_schedules, delete_schedule, \
+    get_stops_index
+from tranzy_migrate import current_version, LATEST_VERSION
+from tranzy_schedules import ScheduleRunner, active_windows
+from tranzy_export import export_csv, export_trips_parquet, export_incremental
+from tranzy_rawlog import read_snapshots
+from tranzy_replay import replay as replay_log
+from tranzy_recommend import departure_table, recommend_departure
+from tranzy_synth import generate as generate_history, manifest_file
+from tranzy_traversals import backfill_traversals, backfill_all, traversals_built
+
+logger = logging.getLogger("tranzy_stats")
+
+
+def setup_logging(log_file: str = None, verbose: bool = False):
+    """
+    Log to stdout and optionally to a file
+    :param log_file: File name, or None
+    :param verbose: Include skipped vehicles
+    :return: None
+    """
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, handlers=handlers,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+
+def end_time(until: str = None, duration: int = None) -> datetime:
+    """
+    :param until: End time as HH:MM, next occurrence (today or tomorrow)
+    :param duration: Minutes to run, used if until is not given
+    :return: End datetime
+    """
+    now = datetime.now()
+    if until:
+        hour, minute = (int(x) for x in until.split(":"))
+        end = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if end <= now:
+            end += timedelta(days=1)
+        return end
+    return now + timedelta(minutes=duration if duration else TIME_TO_RUN)
+
+
+def check_trips(session: Session, trip_id_list: list[str]) -> bool:
+    """
+    :param session: Session
+    :param trip_id_list: Trip IDs given on command line
+    :return: True if all trips are configured in db
+    """
+    configured = {t.trip_id for t in get_monitored_trips(session) or []}
+    missing = [t for t in trip_id_list if t not in configured]
+    if missing:
+        logger.error(f"trips not configured: {', '.join(missing)} (add them from the GUI first)")
+        return False
+    return True
+
+
+def stop_on_signal(stop):
+    """
+    Call stop function on SIGTERM / SIGINT
+    :param stop: Function to call
+    :return: None
+    """
+    def shutdown(signum, frame):
+        logger.info(f"signal {signal.Signals(signum).name} received, stopping")
+        stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+
+def run_collector(collector: Collector):
+    """
+    Run collector until its end time or until stopped, logging its messages
+    :param collector: Collector, not started
+    :return: None
+    """
+    log_levels = [logging.INFO, logging.INFO, logging.DEBUG]
+    poll_metrics = None
+    collector.start()
+    while collector.is_alive() or not collector.messages.empty():
+        try:
+            msg = collector.messages.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if msg[0] == "log":
+            logger.log(log_levels[msg[2]], msg[1])
+        elif msg[0] == "poll_metrics":
+            poll_metrics = msg[1]
+        elif msg[0] == "poll_timing":
+            logger.info(f"poll took {msg[1]['last_duration']:.2f} s, "
+                        f"started {msg[1]['last_jitter'] * 1000:.0f} ms after schedule"
+                        f"{' - ' + poll_metrics if poll_metrics else ''}")
+    c = collector.counters
+    logger.info(f"polling stopped: {c['polls']} polls, {c['stored']} positions saved, "
+                f"{c['skipped']} skipped, {c['errors']} errors")
+    if collector.scheduler:
+        t = collector.scheduler.stats()
+        logger.info(f"poll duration max {t['max_duration']:.2f} s, jitter mean {t['mean_jitter'] * 1000:.0f} ms / "
+                    f"max {t['max_jitter'] * 1000:.0f} ms, {t['skipped_ticks']} missed polls merged")
+
+
+def collect(args) -> int:
+    """
+    collect command
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    engine = open_db(args.db)
+    with Session(engine) as session:
+        if not check_trips(session, args.trip):
+            return 1
+        monitor_index = get_monitor_index(session, args.trip)
+    end = end_time(args.until, args.duration)
+    logger.info(f"polling vehicles for trip {', '.join(args.trip)} every {args.interval} seconds "
+                f"until {end.strftime('%Y-%m-%d %H:%M')}")
+    collector = Collector(engine, args.trip, monitor_index, args.interval, args.raw_log, queue.Queue(),
+                          monotonic() + (end - datetime.now()).total_seconds())
+    stop_on_signal(collector.stop)
+    run_collector(collector)
+    return 0
+
+
+def schedule(args) -> int:
+    """
+    schedule command: add / list / delete / run recurring collection schedules
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    engine = open_db(args.db)
+    if args.action == "run":
+        runner = ScheduleRunner(engine, args.raw_log)
+        stop_on_signal(runner.stop)
+        runner.run(run_collector, logger.info)
+        return 0
+    with Session(engine) as session:
+        if args.action == "add":
+            if not (args.name and args.days and args.start and args.end and args.trip):
+                logger.error("schedule add needs --name, --days, --start, --end and --trip")
+                return 1
+            if not check_trips(session, args.trip):
+                return 1
+            s = add_schedule(session, args.name, args.days, time.fromisoformat(args.start),
+                             time.fromisoformat(args.end), args.trip, args.interval)
+            print(f"schedule {s.idx} added")
+        elif args.action == "list":
+            active = {s.idx for s, start, end in active_windows(get_schedules(session), datetime.now())}
+            for s in get_schedules(session):
+                trip_ids = ", ".join(st.trip.trip_id for st in s.schedule_trips)
+                print(f"{s.idx} - {s.name}: days {s.weekdays} {s.start_time.strftime('%H:%M')}-"
+                      f"{s.end_time.strftime('%H:%M')} every {s.polling_interval} s, trips {trip_ids}"
+                      f"{' (active)' if s.idx in active else ''}{'' if s.enabled else ' (disabled)'}"
+                      f"{', last run ' + s.last_run.strftime('%Y-%m-%d %H:%M') if s.last_run else ''}")
+        elif args.action == "delete":
+            if not delete_schedule(session, args.idx):
+                logger.error(f"schedule {args.idx} not found")
+                return 1
+            print(f"schedule {args.idx} deleted")
+    return 0
+
+
+def migrate(args) -> int:
+    """
+    migrate command: apply pending schema migrations (done by open_db) and show the schema version
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    version = current_version(open_db(args.db))
+    print(f"schema version {version} (latest {LATEST_VERSION})")
+    return 0
+
+
+def backfill(args) -> int:
+    """
+    backfill command: rebuild stop passages and segment traversals from the positions history
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    with Session(open_db(args.db)) as session:
+        if not args.trip:
+            backfill_all(session, logger.info)
+            return 0
+        if not check_trips(session, args.trip):
+            return 1
+        for t in get_monitored_trips(session):
+            if t.trip_id in args.trip:
+                passages_count, traversals_count = backfill_traversals(session, t.idx)
+                logger.info(f"trip {t.trip_id}: {passages_count} stop passages, {traversals_count} segment traversals")
+    return 0
+
+
+def export(args) -> int:
+    """
+    export command: write positions of trips to csv or parquet files
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    if args.incremental and (args.first_day or args.last_day):
+        logger.error("--incremental exports all new positions, it can't be used with --from / --to")
+        return 1
+    first_day = date.fromisoformat(args.first_day) if args.first_day else None
+    last_day = date.fromisoformat(args.last_day) if args.last_day else None
+    engine = open_db(args.db)
+    with Session(engine) as session:
+        if args.trip and not check_trips(session, args.trip):
+            return 1
+        trip_ids = args.trip or [t.trip_id for t in get_monitored_trips(session) or []]
+        if args.format == "parquet":
+            def trip_done(trip_id, file_name, rows, done, total):
+                logger.info(f"{done}/{total} {trip_id}: " + (f"saved {file_name}, {rows} rows" if file_name
+                                                              else "no data to export"))
+
+            export_trips_parquet(engine, trip_ids, first_day, last_day, trip_done, args.workers, args.incremental)
+            return 0
+        for trip_id in trip_ids:
+            def progress(written, total):
+                logger.info(f"{trip_id}: {written} of {total} rows ({written * 100 // total}%)")
+
+            if args.incremental:
+                file_name, rows = export_incremental(session, trip_id, "csv.gz" if args.gzip else "csv", progress)
+                logger.info(f"{trip_id}: {rows} rows added to {file_name}" if file_name
+                            else f"{trip_id}: no new positions")
+                continue
+            file_name = export_csv(session, trip_id, first_day, last_day, args.gzip, progress)
+            logger.info(f"{trip_id}: saved {file_name}" if file_name else f"{trip_id}: no data to export")
+    return 0
+
+
+def recommend(args) -> int:
+    """
+    recommend command: best time to be at the start stop, from the travel times of past days
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    with Session(open_db(args.db)) as session:
+        trip = next((t for t in get_monitored_trips(session) or [] if t.trip_id == args.trip), None)
+        stops = get_stops_index(session, [args.from_stop, args.to_stop])
+        if not trip or len(stops) < 2:
+            logger.error("trip or stops not found in db")
+            return 1
+        if not traversals_built(session, trip.idx):
+            logger.error(f"segment traversals of trip {trip.trip_id} are not built, "
+                         f"run: python -m tranzy_stats backfill --trip {trip.trip_id}")
+            return 1
+        from_stop_idx, to_stop_idx = stops[args.from_stop].idx, stops[args.to_stop].idx
+        weekday = args.day or datetime.now().isoweekday()
+        if args.table:
+            for row in departure_table(session, trip.idx, from_stop_idx, to_stop_idx, weekday):
+                travel = f"{row['travel_p50'] / 60:.0f} min" if row["travel_p50"] is not None else "-"
+                print(f"{row['time'].strftime('%H:%M')} wait {row['wait_p50'] / 60:.0f} min, "
+                      f"travel {travel}, total p50 {row['total_p50'] / 60:.0f} / "
+                      f"p90 {row['total_p90'] / 60:.0f} min ({row['samples']} days)")
+        best = recommend_departure(session, trip.idx, from_stop_idx, to_stop_idx, weekday,
+                                   time.fromisoformat(args.after) if args.after else None,
+                                   time.fromisoformat(args.arrive_by) if args.arrive_by else None, args.window)
+        if not best:
+            print("no data for the requested time")
+            return 1
+        print(f"be at {stops[args.from_stop].stop_name} at {best['time'].strftime('%H:%M')}: arrival at "
+              f"{stops[args.to_stop].stop_name} {best['p50_arrival'].strftime('%H:%M')} (p50), "
+              f"{best['p90_arrival'].strftime('%H:%M')} (p90), {best['samples']} days of data")
+    return 0
+
+
+def rawlog(args) -> int:
+    """
+    rawlog command: summary of the raw log snapshots, or the snapshots as NDJSON on stdout
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    since = datetime.fromisoformat(args.since).astimezone() if args.since else None
+    until = datetime.fromisoformat(args.until).astimezone() if args.until else None
+    snapshots = vehicles = 0
+    first = last = None
+    for captured_at, data in read_snapshots(args.path, since, until):
+        if args.dump:
+            print(json.dumps({"captured_at": captured_at.isoformat(), "vehicles": data}, ensure_ascii=False,
+                             separators=(",", ":")))
+            continue
+        snapshots += 1
+        vehicles += len(data) if type(data) == list else 0
+        first = first or captured_at
+        last = captured_at
+    if not args.dump:
+        if snapshots:
+            print(f"{snapshots} snapshots from {first.astimezone().strftime('%Y-%m-%d %H:%M:%S')} "
+                  f"to {last.astimezone().strftime('%Y-%m-%d %H:%M:%S')}, {vehicles / snapshots:.0f} vehicles "
+                  f"per snapshot")
+        else:
+            print("no snapshots")
+    return 0
+
+
+def replay(args) -> int:
+    """
+    replay command: rebuild positions of configured trips from the raw log, without API calls
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    first_day = date.fromisoformat(args.first_day) if args.first_day else None
+    last_day = date.fromisoformat(args.last_day) if args.last_day else None
+    engine = open_db(args.db)
+    with Session(engine) as session:
+        if args.trip and not check_trips(session, args.trip):
+            return 1
+        trip_ids = args.trip or [t.trip_id for t in get_monitored_trips(session) or []]
+
+    def day_done(day, snapshots, inserted, skipped, done, total):
+        logger.info(f"{done}/{total} {day or args.path}: {snapshots} snapshots, {inserted} positions saved"
+                    f"{f', {skipped} already in db' if skipped else ''}")
+
+    start = monotonic()
+    totals = replay_log(engine, trip_ids, args.path, first_day, last_day, day_done, args.workers)
+    logger.info(f"replay done in {monotonic() - start:.0f} s: {totals['snapshots']} snapshots, "
+                f"{totals['inserted']} positions saved, {totals['skipped']} already in db")
+    return 0
+
+
+def mock_server(args) -> int:
+    """
+    mock-server command: serve a synthetic Tranzy API until stopped
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    network = MockNetwork(args.routes, args.stops, args.vehicles, stale_rate=args.stale, seed=args.seed)
+    server = MockServer(network, args.host, args.port, args.latency, args.error_429, args.error_500, args.seed)
+    logger.info(f"mock Tranzy API on {server.url} ({len(network.trips)} trips, {args.vehicles} vehicles), "
+                f"use it with TRANZY_URL={server.url}")
+    server.start()
+    stop_on_signal(server.shutdown)
+    server.thread.join()
+    server.server_close()
+    logger.info(f"mock server stopped: {server.counters}")
+    return 0
+
+
+def load(args) -> int:
+    """
+    load command: measure the collector polling a mock server (in-process, or --url), with a throwaway db
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    server = None
+    if args.url:
+        url = args.url
+    else:
+        network = MockNetwork(args.routes, args.stops, args.vehicles, stale_rate=args.stale, seed=args.seed)
+        server = MockServer(network, latency=args.latency, seed=args.seed).start()
+        url = server.url
+    work_dir = tempfile.mkdtemp(prefix="tranzy_load_")
+    try:
+        tranzy_req.use_api(url, os.path.join(work_dir, "cache"))
+        engine = open_db(f"sqlite+pysqlite:///{os.path.join(work_dir, 'load.db')}")
+        trip_ids = args.trip or [f"{route_id}_0" for route_id in range(1, args.trips + 1)]
+        with Session(engine) as session:
+            configure_trips(session, trip_ids)
+        if server:
+            # faults only once the trips are configured
+            server.error_429, server.error_500 = args.error_429, args.error_500
+        logger.info(f"{args.polls} polls of {url} for {len(trip_ids)} trips")
+        result = run_load(engine, trip_ids, args.polls, args.interval)
+        if server:
+            result["server"] = dict(server.counters)
+        engine.dispose()
+    finally:
+        if server:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    t = result["poll_ms"]
+    logger.info(f"{result['polls']} polls in {result['seconds']} s ({result['polls_per_s']} polls/s), "
+                f"poll p50 {t['p50']} ms / p95 {t['p95']} ms / max {t['max']} ms, "
+                f"{result['stored']} positions saved, {result['skipped']} skipped, {result['errors']} errors")
+    if "server" in result:
+        srv = result["server"]
+        logger.info(f"mock server: {srv.get('requests', 0)} requests, {srv.get('errors_429', 0)} answered 429, "
+                    f"{srv.get('errors_500', 0)} answered 500")
+    logger.info(f"stage p50 ms: {', '.join(f'{stage} {ms}' for stage, ms in result['stage_ms'].items())}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+def bench(args) -> int:
+    """
+    bench command: run a benchmark suite, save the results and compare them with the baseline
+    :param args: Parsed arguments
+    :return: Exit code, 2 if a case regressed compared to the baseline
+    """
+    report = run_suite(args.suite, args.seed, args.only, args.work_dir, logger.info, args.fixture)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        logger.info(f"no baseline {args.baseline} to compare with (save one with --save-baseline)")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["meta"].get("platform") != report["meta"]["platform"]:
+        logger.warning(f"baseline from another environment: {baseline['meta'].get('platform')}")
+    regressions = 0
+    for case, metric, old, new, change, regression in compare(report, baseline, args.tolerance):
+        logger.log(logging.WARNING if regression else logging.INFO,
+                   f"{case} {metric}: {old} -> {new} ({change:+.0%}){' REGRESSION' if regression else ''}")
+        regressions += regression
+    return 2 if regressions else 0
+
+
+def synth(args) -> int:
+    """
+    synth command: create a db with a synthetic collection history, and its manifest
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    if os.path.exists(args.out):
+        logger.error(f"{args.out} already exists")
+        return 1
+    first_day = date.fromisoformat(args.first_day)
+
+    def day_done(day, rows, total):
+        logger.info(f"{day}: {rows} positions, {total} in total")
+
+    manifest = generate_history(args.out, args.days, first_day, args.routes, args.stops, args.seed, args.rows,
+                                not args.no_traversals, day_done)
+    rows = manifest["rows"]
+    logger.info(f"{rows['position']} positions of {rows['trip']} trips from {manifest['first_day']} to "
+                f"{manifest['last_day']} in {manifest['seconds']} s, {rows['segment_traversal']} segment traversals; "
+                f"manifest {manifest_file(args.out)}")
+    return 0
+
+
+def trips(args) -> int:
+    """
+    trips command: list configured trips
+    :param args: Parsed arguments
+    :return: Exit code
+    """
+    with Session(open_db(args.db)) as session:
+        for t in get_monitored_trips(session) or []:
+            print(f"{t.trip_id} - line {t.route_short_name} ({t.route_long_name}) to {t.trip_headsign}")
+    return 0
+
+
+def parse_args(argv: list[str] = None):
+    """
+    :param argv: Command line arguments, default sys.argv
+    :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(prog="tranzy_stats", description="Tranzy Stats command line interface")
+    parser.add_argument("--db", default=DB_URL, help="database URL (default: %(default)s)")
+    parser.add_argument("--log-file", help="also write log to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log skipped vehicles too")
+    parser.add_argument("--metrics-file", default=METRICS_FILE,
+                        help="write poll metrics in Prometheus text format to this file after each poll")
+    parser.add_argument("--metrics-port", type=int, help="serve poll metrics for Prometheus on this port (/metrics)")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="listening address of the metrics endpoint (default: %(default)s, 0.0.0.0 for all)")
+    parser.add_argument("--profile", type=int, metavar="N",
+                        help="profile one poll in N (pstats or collapsed stacks in the profiles folder)")
+    parser.add_argument("--profile-mode", choices=tranzy_profile.MODES,
+                        help="deterministic (cProfile, .prof) or sampling (stack samples, .folded), "
+                             "default TRANZY_PROFILE_MODE or deterministic")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("collect", help="poll vehicles and save positions of configured trips")
+    p.add_argument("--trip", action="append", required=True, help="trip ID, repeat for multiple trips")
+    p.add_argument("--interval", type=int, default=POLLING_INTERVAL, help="polling interval in seconds")
+    p.add_argument("--until", help="stop at HH:MM (next occurrence)")
+    p.add_argument("--duration", type=int, help=f"minutes to run if --until not given (default {TIME_TO_RUN})")
+    p.add_argument("--raw-log", action="store_true", help="enable raw logging of vehicles JSON")
+    p.set_defaults(func=collect)
+
+    p = commands.add_parser("schedule", help="recurring collection schedules")
+    p.add_argument("action", choices=["add", "list", "delete", "run"])
+    p.add_argument("idx", nargs="?", type=int, help="schedule idx (delete)")
+    p.add_argument("--name", help="schedule name")
+    p.add_argument("--days", help="ISO weekdays, e.g. 12345 for Monday to Friday")
+    p.add_argument("--start", help="window start HH:MM")
+    p.add_argument("--end", help="window end HH:MM (before start if it ends next day)")
+    p.add_argument("--trip", action="append", help="trip ID, repeat for multiple trips")
+    p.add_argument("--interval", type=int, default=POLLING_INTERVAL, help="polling interval in seconds")
+    p.add_argument("--raw-log", action="store_true", help="enable raw logging of vehicles JSON (run)")
+    p.set_defaults(func=schedule)
+    schedule_parser = p
+
+    p = commands.add_parser("migrate", help="apply pending schema migrations")
+    p.set_defaults(func=migrate)
+
+    p = commands.add_parser("backfill", help="rebuild segment traversals from positions history")
+    p.add_argument("--trip", action="append", help="trip ID, repeat for multiple trips (default all)")
+    p.set_defaults(func=backfill)
+
+    p = commands.add_parser("export", help="export positions of trips to csv or parquet")
+    p.add_argument("--trip", action="append", help="trip ID, repeat for multiple trips (default all)")
+    p.add_argument("--format", choices=["csv", "parquet"], default="csv", help="file format (parquet needs pyarrow)")
+    p.add_argument("--from", dest="first_day", help="first day YYYY-MM-DD (local time)")
+    p.add_argument("--to", dest="last_day", help="last day YYYY-MM-DD, included")
+    p.add_argument("--gzip", action="store_true", help="write compressed .csv.gz files")
+    p.add_argument("--workers", type=int, default=EXPORT_WORKERS, help="trips exported in parallel (parquet)")
+    p.add_argument("--incremental", action="store_true",
+                   help="only positions saved since the previous incremental export (csv appended, parquet part files)")
+    p.set_defaults(func=export)
+
+    p = commands.add_parser("recommend", help="best departure time between two stops")
+    p.add_argument("--trip", required=True, help="trip ID")
+    p.add_argument("--from-stop", type=int, required=True, help="Tranzy stop ID of the start stop")
+    p.add_argument("--to-stop", type=int, required=True, help="Tranzy stop ID of the end stop")
+    p.add_argument("--day", type=int, choices=range(1, 8), help="ISO weekday (default today)")
+    p.add_argument("--after", help="earliest time at the start stop HH:MM (default now)")
+    p.add_argument("--arrive-by", help="latest arrival HH:MM (p90), the latest departure arriving in time is shown")
+    p.add_argument("--window", type=int, default=60, help="minutes after --after to search the fastest departure")
+    p.add_argument("--table", action="store_true", help="also print percentiles for each time of day")
+    p.set_defaults(func=recommend)
+
+    p = commands.add_parser("rawlog", help="read the raw log of vehicles snapshots")
+    p.add_argument("--path", default=RAW_LOG_DIR, help="raw log folder or file (default: %(default)s)")
+    p.add_argument("--from", dest="since", help="first capture time YYYY-MM-DDTHH:MM (local time)")
+    p.add_argument("--to", dest="until", help="last capture time YYYY-MM-DDTHH:MM, excluded")
+    p.add_argument("--dump", action="store_true", help="print the snapshots as NDJSON instead of a summary")
+    p.set_defaults(func=rawlog)
+
+    p = commands.add_parser("replay", help="rebuild positions of configured trips from the raw log")
+    p.add_argument("--trip", action="append", help="trip ID, repeat for multiple trips (default all)")
+    p.add_argument("--path", default=RAW_LOG_DIR, help="raw log folder or file (default: %(default)s)")
+    p.add_argument("--from", dest="first_day", help="first day YYYY-MM-DD (local time)")
+    p.add_argument("--to", dest="last_day", help="last day YYYY-MM-DD, included")
+    p.add_argument("--workers", type=int, default=REPLAY_WORKERS, help="days evaluated in parallel")
+    p.set_defaults(func=replay)
+
+    def add_mock_arguments(p):
+        p.add_argument("--routes", type=int, default=20, help="synthetic routes (2 trips each)")
+        p.add_argument("--stops", type=int, default=25, help="stops per trip")
+        p.add_argument("--vehicles", type=int, default=300, help="fleet size")
+        p.add_argument("--stale", type=float, default=0.05, help="fraction of vehicles with stale timestamps")
+        p.add_argument("--latency", type=float, default=0, help="mean response delay in ms")
+        p.add_argument("--error-429", type=float, default=0, help="fraction of requests answered 429")
+        p.add_argument("--error-500", type=float, default=0, help="fraction of requests answered 500")
+        p.add_argument("--seed", type=int, default=1, help="random seed")
+
+    p = commands.add_parser("mock-server", help="serve a synthetic Tranzy API (use with TRANZY_URL)")
+    p.add_argument("--host", default="127.0.0.1", help="listening address")
+    p.add_argument("--port", type=int, default=8080, help="listening port")
+    add_mock_arguments(p)
+    p.set_defaults(func=mock_server)
+
+    p = commands.add_parser("load", help="measure collection against a mock API, with a throwaway db")
+    p.add_argument("--url", help="API base URL (default: mock server started in this process)")
+    p.add_argument("--trip", action="append", help="trip ID to collect, repeat for multiple trips")
+    p.add_argument("--trips", type=int, default=10, help="collect trips 1_0 to N_0 if --trip not given")
+    p.add_argument("--polls", type=int, default=20, help="number of polls")
+    p.add_argument("--interval", type=float, default=0, help="seconds between polls (default back to back)")
+    p.add_argument("--json", help="write the results to this JSON file")
+    add_mock_arguments(p)
+    p.set_defaults(func=load)
+
+    p = commands.add_parser("bench", help="benchmark the ingest and stats hot paths on synthetic data")
+    p.add_argument("--suite", choices=list(SUITES), default="quick", help="data sizes (full: up to 10M positions)")
+    p.add_argument("--only", help="run only the cases whose name contains this text, e.g. insert_positions")
+    p.add_argument("--seed", type=int, default=1, help="random seed of the synthetic data")
+    p.add_argument("--work-dir", default=BENCH_DIR, help="folder of the generated dbs (default: %(default)s)")
+    p.add_argument("--json", help="write the results to this JSON file")
+    p.add_argument("--baseline", default=BENCH_BASELINE, help="baseline results (default: %(default)s)")
+    p.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    p.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown accepted (default: %(default)s)")
+    p.add_argument("--fixture", help="manifest of a synth db, used for the position table cases")
+    p.set_defaults(func=bench)
+
+    p = commands.add_parser("synth", help="create a db with a synthetic collection history (fixtures)")
+    p.add_argument("--out", required=True, help="new db file, the manifest is written next to it")
+    p.add_argument("--days", type=int, default=30, help="days of history")
+    p.add_argument("--from", dest="first_day", default="2024-01-01", help="first day YYYY-MM-DD (local time)")
+    p.add_argument("--routes", type=int, default=2, help="synthetic routes (2 trips each)")
+    p.add_argument("--stops", type=int, default=25, help="stops per trip")
+    p.add_argument("--rows", type=int, help="stop at this number of positions (more days if needed)")
+    p.add_argument("--seed", type=int, default=1, help="random seed")
+    p.add_argument("--no-traversals", action="store_true",
+                   help="don't build segment traversals (faster, run backfill later if needed)")
+    p.set_defaults(func=synth)
+
+    p = commands.add_parser("trips", help="list configured trips")
+    p.set_defaults(func=trips)
+
+    args = parser.parse_args(argv)
+    if args.func is schedule and args.action == "delete" and args.idx is None:
+        schedule_parser.error("schedule delete needs the schedule idx")
+    return args
+
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(argv)
+    setup_logging(args.log_file, args.verbose)
+    registry.file = args.metrics_file
+    if args.profile:
+        tranzy_profile.configure(True, args.profile, profile_mode=args.profile_mode)
+    if args.metrics_port:
+        server = MetricsServer(args.metrics_port, args.metrics_host).start()
+        logger.info(f"poll metrics on http://{server.server_address[0]}:{args.metrics_port}/metrics")
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+Synthetic collection history, to build large tranzy.db fixtures (benchmarks, stats and export tests) without
+months of live collection. A network of routes is saved as configured trips (trip, stop, stop_order and
+monitored_stops, all stops monitored) and the positions the collector would have saved are simulated day by day:
+ - departures from the first stop every headway, shorter in the weekday rush hours, longer in the evening
+   and at weekends
+ - travel time of each segment from a speed lowered around 8:00 and 17:00 on weekdays, with random variation
+ - dwell time at a stop proportional to the time since the previous vehicle left it (more passengers waiting):
+   a late vehicle gets later and its follower catches up, vehicles bunch as in real traffic
+ - vehicles polled every POLLING_INTERVAL, reports a few seconds old, some reports missing, GPS noise of a few
+   meters with occasional jumps; only positions within MAX_DIST_TO_STOP of a stop are saved, as by the collector
+Positions are computed with NumPy one vehicle run at a time and inserted in time order with executemany of plain
+tuples (no ORM objects), with the position indexes dropped during the load and rebuilt at the end, so tens of
+millions of rows take minutes. A manifest (JSON, next to the db) describes the content for benchmarks.
+"""
+
+import json
+import math
+import os
+import time
+from datetime import datetime, date, timedelta
+
+import numpy as np
+from sqlalchemy import insert, select, update, func
+from sqlalchemy.orm import Session
+
+from config import AGENCY_ID, MAX_DIST_TO_STOP, POLLING_INTERVAL
+from tranzy_db import Trip, Stop, StopOrder, MonitoredStops, Position, SegmentTraversal, open_db, create_indexes
+from tranzy_mock import CENTER, METERS_PER_DEGREE
+from tranzy_traversals import backfill_traversals
+
+SERVICE_HOURS = (5, 23)  # local time of the first and last departures
+HEADWAY = {"rush": 6, "day": 10, "evening": 15}  # minutes between departures, x1.5 at weekends
+RUSH_HOURS = ((7, 9), (16, 18))  # weekdays, shorter headways
+SLOWDOWN = ((8, 0.8, 0.45), (17, 1.0, 0.4))  # (peak hour, width in hours, speed reduction at the peak), weekdays
+SPEED = 25  # km/h, free flow between stops
+SPEED_VARIATION = 0.15  # sigma of the log-normal travel time factor of a segment
+DWELL = 20  # seconds at a stop when the previous vehicle left it one headway before
+LAYOVER = 120  # seconds at the first stop before departure
+SKIP_STOP = 0.15  # probability nobody gets on or off (no stop)
+REPORT_AGE = 20  # seconds, max age of the vehicle reports
+MISSING_REPORTS = 0.02  # fraction of polls without report of a vehicle
+GPS_NOISE = 8  # meters, sigma of the position error
+GPS_JUMPS = 0.005  # fraction of positions with a 10x error
+STOP_SPACING = (250, 600)  # meters between consecutive stops
+INSERT_SQL = "INSERT INTO position (vehicle_no, latitude, longitude, timestamp, speed, stop_distance, trip_idx, " \
+             "stop_idx) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def build_network(rnd: np.random.Generator, routes: int, stops_per_trip: int) -> tuple[list[dict], list[dict]]:
+    """
+    Routes are gently curved lines of stops through the city at irregular spacing; trip 0 runs along the line
+    and trip 1 back, through the same stops.
+    :param rnd: NumPy random generator
+    :param routes: Number of routes (2 trips each)
+    :param stops_per_trip: Stops of each trip
+    :return: List of stops (as the stops endpoint), list of trips: trip_id, route_id, stop_id (list),
+     dist (cumulative meters along the trip at each stop), lat, lon (arrays)
+    """
+    stops, trips = [], []
+    stop_id = 1000
+    cos_lat = math.cos(math.radians(CENTER[0]))
+    for route_id in range(1, routes + 1):
+        spacing = rnd.uniform(*STOP_SPACING, stops_per_trip - 1)
+        # heading drifts a little at each stop
+        heading = rnd.uniform(0, 2 * math.pi) + np.cumsum(rnd.normal(0, 0.15, stops_per_trip - 1))
+        north = np.concatenate(([0], np.cumsum(spacing * np.cos(heading))))
+        east = np.concatenate(([0], np.cumsum(spacing * np.sin(heading))))
+        # line centered near the city center
+        north += rnd.uniform(-1000, 1000) - north.mean()
+        east += rnd.uniform(-1000, 1000) - east.mean()
+        lat = np.round(CENTER[0] + north / METERS_PER_DEGREE, 6)
+        lon = np.round(CENTER[1] + east / (METERS_PER_DEGREE * cos_lat), 6)
+        ids = list(range(stop_id, stop_id + stops_per_trip))
+        stop_id += stops_per_trip
+        stops.extend({"stop_id": i, "stop_name": f"Stop {i}", "stop_lat": float(la), "stop_lon": float(lo)}
+                     for i, la, lo in zip(ids, lat, lon))
+        dist = np.concatenate(([0], np.cumsum(spacing)))
+        for direction in (0, 1):
+            if direction:
+                ids, dist, lat, lon = ids[::-1], dist[-1] - dist[::-1], lat[::-1], lon[::-1]
+            trips.append({"trip_id": f"{route_id}_{direction}", "route_id": route_id, "stop_id": ids,
+                          "dist": dist, "lat": lat, "lon": lon})
+    return stops, trips
+
+
+def save_network(session: Session, stops: list[dict], trips: list[dict], agency_id: str = AGENCY_ID):
+    """
+    Save stops and trips as configured for monitoring, all stops monitored. Adds trip_idx and stop_idx
+    (array of DB stop idx) to the trips.
+    :param session: Session
+    :param stops: Stops of build_network
+    :param trips: Trips of build_network
+    :param agency_id: Agency ID
+    :return: None
+    """
+    session.execute(insert(Stop), stops)
+    stop_idx = dict(session.execute(select(Stop.stop_id, Stop.idx)).all())
+    for t in trips:
+        first, last = f"Stop {t['stop_id'][0]}", f"Stop {t['stop_id'][-1]}"
+        trip = Trip(agency_id=int(agency_id), route_id=t["route_id"], trip_id=t["trip_id"], shape_id=t["trip_id"],
+                    route_short_name=str(t["route_id"]), route_long_name=f"{first} - {last}", trip_headsign=last,
+                    monitored=True)
+        session.add(trip)
+        session.add_all([StopOrder(stop_order=i, trip=trip, stop_idx=stop_idx[s]) for i, s in enumerate(t["stop_id"])])
+        session.add(MonitoredStops(start_stop=0, end_stop=len(t["stop_id"]) - 1, trip=trip))
+        session.flush()
+        t["trip_idx"] = trip.idx
+        t["stop_idx"] = np.array([stop_idx[s] for s in t["stop_id"]])
+    session.commit()
+
+
+def headway(hour: float, weekend: bool) -> float:
+    """
+    :param hour: Local time in hours
+    :param weekend: Saturday or Sunday
+    :return: Seconds between departures
+    """
+    if weekend:
+        return HEADWAY["day" if hour < 20 else "evening"] * 1.5 * 60
+    if any(start <= hour < end for start, end in RUSH_HOURS):
+        return HEADWAY["rush"] * 60
+    return HEADWAY["day" if hour < 20 else "evening"] * 60
+
+
+def speed_factor(hour: float, weekend: bool) -> float:
+    """
+    :param hour: Local time in hours
+    :param weekend: Saturday or Sunday
+    :return: Fraction of the free flow speed
+    """
+    if weekend:
+        return 1.0
+    return 1 - max(reduction * math.exp(-((hour - peak) / width) ** 2 / 2) for peak, width, reduction in SLOWDOWN)
+
+
+def simulate_runs(rnd: np.random.Generator, trip: dict, day_start: float, weekend: bool) -> list[tuple]:
+    """
+    Arrival and departure times at each stop of all the runs of a trip in a day. Runs are simulated in departure
+    order: the dwell time at a stop depends on the time since the previous run left it, and a run can't arrive
+    before the previous one (bunched vehicles follow each other).
+    :param rnd: NumPy random generator
+    :param trip: Trip of build_network
+    :param day_start: Local midnight, epoch seconds
+    :param weekend: Saturday or Sunday
+    :return: List of (arrival, departure) arrays of epoch seconds, one per run
+    """
+    segments = np.diff(trip["dist"])
+    n = len(trip["dist"])
+    runs, previous = [], None
+    t0 = day_start + SERVICE_HOURS[0] * 3600
+    while t0 < day_start + SERVICE_HOURS[1] * 3600:
+        planned = headway((t0 - day_start) / 3600, weekend)
+        variation = rnd.lognormal(0, SPEED_VARIATION, n)
+        skip = rnd.random(n) < SKIP_STOP
+        arrival, departure = np.empty(n), np.empty(n)
+        arrival[0] = t0 - LAYOVER
+        departure[0] = t0 + rnd.uniform(-30, 30)
+        for i in range(1, n):
+            hour = (departure[i - 1] - day_start) / 3600
+            t = departure[i - 1] + segments[i - 1] / (SPEED / 3.6 * speed_factor(hour, weekend)) * variation[i]
+            if previous is not None:
+                t = max(t, previous[0][i] + 5)
+            gap = t - previous[1][i] if previous is not None else planned
+            dwell = 0 if skip[i] and gap < planned else min(DWELL * max(gap, 0) / planned, 240) + 5
+            arrival[i], departure[i] = t, t + dwell
+        runs.append((arrival, departure))
+        previous = runs[-1]
+        t0 += planned
+    return runs
+
+
+def run_positions(rnd: np.random.Generator, trip: dict, arrival: np.ndarray, departure: np.ndarray,
+                  poll_start: float) -> dict:
+    """
+    Positions of one run saved by the collector: reports at each poll, within MAX_DIST_TO_STOP of a stop
+    :param rnd: NumPy random generator
+    :param trip: Trip of build_network, saved (save_network)
+    :param arrival: Arrival times at the stops, epoch seconds
+    :param departure: Departure times from the stops, epoch seconds
+    :param poll_start: Time of a poll, epoch seconds (polls every POLLING_INTERVAL)
+    :return: Dict of column arrays: timestamp (epoch seconds), latitude, longitude, speed, stop_distance, stop_idx
+    """
+    dist = trip["dist"]
+    polls = poll_start + POLLING_INTERVAL * np.arange(math.ceil((arrival[0] - poll_start) / POLLING_INTERVAL),
+                                                      math.floor((departure[-1] - poll_start) / POLLING_INTERVAL) + 1)
+    polls = polls[rnd.random(len(polls)) >= MISSING_REPORTS]
+    timestamp = np.floor(polls - rnd.uniform(0, REPORT_AGE, len(polls)))
+    # vehicle at a stop between arrival and departure, moving at constant speed between stops
+    events = np.column_stack((arrival, departure)).ravel()
+    along = np.interp(timestamp, events, np.repeat(dist, 2))
+    k = np.clip(np.searchsorted(dist, along), 1, len(dist) - 1)
+    closest = np.where(along - dist[k - 1] < dist[k] - along, k - 1, k)
+    # position on the segment, plus GPS error
+    segment = np.clip(np.searchsorted(dist, along, side="right") - 1, 0, len(dist) - 2)
+    f = (along - dist[segment]) / (dist[segment + 1] - dist[segment])
+    error = rnd.normal(0, GPS_NOISE, (2, len(timestamp))) * np.where(rnd.random(len(timestamp)) < GPS_JUMPS, 10, 1)
+    cos_lat = math.cos(math.radians(CENTER[0]))
+    lat = trip["lat"][segment] + (trip["lat"][segment + 1] - trip["lat"][segment]) * f \
+        + error[0] / METERS_PER_DEGREE
+    lon = trip["lon"][segment] + (trip["lon"][segment + 1] - trip["lon"][segment]) * f \
+        + error[1] / (METERS_PER_DEGREE * cos_lat)
+    stop_distance = np.hypot((lat - trip["lat"][closest]) * METERS_PER_DEGREE,
+                             (lon - trip["lon"][closest]) * METERS_PER_DEGREE * cos_lat)
+    # speed reported: 0 at a stop, average of the segment when moving
+    event = np.clip(np.searchsorted(events, timestamp, side="right") - 1, 0, len(events) - 2)
+    moving = event % 2 == 1
+    i = event // 2
+    travel = np.maximum(arrival[np.minimum(i + 1, len(dist) - 1)] - departure[i], 1)
+    speed = np.where(moving, np.diff(dist, append=dist[-1])[i] / travel * 3.6, 0)
+    keep = stop_distance <= MAX_DIST_TO_STOP
+    return {"timestamp": timestamp[keep], "latitude": np.round(lat[keep], 6), "longitude": np.round(lon[keep], 6),
+            "speed": np.round(speed[keep]).astype(int), "stop_distance": np.round(stop_distance[keep]).astype(int),
+            "stop_idx": trip["stop_idx"][closest[keep]]}
+
+
+def simulate_day(rnd: np.random.Generator, trips: list[dict], day: date) -> list[tuple]:
+    """
+    Positions of all the trips in a local day
+    :param rnd: NumPy random generator
+    :param trips: Trips of build_network, saved (save_network)
+    :param day: Local date
+    :return: Rows to insert, tuples in INSERT_SQL order, in timestamp order (naive UTC, as stored)
+    """
+    day_start = datetime.combine(day, datetime.min.time()).astimezone().timestamp()
+    weekend = day.isoweekday() > 5
+    poll_start = day_start + rnd.uniform(0, POLLING_INTERVAL)
+    columns = []
+    for t in trips:
+        # a vehicle is used again once back at the first stop (the return runs on the other trip)
+        pool = []
+        for arrival, departure in simulate_runs(rnd, t, day_start, weekend):
+            vehicle = next((v for v, free_at in enumerate(pool) if free_at < arrival[0]), len(pool))
+            free_at = departure[-1] + (departure[-1] - departure[0]) + 2 * LAYOVER
+            pool[vehicle:vehicle + 1] = [free_at]
+            c = run_positions(rnd, t, arrival, departure, poll_start)
+            c["vehicle_no"] = np.full(len(c["timestamp"]), f"{t['route_id']}{t['trip_id'][-1]}{vehicle:02d}")
+            c["trip_idx"] = np.full(len(c["timestamp"]), t["trip_idx"])
+            columns.append(c)
+    if not columns:
+        return []
+    c = {k: np.concatenate([r[k] for r in columns]) for k in columns[0]}
+    order = np.argsort(c["timestamp"], kind="stable")
+    timestamp = np.datetime_as_string(c["timestamp"][order].astype("datetime64[s]"), unit="us")
+    return list(zip(c["vehicle_no"][order].tolist(), c["latitude"][order].tolist(),
+                    c["longitude"][order].tolist(), np.char.replace(timestamp, "T", " ").tolist(),
+                    c["speed"][order].tolist(), c["stop_distance"][order].tolist(), c["trip_idx"][order].tolist(),
+                    c["stop_idx"][order].tolist()))
+
+
+def manifest_file(file_name: str) -> str:
+    """
+    :param file_name: Db file
+    :return: Manifest file of the db
+    """
+    return f"{os.path.splitext(file_name)[0]}.manifest.json"
+
+
+def generate(file_name: str, days: int = 30, first_day: date = date(2024, 1, 1), routes: int = 2,
+             stops_per_trip: int = 25, seed: int = 1, max_rows: int = None, traversals: bool = True,
+             progress=None) -> dict:
+    """
+    Create a db with a synthetic collection history and its manifest.
+    :param file_name: New db file (an existing file is an error)
+    :param days: Days of history
+    :param first_day: First local date
+    :param routes: Number of routes (2 trips each)
+    :param stops_per_trip: Stops of each trip
+    :param seed: Random seed, the same arguments and seed give the same db
+    :param max_rows: Stop at this number of positions (days continue as needed), None for all positions of the days
+    :param traversals: Build stop passages and segment traversals of the positions (as backfill)
+    :param progress: Function called after each day with (day, positions of the day, total positions), or None
+    :return: Manifest (dict), also written to manifest_file(file_name)
+    """
+    if os.path.exists(file_name):
+        raise FileExistsError(f"{file_name} already exists")
+    start = time.perf_counter()
+    rnd = np.random.default_rng(seed)
+    stops, trips = build_network(rnd, routes, stops_per_trip)
+    engine = open_db(f"sqlite+pysqlite:///{file_name}")
+    with Session(engine) as session:
+        save_network(session, stops, trips)
+    # indexes are built once at the end, faster than maintaining them row by row
+    for index in Position.__table__.indexes:
+        index.drop(engine, checkfirst=True)
+    total, day, last_day = 0, first_day, None
+    with engine.connect() as conn:
+        # a failed load is started again from scratch, no need to sync
+        conn.exec_driver_sql("PRAGMA synchronous=OFF")
+        while day < first_day + timedelta(days=days) or (max_rows and total < max_rows):
+            rows = simulate_day(rnd, trips, day)
+            if max_rows:
+                rows = rows[:max_rows - total]
+            if rows:
+                conn.exec_driver_sql(INSERT_SQL, rows)
+                conn.commit()
+            total += len(rows)
+            last_day = day
+            if progress:
+                progress(day, len(rows), total)
+            if max_rows and total >= max_rows:
+                break
+            day += timedelta(days=1)
+    create_indexes(engine)
+    with Session(engine) as session:
+        if traversals:
+            for t in trips:
+                backfill_traversals(session, t["trip_idx"])
+        else:
+            session.execute(update(Trip).values(traversals_built=False))
+            session.commit()
+        trip_rows = dict(session.execute(select(Position.trip_idx, func.count(Position.idx))
+                                         .group_by(Position.trip_idx)).all())
+        first, last = session.execute(select(func.min(Position.timestamp), func.max(Position.timestamp))).one()
+        traversal_rows = session.execute(select(func.count(SegmentTraversal.idx))).scalar()
+    engine.dispose()
+    manifest = {
+        "db": os.path.abspath(file_name),
+        "created": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "seconds": round(time.perf_counter() - start, 1),
+        "parameters": {"days": days, "first_day": first_day.isoformat(), "routes": routes,
+                       "stops_per_trip": stops_per_trip, "seed": seed, "max_rows": max_rows,
+                       "utc_offset": datetime.combine(first_day, datetime.min.time()).astimezone().strftime("%z")},
+        "first_day": first_day.isoformat(), "last_day": last_day.isoformat() if last_day else None,
+        "first_timestamp": first.isoformat() if first else None, "last_timestamp": last.isoformat() if last else None,
+        "rows": {"trip": len(trips), "stop": len(stops), "stop_order": sum(len(t["stop_id"]) for t in trips),
+                 "monitored_stops": len(trips), "position": total, "segment_traversal": traversal_rows},
+        "trips": [{"trip_id": t["trip_id"], "trip_idx": t["trip_idx"], "first_stop_id": t["stop_id"][0],
+                   "last_stop_id": t["stop_id"][-1], "stops": len(t["stop_id"]), "length_m": round(t["dist"][-1]),
+                   "positions": trip_rows.get(t["trip_idx"], 0)} for t in trips],
+    }
+    with open(manifest_file(file_name), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
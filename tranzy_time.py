@@ -0,0 +1,23 @@
+"""
+Conversions between API / local times and the db timestamps (naive UTC).
+"""
+
+from datetime import datetime, date, time, timedelta, timezone
+
+
+def utc_naive(ts: datetime) -> datetime:
+    """
+    :param ts: Datetime, aware (API) or naive UTC (db)
+    :return: Naive UTC datetime, as stored in db
+    """
+    return ts.astimezone(timezone.utc).replace(tzinfo=None) if ts.tzinfo else ts
+
+
+def local_day_bounds(day: date) -> tuple[datetime, datetime]:
+    """
+    :param day: Local date
+    :return: Start and end of the day as naive UTC datetimes (db timestamps)
+    """
+    start = datetime.combine(day, time()).astimezone().astimezone(timezone.utc).replace(tzinfo=None)
+    end = datetime.combine(day + timedelta(days=1), time()).astimezone().astimezone(timezone.utc).replace(tzinfo=None)
+    return start, end
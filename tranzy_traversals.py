@@ -0,0 +1,370 @@
+"""
+Segment traversals: travel times between every pair of monitored stops, kept up to date as positions are saved,
+so stats are a lookup instead of a pairing over raw positions.
+ - stop_passage: positions of a vehicle at a stop no more than PASSAGE_GAP minutes apart form a passage,
+   represented by the position closest to the stop
+ - segment_traversal: each passage at a stop is paired with the first passage at every later monitored stop,
+   if it comes before the next passage at the departure stop and within MAX_TRAVEL_TIME minutes
+The rules are the ones of get_trip_stats, which computes the same rows for one stop pair from positions.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete, update, insert, and_, bindparam
+from sqlalchemy.orm import Session
+
+from config import PASSAGE_GAP, MAX_TRAVEL_TIME
+from tranzy_db import Position, StopPassage, SegmentTraversal, StopOrder, MonitoredStops, Trip, TravelHistogram, \
+    HistogramWatermark
+from tranzy_time import utc_naive
+
+# rows per bulk insert when rebuilding
+BACKFILL_BATCH = 10000
+
+
+def monitored_order(session: Session, trip_idx: int) -> dict[int, int]:
+    """
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :return: Dict stop idx -> stop order, for the monitored stops of the trip
+    """
+    stmt = select(StopOrder.stop_idx, StopOrder.stop_order)\
+        .join(MonitoredStops, MonitoredStops.trip_idx == StopOrder.trip_idx)\
+        .where(and_(StopOrder.trip_idx == trip_idx,
+                    MonitoredStops.start_stop <= StopOrder.stop_order,
+                    StopOrder.stop_order <= MonitoredStops.end_stop))
+    return {stop_idx: stop_order for stop_idx, stop_order in session.execute(stmt)}
+
+
+def merge_position(last_passage: dict, position: dict) -> datetime:
+    """
+    Add a position to the passages of a vehicle, in time order.
+    :param last_passage: Dict stop idx -> last passage (dict of StopPassage columns), updated;
+     new passages have no "idx" key, changed passages get "changed" = True
+    :param position: Position row as dict
+    :return: Earliest passage timestamp changed (old or new closest position)
+    """
+    ts = utc_naive(position["timestamp"])
+    passage = last_passage.get(position["stop_idx"])
+    if passage and ts - passage["last_timestamp"] <= timedelta(minutes=PASSAGE_GAP):
+        changed_from = passage["timestamp"]
+        passage["last_timestamp"] = max(passage["last_timestamp"], ts)
+        passage["changed"] = True
+        if (position["stop_distance"], ts) < (passage["stop_distance"], passage["timestamp"]):
+            passage["timestamp"] = ts
+            passage["stop_distance"] = position["stop_distance"]
+        return min(changed_from, passage["timestamp"])
+    last_passage[position["stop_idx"]] = {"trip_idx": position["trip_idx"], "vehicle_no": position["vehicle_no"],
+                                          "stop_idx": position["stop_idx"], "timestamp": ts,
+                                          "stop_distance": position["stop_distance"], "last_timestamp": ts}
+    return ts
+
+
+def passage_row(passage: dict) -> dict:
+    """
+    :param passage: Passage dict built by merge_position
+    :return: StopPassage row as dict, for insert
+    """
+    return {k: v for k, v in passage.items() if k != "changed"}
+
+
+def traversal_row(trip_idx: int, vehicle_no: str, from_stop: int, to_stop: int, departure: datetime,
+                  arrival: datetime) -> dict:
+    """
+    :param arrival: Arrival timestamp, None if no arrival
+    :return: SegmentTraversal row as dict
+    """
+    return {"trip_idx": trip_idx, "vehicle_no": vehicle_no, "from_stop_idx": from_stop, "to_stop_idx": to_stop,
+            "departure": departure, "arrival": arrival,
+            "duration": round((arrival - departure).total_seconds()) if arrival else None}
+
+
+def departure_arrivals(passages: list[tuple[int, datetime]], i: int, order: dict[int, int],
+                       to_stops: set[int] = None) -> dict[int, datetime]:
+    """
+    Arrivals of the traversals departing at one passage of a vehicle.
+    :param passages: List of (stop idx, closest position timestamp), sorted by timestamp
+    :param i: Index of the departure passage in passages (at a monitored stop)
+    :param order: Dict stop idx -> stop order of the monitored stops, as returned by monitored_order
+    :param to_stops: Arrival stops to compute, None for all the monitored stops after the departure stop
+    :return: Dict arrival stop idx -> arrival timestamp, None if no arrival
+    """
+    from_stop, departure = passages[i]
+    max_travel = timedelta(minutes=MAX_TRAVEL_TIME)
+    # first passage at each stop until the vehicle is back at from_stop
+    arrivals = {}
+    for to_stop, ts in passages[i + 1:]:
+        if to_stop == from_stop or ts - departure > max_travel:
+            break
+        arrivals.setdefault(to_stop, ts)
+    result = {}
+    for to_stop, to_order in order.items():
+        if to_order <= order[from_stop] or (to_stops is not None and to_stop not in to_stops):
+            continue
+        arrival = arrivals.get(to_stop)
+        result[to_stop] = arrival if arrival and arrival > departure else None
+    return result
+
+
+def pair_passages(passages: list[tuple[int, datetime]], order: dict[int, int], trip_idx: int,
+                  vehicle_no: str) -> list[dict]:
+    """
+    Traversals departing at the given passages of one vehicle.
+    :param passages: List of (stop idx, closest position timestamp), sorted by timestamp
+    :param order: Dict stop idx -> stop order of the monitored stops, as returned by monitored_order
+    :param trip_idx: DB trip idx
+    :param vehicle_no: Vehicle number
+    :return: List of SegmentTraversal rows as dicts
+    """
+    rows = []
+    for i, (from_stop, departure) in enumerate(passages):
+        if from_stop not in order:
+            continue
+        rows.extend(traversal_row(trip_idx, vehicle_no, from_stop, to_stop, departure, arrival)
+                    for to_stop, arrival in departure_arrivals(passages, i, order).items())
+    return rows
+
+
+def diff_traversals(old: list[tuple[int, datetime]], new: list[tuple[int, datetime]], order: dict[int, int],
+                    trip_idx: int, vehicle_no: str) -> tuple[list[dict], list[dict], list[dict]]:
+    """
+    Traversal changes of a vehicle between two versions of its passages (before and after new positions).
+    Only the traversals whose departure or arrival passage changed are computed: all the traversals of a new or
+    moved passage, and for the earlier passages (at most MAX_TRAVEL_TIME before) those arriving at a changed stop,
+    or all of them if they depart from a changed stop (the vehicle being back at the departure stop ends them).
+    :param old: List of (stop idx, closest position timestamp) in db, sorted by timestamp
+    :param new: Same passages after the new positions
+    :param order: Monitored stops order, as returned by monitored_order
+    :param trip_idx: DB trip idx
+    :param vehicle_no: Vehicle number
+    :return: Rows to insert, rows to update (arrival, duration), departures to delete (from_stop_idx, departure)
+    """
+    changed = set(old).symmetric_difference(new)
+    if not changed:
+        return [], [], []
+    changed_stops = {stop for stop, _ in changed}
+    since = min(ts for _, ts in changed) - timedelta(minutes=MAX_TRAVEL_TIME)
+
+    def affected(passages: list[tuple[int, datetime]]) -> dict:
+        result = {}
+        for i, (stop, ts) in enumerate(passages):
+            if ts >= since and stop in order:
+                full = (stop, ts) in changed or stop in changed_stops
+                result[(stop, ts)] = departure_arrivals(passages, i, order, None if full else changed_stops)
+        return result
+
+    before, after = affected(old), affected(new)
+    inserts, updates = [], []
+    for (from_stop, departure), arrivals in after.items():
+        old_arrivals = before.get((from_stop, departure))
+        for to_stop, arrival in arrivals.items():
+            if old_arrivals is None or old_arrivals[to_stop] != arrival:
+                row = traversal_row(trip_idx, vehicle_no, from_stop, to_stop, departure, arrival)
+                (inserts if old_arrivals is None else updates).append(row)
+    deletes = [{"trip_idx": trip_idx, "vehicle_no": vehicle_no, "from_stop_idx": from_stop, "departure": departure}
+               for from_stop, departure in before if (from_stop, departure) not in after]
+    return inserts, updates, deletes
+
+
+def load_passages(session: Session, vehicles: list[tuple[int, str]], since: datetime, until: datetime = None) \
+        -> dict[tuple[int, str], list[dict]]:
+    """
+    Passages of several vehicles, in one query.
+    :param session: Session
+    :param vehicles: List of (trip idx, vehicle number)
+    :param since: Earliest last_timestamp (naive UTC)
+    :param until: Last_timestamp before this, None for no limit
+    :return: Dict (trip idx, vehicle number) -> list of passages (dict of StopPassage columns) by last_timestamp
+    """
+    condition = and_(StopPassage.trip_idx.in_({t for t, _ in vehicles}),
+                     StopPassage.vehicle_no.in_({v for _, v in vehicles}),
+                     StopPassage.last_timestamp >= since)
+    if until is not None:
+        condition = and_(condition, StopPassage.last_timestamp < until)
+    stmt = select(StopPassage.idx, StopPassage.trip_idx, StopPassage.vehicle_no, StopPassage.stop_idx,
+                  StopPassage.timestamp, StopPassage.stop_distance, StopPassage.last_timestamp)\
+        .where(condition).order_by(StopPassage.last_timestamp)
+    result = {key: [] for key in vehicles}
+    for row in session.execute(stmt):
+        passages = result.get((row.trip_idx, row.vehicle_no))
+        if passages is not None:
+            passages.append(row._asdict())
+    return result
+
+
+def update_traversals(session: Session, rows: list[dict]):
+    """
+    Update passages and traversals with new positions. Called by insert_positions before commit.
+    The passages of all the vehicles are read in one query, the traversals are not read: the ones in db are the
+    pairing of the passages before the update, so only the differences with the pairing after it are written.
+    :param session: Session
+    :param rows: Position rows as dicts, as inserted in db
+    :return: None
+    """
+    vehicles = {}
+    for row in rows:
+        vehicles.setdefault((row["trip_idx"], row["vehicle_no"]), []).append(row)
+    if not vehicles:
+        return
+    for positions in vehicles.values():
+        positions.sort(key=lambda r: utc_naive(r["timestamp"]))
+    # passages that can be extended by the new positions, and the ones their traversals can depart from
+    loaded_from = min(utc_naive(p[0]["timestamp"]) for p in vehicles.values()) \
+        - timedelta(minutes=PASSAGE_GAP + MAX_TRAVEL_TIME)
+    loaded = load_passages(session, list(vehicles), loaded_from)
+    orders = {}
+    changed, new_passages = [], []
+    inserts, updates, deletes = [], [], []
+    for (trip_idx, vehicle_no), positions in vehicles.items():
+        existing = loaded[(trip_idx, vehicle_no)]
+        old = sorted(((p["stop_idx"], p["timestamp"]) for p in existing), key=lambda p: p[1])
+        last_passage = {p["stop_idx"]: p for p in existing}
+        added = []
+        for position in positions:
+            passage = last_passage.get(position["stop_idx"])
+            merge_position(last_passage, position)
+            if last_passage[position["stop_idx"]] is not passage:
+                added.append(last_passage[position["stop_idx"]])
+        changed.extend({k: p[k] for k in ("idx", "timestamp", "stop_distance", "last_timestamp")}
+                       for p in existing if p.get("changed"))
+        new_passages.extend(added)
+        new = sorted(((p["stop_idx"], p["timestamp"]) for p in existing + added), key=lambda p: p[1])
+        moved = set(old).symmetric_difference(new)
+        if not moved:
+            continue
+        since = min(ts for _, ts in moved) - timedelta(minutes=MAX_TRAVEL_TIME)
+        if since < loaded_from:
+            # a long passage moved its closest position back: add the older departures
+            older = load_passages(session, [(trip_idx, vehicle_no)], since, loaded_from)[(trip_idx, vehicle_no)]
+            older = [(p["stop_idx"], p["timestamp"]) for p in older]
+            old = sorted(older + old, key=lambda p: p[1])
+            new = sorted(older + new, key=lambda p: p[1])
+        if trip_idx not in orders:
+            orders[trip_idx] = monitored_order(session, trip_idx)
+        vehicle_inserts, vehicle_updates, vehicle_deletes = diff_traversals(old, new, orders[trip_idx], trip_idx,
+                                                                            vehicle_no)
+        inserts.extend(vehicle_inserts)
+        updates.extend(vehicle_updates)
+        deletes.extend(vehicle_deletes)
+    if changed:
+        session.execute(update(StopPassage), changed)
+    if new_passages:
+        session.execute(insert(StopPassage), [passage_row(p) for p in new_passages])
+    connection = session.connection()
+    if deletes:
+        connection.execute(delete(SegmentTraversal)
+                           .where(and_(SegmentTraversal.trip_idx == bindparam("b_trip_idx"),
+                                       SegmentTraversal.vehicle_no == bindparam("b_vehicle_no"),
+                                       SegmentTraversal.departure == bindparam("b_departure"),
+                                       SegmentTraversal.from_stop_idx == bindparam("b_from_stop_idx"))),
+                           [{f"b_{k}": v for k, v in row.items()} for row in deletes])
+    if updates:
+        connection.execute(update(SegmentTraversal)
+                           .where(and_(SegmentTraversal.trip_idx == bindparam("b_trip_idx"),
+                                       SegmentTraversal.vehicle_no == bindparam("b_vehicle_no"),
+                                       SegmentTraversal.departure == bindparam("b_departure"),
+                                       SegmentTraversal.from_stop_idx == bindparam("b_from_stop_idx"),
+                                       SegmentTraversal.to_stop_idx == bindparam("b_to_stop_idx")))
+                           .values(arrival=bindparam("b_arrival"), duration=bindparam("b_duration")),
+                           [{f"b_{k}": v for k, v in row.items()} for row in updates])
+    if inserts:
+        session.execute(insert(SegmentTraversal), inserts)
+
+
+def backfill_traversals(session: Session, trip_idx: int, batch_size: int = BACKFILL_BATCH) -> tuple[int, int]:
+    """
+    Rebuild passages and traversals of a trip from all its positions, and mark them built (traversals_built).
+    The histograms derived from the traversals (tranzy_recommend) are reset, they are rebuilt when next used.
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :param batch_size: Rows per bulk insert
+    :return: Number of passages, number of traversals
+    """
+    session.execute(delete(HistogramWatermark).where(HistogramWatermark.trip_idx == trip_idx))
+    session.execute(delete(TravelHistogram).where(TravelHistogram.trip_idx == trip_idx))
+    session.execute(delete(SegmentTraversal).where(SegmentTraversal.trip_idx == trip_idx))
+    session.execute(delete(StopPassage).where(StopPassage.trip_idx == trip_idx))
+    order = monitored_order(session, trip_idx)
+    stmt = select(Position.trip_idx, Position.vehicle_no, Position.stop_idx, Position.timestamp,
+                  Position.stop_distance)\
+        .where(Position.trip_idx == trip_idx)\
+        .order_by(Position.vehicle_no, Position.timestamp)\
+        .execution_options(yield_per=batch_size)
+    passages_count = traversals_count = 0
+    pending_passages, pending_traversals = [], []
+
+    def flush(force: bool = False):
+        if pending_passages and (force or len(pending_passages) >= batch_size):
+            session.execute(insert(StopPassage), pending_passages)
+            pending_passages.clear()
+        if pending_traversals and (force or len(pending_traversals) >= batch_size):
+            session.execute(insert(SegmentTraversal), pending_traversals)
+            pending_traversals.clear()
+
+    def vehicle_done(vehicle_no: str, passages: list[dict]):
+        nonlocal passages_count, traversals_count
+        passages.sort(key=lambda p: p["timestamp"])
+        traversals = pair_passages([(p["stop_idx"], p["timestamp"]) for p in passages], order, trip_idx,
+                                   vehicle_no)
+        pending_passages.extend(passage_row(p) for p in passages)
+        pending_traversals.extend(traversals)
+        passages_count += len(passages)
+        traversals_count += len(traversals)
+        flush()
+
+    vehicle_no, passages, last_passage = None, [], {}
+    for position in session.execute(stmt).mappings():
+        if position["vehicle_no"] != vehicle_no:
+            if vehicle_no is not None:
+                vehicle_done(vehicle_no, passages)
+            vehicle_no, passages, last_passage = position["vehicle_no"], [], {}
+        passage = last_passage.get(position["stop_idx"])
+        merge_position(last_passage, position)
+        if last_passage[position["stop_idx"]] is not passage:
+            passages.append(last_passage[position["stop_idx"]])
+    if vehicle_no is not None:
+        vehicle_done(vehicle_no, passages)
+    flush(force=True)
+    session.execute(update(Trip).where(Trip.idx == trip_idx).values(traversals_built=True))
+    session.commit()
+    return passages_count, traversals_count
+
+
+def backfill_all(session: Session, log=print):
+    """
+    Rebuild passages and traversals of all trips
+    :param session: Session
+    :param log: Function to log progress messages
+    :return: None
+    """
+    for trip_idx, trip_id in session.execute(select(Trip.idx, Trip.trip_id).order_by(Trip.idx)).all():
+        passages_count, traversals_count = backfill_traversals(session, trip_idx)
+        log(f"trip {trip_id}: {passages_count} stop passages, {traversals_count} segment traversals")
+
+
+def traversals_built(session: Session, trip_idx: int) -> bool:
+    """
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :return: True if the segment traversals of the trip cover all its positions, False if the history before
+     they were introduced is not built yet (backfill)
+    """
+    return bool(session.execute(select(Trip.traversals_built).where(Trip.idx == trip_idx)).scalar())
+
+
+def get_segment_stats(session: Session, trip_idx, from_stop_idx, to_stop_idx):
+    """
+    Travel times between two monitored stops from the precomputed traversals (complete if traversals_built).
+    :param session: Session
+    :param trip_idx: DB trip idx
+    :param from_stop_idx: DB stop idx of the departure stop
+    :param to_stop_idx: DB stop idx of the arrival stop (after departure stop)
+    :return: List of rows (vehicle_no, departure, arrival, travel_time) ordered by departure, as get_trip_stats
+    """
+    stmt = select(SegmentTraversal.vehicle_no, SegmentTraversal.departure, SegmentTraversal.arrival,
+                  SegmentTraversal.duration.label("travel_time"))\
+        .where(and_(SegmentTraversal.trip_idx == trip_idx,
+                    SegmentTraversal.from_stop_idx == from_stop_idx,
+                    SegmentTraversal.to_stop_idx == to_stop_idx))\
+        .order_by(SegmentTraversal.departure)
+    return session.execute(stmt).all()